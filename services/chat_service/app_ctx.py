@@ -1,11 +1,10 @@
 import os
+import threading
 
-from llama_index.embeddings.openai import OpenAIEmbedding
+from providers import providers, GatedClient
+from startup import lazy
 
-from llama_index.llms.openai import OpenAI
-from llama_index.postprocessor import CohereRerank
-from llama_index.vector_stores import PineconeVectorStore
-from pinecone import Pinecone
+PINECONE_METHODS = ('query', 'upsert', 'delete', 'fetch', 'update')
 
 
 def get_env(key: str):
@@ -15,12 +14,103 @@ def get_env(key: str):
     return value
 
 
+def get_vector_store():
+    """
+    VECTOR_STORE selects `pinecone`, `local` (memory-mapped files under
+    LOCAL_VECTOR_STORE_PATH, shared with the ingest service) or `tiered` (pinecone with an
+    in-memory hot tier for the most recently active users). Pinecone namespaces follow
+    VECTOR_SHARDING, the local store is always partitioned by user.
+    """
+    backend = os.getenv('VECTOR_STORE', 'pinecone')
+    if backend not in ('pinecone', 'local', 'tiered'):
+        raise ValueError(f"Unknown vector store {backend}")
+    if backend == 'local':
+        from local_vector_store import LocalVectorStore
+        return LocalVectorStore(path=os.getenv('LOCAL_VECTOR_STORE_PATH', 'vectors'))
+
+    from llama_index.vector_stores import PineconeVectorStore
+    from pinecone import Pinecone
+
+    from chat_impl.vector_tier import TieredVectorStore
+    from vector_sharding import ShardingStrategy, ShardedVectorStore
+
+    pc = Pinecone(api_key=get_env('PINECONE_API_KEY'))
+    pinecone_index = GatedClient(
+        pc.Index("text-embedding-3-small-index"), providers.gate('pinecone'), PINECONE_METHODS
+    )
+    # unsharded is one namespace behind the same wrapper, which queries off the event loop
+    vector_store = ShardedVectorStore(
+        ShardingStrategy.from_env(),
+        lambda namespace: PineconeVectorStore(pinecone_index=pinecone_index, namespace=namespace),
+    )
+    if backend == 'tiered':
+        return TieredVectorStore(vector_store, max_users=int(os.getenv('VECTOR_HOT_TIER_USERS', '64')))
+    return vector_store
+
+
 class ApplicationContext:
+    """
+    Clients are built on first use and the libraries behind them imported then, so
+    constructing a context is free and startup can build them all concurrently.
+    """
+
     def __init__(self):
-        pc = Pinecone(api_key=get_env('PINECONE_API_KEY'))
-        pinecone_index = pc.Index("text-embedding-3-small-index")
+        self.openai_api_key = os.getenv('OPENAI_API_KEY')
+
+    @lazy
+    def gpt3(self):
+        from llama_index.llms.openai import OpenAI
+        return providers.share_openai(OpenAI(model='gpt-3.5-turbo', temperature=0))
+
+    @lazy
+    def embedding_cache(self):
+        from embedding_cache import EmbeddingCache
+        return EmbeddingCache(
+            max_bytes=int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            disk_path=os.getenv('EMBEDDING_CACHE_PATH'),
+        )
+
+    @lazy
+    def text_small(self):
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        from embedding_cache import CachedEmbedding
+        return CachedEmbedding(
+            providers.share_openai(OpenAIEmbedding(model='text-embedding-3-small')), self.embedding_cache
+        )
+
+    @lazy
+    def document_vector_store(self):
+        return get_vector_store()
+
+    @lazy
+    def cohere_rerank(self):
+        from llama_index.postprocessor import CohereRerank
+        rerank = CohereRerank(api_key=get_env('COHERE_API_KEY'), top_n=3)
+        # not public api, without the wrapper rerank calls just skip the gate
+        if hasattr(rerank, '_client'):
+            rerank._client = GatedClient(rerank._client, providers.gate('cohere'), ('rerank',))
+        return rerank
+
+    @lazy
+    def storage_client(self):
+        from google.cloud import storage
+        return storage.Client(project='speedy-atom-413006')
+
+    @lazy
+    def document_bucket(self):
+        return self.storage_client.bucket('speedy-atom-413006.appspot.com')
+
+
+_context = None
+_context_lock = threading.Lock()
+
 
-        self.gpt3 = OpenAI(model='gpt-3.5-turbo', temperature=0)
-        self.text_small = OpenAIEmbedding(model='text-embedding-3-small')
-        self.document_vector_store = PineconeVectorStore(pinecone_index=pinecone_index, namespace='documents')
-        self.cohere_rerank = CohereRerank(api_key=get_env('COHERE_API_KEY'), top_n=3)
+def get_context():
+    """
+    The context shared by the routes and the startup warm-up.
+    """
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = ApplicationContext()
+        return _context
@@ -0,0 +1,201 @@
+"""
+In-process fakes of the Google clients the apps hold: a GCS bucket, a Firestore client and
+Firebase id token verification. Each call sleeps the profile's latency, like the blocking
+client it replaces.
+"""
+import base64
+import hashlib
+import io
+import threading
+import time
+from typing import Dict, Any, Optional, Callable, List, Tuple
+
+
+class FakeBlob:
+    def __init__(self, bucket: 'FakeBucket', name: str, data: bytes = b'', content_type: Optional[str] = None,
+                 metadata: Optional[Dict[str, str]] = None, generation: int = 0):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.generation = generation
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode('ascii') if generation else None
+
+    def open(self, mode: str = 'rb'):
+        self.bucket.wait()
+        return io.BytesIO(self.bucket.read(self.name))
+
+    def download_as_bytes(self, if_generation_match: Optional[int] = None, **kwargs) -> bytes:
+        self.bucket.wait()
+        stored = self.bucket.blobs.get(self.name)
+        if stored is None:
+            from google.api_core.exceptions import NotFound
+            raise NotFound(self.name)
+        if if_generation_match is not None and stored.generation != if_generation_match:
+            from google.api_core.exceptions import PreconditionFailed
+            raise PreconditionFailed(self.name)
+        return stored.data
+
+    def upload_from_string(self, data: bytes, content_type: Optional[str] = None,
+                           if_generation_match: Optional[int] = None, **kwargs):
+        self.bucket.wait()
+        self.bucket.write(self.name, data, content_type or self.content_type, self.metadata, if_generation_match)
+
+
+class FakeBucket:
+    """
+    Objects live in a dict. Names `generate` returns content for are created on first
+    access, so a benchmark can refer to any number of synthetic uploads.
+    """
+
+    def __init__(self, latency_s: float = 0.02,
+                 generate: Optional[Callable[[str], Optional[Tuple[bytes, str, Dict[str, str]]]]] = None):
+        self.latency_s = latency_s
+        self.generate = generate
+        self.blobs: Dict[str, FakeBlob] = {}
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _get(self, name: str) -> Optional[FakeBlob]:
+        with self._lock:
+            blob = self.blobs.get(name)
+            if blob is None and self.generate is not None:
+                generated = self.generate(name)
+                if generated is not None:
+                    data, content_type, metadata = generated
+                    blob = self.blobs[name] = FakeBlob(self, name, data, content_type, metadata, generation=1)
+            return blob
+
+    def read(self, name: str) -> bytes:
+        blob = self._get(name)
+        if blob is None:
+            from google.api_core.exceptions import NotFound
+            raise NotFound(name)
+        return blob.data
+
+    def write(self, name: str, data: bytes, content_type: Optional[str], metadata: Dict[str, str],
+              if_generation_match: Optional[int] = None):
+        with self._lock:
+            current = self.blobs.get(name)
+            generation = current.generation if current else 0
+            if if_generation_match is not None and generation != if_generation_match:
+                from google.api_core.exceptions import PreconditionFailed
+                raise PreconditionFailed(name)
+            self.blobs[name] = FakeBlob(self, name, data, content_type, metadata, generation=generation + 1)
+
+    def get_blob(self, name: str) -> Optional[FakeBlob]:
+        self.wait()
+        return self._get(name)
+
+    def blob(self, name: str) -> FakeBlob:
+        return self._get(name) or FakeBlob(self, name)
+
+
+class FakeSnapshot:
+    def __init__(self, document_id: str, data: Optional[Dict[str, Any]]):
+        self.id = document_id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, db: 'FakeFirestore', path: str):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name: str) -> 'FakeCollectionReference':
+        return FakeCollectionReference(self.db, f'{self.path}/{name}')
+
+    def get(self, **kwargs) -> FakeSnapshot:
+        self.db.wait()
+        with self.db.lock:
+            return FakeSnapshot(self.id, self.db.documents.get(self.path))
+
+    def set(self, data: Dict[str, Any], merge: bool = False):
+        self.db.wait()
+        self.db.apply([(self, data, merge)])
+
+    def delete(self):
+        self.db.wait()
+        with self.db.lock:
+            self.db.documents.pop(self.path, None)
+
+
+class FakeWatch:
+    def unsubscribe(self):
+        pass
+
+
+class FakeCollectionReference:
+    def __init__(self, db: 'FakeFirestore', path: str):
+        self.db = db
+        self.path = path
+
+    def document(self, document_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self.db, f'{self.path}/{document_id}')
+
+    def on_snapshot(self, callback) -> FakeWatch:
+        # the initial snapshot, nothing changes afterwards
+        callback([], [], None)
+        return FakeWatch()
+
+
+class FakeWriteBatch:
+    def __init__(self, db: 'FakeFirestore'):
+        self.db = db
+        self.writes: List[Tuple[FakeDocumentReference, Dict[str, Any], bool]] = []
+
+    def set(self, reference: FakeDocumentReference, data: Dict[str, Any], merge: bool = False):
+        self.writes.append((reference, data, merge))
+
+    def commit(self):
+        self.db.wait()
+        self.db.apply(self.writes)
+
+
+class FakeFirestore:
+    def __init__(self, latency_s: float = 0.02):
+        self.latency_s = latency_s
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def apply(self, writes: List[Tuple[FakeDocumentReference, Dict[str, Any], bool]]):
+        with self.lock:
+            for reference, data, merge in writes:
+                current = self.documents.get(reference.path) if merge else None
+                self.documents[reference.path] = {**(current or {}), **data}
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+
+def bench_token(uid: str) -> str:
+    # shaped like a JWT so it passes the header checks, the uid is the middle segment
+    return f'bench.{uid}.signature'
+
+
+def fake_verify_id_token(latency_s: float = 0.05):
+    def verify_id_token(token: str, *args, **kwargs) -> Dict[str, Any]:
+        time.sleep(latency_s)
+        _, uid, _ = token.split('.')
+        return {'uid': uid, 'exp': time.time() + 3600}
+
+    return verify_id_token
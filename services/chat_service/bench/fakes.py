@@ -0,0 +1,120 @@
+import asyncio
+import time
+from typing import List, Optional, Any
+
+from llama_index import MockEmbedding, ServiceContext, get_response_synthesizer
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.llms import MockLLM
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+
+from bench.harness import RateLimiter
+from chat_impl.rerank import AdaptiveRerank, RerankSettings, RemoteRerankHealth, RerankStats, TermOverlapScorer
+from chat_impl.speculation import SpeculativeCitationQueryEngine
+from local_vector_store import LocalVectorStore
+
+
+class FakeRerank(BaseNodePostprocessor):
+    """
+    Stands in for CohereRerank: keeps the `top_n` best scored nodes after sleeping
+    `latency_s`, with an optional requests/s limit.
+    """
+
+    top_n: int = Field(default=3)
+    latency_s: float = Field(default=0.15)
+    _rate_limiter: RateLimiter = PrivateAttr()
+
+    def __init__(self, top_n: int = 3, latency_s: float = 0.15, requests_per_s: float = 0, **kwargs: Any):
+        super().__init__(top_n=top_n, latency_s=latency_s, **kwargs)
+        self._rate_limiter = RateLimiter(requests_per_s)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'FakeRerank'
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        self._rate_limiter.check()
+        time.sleep(self.latency_s)
+        return sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)[:self.top_n]
+
+
+class SlowLocalVectorStore(LocalVectorStore):
+    """
+    The local vector store with the round trip of a remote one. Queries block the calling
+    thread like the pinecone client does.
+    """
+
+    _latency_s: float = PrivateAttr()
+    _rate_limiter: RateLimiter = PrivateAttr()
+
+    def __init__(self, path: Optional[str] = None, latency_s: float = 0.03, requests_per_s: float = 0,
+                 **kwargs: Any):
+        super().__init__(path=path, **kwargs)
+        self._latency_s = latency_s
+        self._rate_limiter = RateLimiter(requests_per_s)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'SlowLocalVectorStore'
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        self._rate_limiter.check()
+        time.sleep(self._latency_s)
+        return super().query(query, **kwargs)
+
+
+class FakeRetriever(BaseRetriever):
+    """
+    Dense retrieval after `latency_s`: five close candidates per query, so AdaptiveRerank
+    has to call the remote reranker, the first one shared by all queries.
+    """
+
+    def __init__(self, latency_s: float):
+        super().__init__()
+        self.latency_s = latency_s
+        self.calls = 0
+
+    def _nodes(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return [
+            NodeWithScore(node=TextNode(id_='shared', text='overview'), score=0.8),
+            *[
+                NodeWithScore(node=TextNode(id_=f'{query_bundle.query_str}-{i}', text=f'{query_bundle.query_str} {i}'),
+                              score=0.79 - i / 100)
+                for i in range(4)
+            ],
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        self.calls += 1
+        time.sleep(self.latency_s)
+        return self._nodes(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        self.calls += 1
+        await asyncio.sleep(self.latency_s)
+        return self._nodes(query_bundle)
+
+
+def fake_citation_engine(retriever: BaseRetriever, rerank_s: float) -> SpeculativeCitationQueryEngine:
+    """
+    The citation engine the app builds, with the real AdaptiveRerank in front of a
+    FakeRerank that blocks for `rerank_s` like the cohere client.
+    """
+    settings = RerankSettings()
+    rerank = AdaptiveRerank(
+        remote=FakeRerank(latency_s=rerank_s),
+        settings=settings,
+        local_scorer=TermOverlapScorer(),
+        health=RemoteRerankHealth(settings.latency_budget_s, settings.probe_interval_s),
+        stats=RerankStats(),
+    )
+    # answers are streamed by the callers, the synthesizer is never called
+    service_context = ServiceContext.from_defaults(llm=MockLLM(), embed_model=MockEmbedding(embed_dim=1))
+    return SpeculativeCitationQueryEngine(
+        retriever=retriever,
+        response_synthesizer=get_response_synthesizer(service_context=service_context),
+        node_postprocessors=[rerank],
+    )
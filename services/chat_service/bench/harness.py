@@ -0,0 +1,277 @@
+"""
+Shared pieces of the load benchmarks: the latency profile of the fake upstreams, running
+the fakes and the app under test in processes of their own, driving requests at a fixed
+concurrency, and summarizing, saving and comparing results.
+"""
+import asyncio
+import importlib
+import itertools
+import json
+import multiprocessing
+import resource
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from dataclasses import dataclass, fields, asdict
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Tuple
+
+
+@dataclass
+class FakeProfile:
+    """
+    Latency in seconds and rate limit in requests per second (0 is unlimited) of every
+    service the apps call. Overridden from the command line with `name=value` pairs.
+    """
+
+    openai_first_token_s: float = 0.4
+    openai_token_s: float = 0.02
+    openai_tokens: int = 60
+    openai_rps: float = 0
+    embedding_s: float = 0.05
+    embedding_per_item_s: float = 0.0005
+    embedding_rps: float = 0
+    vector_s: float = 0.03
+    vector_rps: float = 0
+    rerank_s: float = 0.15
+    rerank_rps: float = 0
+    unstructured_s: float = 1.0
+    unstructured_per_page_s: float = 0.2
+    unstructured_rps: float = 0
+    gcs_s: float = 0.02
+    firestore_s: float = 0.02
+    auth_s: float = 0.05
+
+    @classmethod
+    def parse(cls, overrides: List[str]) -> 'FakeProfile':
+        names = {field.name for field in fields(cls)}
+        values = {}
+        for override in overrides:
+            name, _, value = override.partition('=')
+            if name not in names:
+                raise ValueError(f"Unknown fake setting {name}, expected one of {', '.join(sorted(names))}")
+            values[name] = type(getattr(cls, name))(value)
+        return cls(**values)
+
+
+class FakeRateLimitError(Exception):
+    pass
+
+
+class RateLimiter:
+    def __init__(self, requests_per_s: float = 0):
+        self.requests_per_s = requests_per_s
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def check(self):
+        if not self.requests_per_s:
+            return
+        now = time.monotonic()
+        with self._lock:
+            while self._calls and now - self._calls[0] > 1.0:
+                self._calls.popleft()
+            if len(self._calls) >= self.requests_per_s:
+                raise FakeRateLimitError(f"more than {self.requests_per_s} requests/s")
+            self._calls.append(now)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def with_rss_route(app):
+    @app.get('/bench/rss')
+    async def get_rss():
+        return {'peak_rss_mb': peak_rss_mb()}
+
+    return app
+
+
+def _serve(factory: str, port: int, args: tuple):
+    import uvicorn
+
+    module, _, name = factory.partition(':')
+    app = getattr(importlib.import_module(module), name)(*args)
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning')
+
+
+class ServerProcess:
+    """
+    Serves the app returned by `factory` ('module:function', called with `args` in the
+    child) with uvicorn in a spawned process, so the load generator and the fakes do not
+    share a GIL or an event loop with the app under test.
+    """
+
+    def __init__(self, factory: str, *args: Any):
+        self.factory = factory
+        self.args = args
+        self.port = 0
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.startup_s = 0.0
+        self.ready_s: Optional[float] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self, timeout_s: float = 300) -> 'ServerProcess':
+        self.port = free_port()
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=_serve, args=(self.factory, self.port, self.args), daemon=True
+        )
+        self.started_at = start = time.perf_counter()
+        self.process.start()
+        while time.perf_counter() - start < timeout_s:
+            if not self.process.is_alive():
+                raise RuntimeError(f"{self.factory} exited with {self.process.exitcode} while starting")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                self.startup_s = time.perf_counter() - start
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise TimeoutError(f"{self.factory} did not start within {timeout_s}s")
+
+    def wait_ready(self, path: str = '/ready', timeout_s: float = 300) -> float:
+        """
+        Polls `path` until it answers 200, for apps that warm up after they start serving,
+        and returns the seconds since the process was started.
+        """
+        while time.perf_counter() - self.started_at < timeout_s:
+            try:
+                with urllib.request.urlopen(self.url + path, timeout=5) as response:
+                    if response.status == 200:
+                        self.ready_s = time.perf_counter() - self.started_at
+                        return self.ready_s
+            except (urllib.error.URLError, OSError):
+                pass
+            time.sleep(0.1)
+        raise TimeoutError(f"{self.factory} was not ready within {timeout_s}s")
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(10)
+
+    def __enter__(self) -> 'ServerProcess':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+async def drive(request: Callable[[int], Awaitable[None]], concurrency: int, total: int) -> float:
+    """
+    Runs `request(i)` for i in range(total) with `concurrency` requests in flight, and
+    returns the wall time.
+    """
+    counter = itertools.count()
+
+    async def worker():
+        while (i := next(counter)) < total:
+            await request(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Latency percentiles in milliseconds of `values` in seconds.
+    """
+    if not values:
+        return {'count': 0, 'mean_ms': None, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    ordered = sorted(values)
+
+    def percentile(q: float) -> float:
+        return 1000 * ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': 1000 * sum(ordered) / len(ordered),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': 1000 * ordered[-1],
+    }
+
+
+def report(service: str, profile: FakeProfile, startup_s: float, results: List[Dict[str, Any]],
+           settings: Dict[str, Any], ready_s: Optional[float] = None) -> Dict[str, Any]:
+    return {
+        'service': service,
+        'created_at': time.time(),
+        'profile': asdict(profile),
+        'settings': settings,
+        'startup_s': startup_s,
+        'ready_s': ready_s,
+        'results': results,
+    }
+
+
+def save(result: Dict[str, Any], path: str):
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+# metrics compared between runs, where lower is better unless listed in HIGHER_IS_BETTER
+COMPARED = (
+    ('latency', 'p50_ms'), ('latency', 'p95_ms'), ('latency', 'p99_ms'),
+    ('first_token', 'p50_ms'), ('first_token', 'p95_ms'), ('accepted', 'p50_ms'), ('accepted', 'p95_ms'),
+    ('throughput_rps', None), ('peak_rss_mb', None),
+)
+HIGHER_IS_BETTER = {'throughput_rps'}
+
+
+def _metric(result: Dict[str, Any], key: Tuple[str, Optional[str]]) -> Optional[float]:
+    group, name = key
+    value = result.get(group)
+    return value.get(name) if name and isinstance(value, dict) else value
+
+
+def compare(current: Dict[str, Any], baseline_path: str, tolerance: float = 0.1) -> List[str]:
+    """
+    Prints each compared metric against a saved run of the same scenario and concurrency,
+    and returns the ones that got worse by more than `tolerance`.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(result['scenario'], result['concurrency']): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        key = (result['scenario'], result['concurrency'])
+        previous = before.get(key)
+        if previous is None:
+            continue
+        changes = []
+        for metric in COMPARED:
+            old, new = _metric(previous, metric), _metric(result, metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            name = '.'.join(part for part in metric if part)
+            changes.append(f"{name} {old:.1f}->{new:.1f} ({change:+.0%})")
+            worse = -change if metric[0] in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append(f"{key[0]}@{key[1]} {name} {change:+.0%}")
+        print(f"{key[0]:<12} concurrency={key[1]:<3} " + ', '.join(changes))
+    if 'startup_s' in baseline:
+        print(f"startup {baseline['startup_s']:.2f}s->{current['startup_s']:.2f}s")
+    if baseline.get('ready_s') and current.get('ready_s'):
+        print(f"ready {baseline['ready_s']:.2f}s->{current['ready_s']:.2f}s")
+    return regressions
@@ -0,0 +1,152 @@
+"""
+Recall and latency of dense, keyword and fused retrieval on a synthetic corpus. Dense
+retrieval is simulated with topic vectors, so it finds what a document is about but
+not exact identifiers, which is where embeddings are weak. Run from the service directory:
+
+    python -m bench.hybrid_recall --documents 5000 --queries 500
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from chat_impl.hybrid import reciprocal_rank_fusion
+from keyword_index import KeywordDocument, KeywordIndex
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'zi', 'pe', 'su', 'da', 'fi']
+
+
+def word(rng: random.Random) -> str:
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def build_corpus(documents: int, topics: int, dim: int, rng: random.Random, np_rng):
+    vocabularies = [[word(rng) for _ in range(40)] for _ in range(topics)]
+    centroids = np_rng.normal(size=(topics, dim))
+    corpus = []
+    for i in range(documents):
+        topic = rng.randrange(topics)
+        identifier = rng.choice([
+            f'INV-{rng.randint(10000, 99999)}',
+            f'{word(rng)}_{word(rng)}_v{rng.randint(1, 9)}',
+            f'{word(rng)}{word(rng).capitalize()}Handler',
+        ])
+        body = ' '.join(rng.choice(vocabularies[topic][:30]) for _ in range(60))
+        text = f'{body} see {identifier} in report_{i}.pdf'
+        vector = centroids[topic] + np_rng.normal(scale=0.6, size=dim)
+        corpus.append((str(i), topic, identifier, text, vector))
+    return vocabularies, centroids, corpus
+
+
+def build_queries(corpus, vocabularies, centroids, count: int, rng: random.Random, np_rng):
+    queries = []
+    for _ in range(count):
+        doc_id, topic, identifier, text, vector = rng.choice(corpus)
+        if rng.random() < 0.5:
+            # exact term: names the identifier, dense only knows the topic
+            query = f'where did I mention {identifier}'
+            query_vector = centroids[topic] + np_rng.normal(scale=0.8, size=len(vector))
+            kind = 'exact'
+        else:
+            # paraphrase: words the document does not use, dense is close to the document
+            query = ' '.join(rng.choice(vocabularies[topic][30:]) for _ in range(5))
+            query_vector = vector + np_rng.normal(scale=0.3, size=len(vector))
+            kind = 'semantic'
+        queries.append((kind, query, query_vector, doc_id))
+    return queries
+
+
+def dense_search(matrix: np.ndarray, ids, query_vector: np.ndarray, top_k: int):
+    scores = matrix @ (query_vector / np.linalg.norm(query_vector))
+    best = np.argpartition(-scores, top_k)[:top_k]
+    return [ids[i] for i in best[np.argsort(-scores[best])]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=5000)
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--dense-top-k', type=int, nargs='+', default=[10, 6])
+    parser.add_argument('--keyword-top-k', type=int, default=6)
+    parser.add_argument('--top-k', type=int, default=8)
+    parser.add_argument('--rerank-top-n', type=int, default=3)
+    parser.add_argument('--skip-rerank-score', type=float, default=0.99)
+    parser.add_argument('--dense-latency-ms', type=float, default=80,
+                        help='simulated vector store round trip, retrieval runs concurrently with it')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    rng, np_rng = random.Random(args.seed), np.random.default_rng(args.seed)
+    vocabularies, centroids, corpus = build_corpus(args.documents, args.topics, args.dim, rng, np_rng)
+    queries = build_queries(corpus, vocabularies, centroids, args.queries, rng, np_rng)
+
+    start = time.perf_counter()
+    index = KeywordIndex(KeywordDocument.from_text(doc_id, text, {}) for doc_id, _, _, text, _ in corpus)
+    build_s = time.perf_counter() - start
+    ids = [doc_id for doc_id, *_ in corpus]
+    matrix = np.stack([vector / np.linalg.norm(vector) for *_, vector in corpus])
+    serialized = index.to_bytes()
+
+    keyword_ms = []
+    found = {}
+
+    def hit(name, kind, ranking, target, k):
+        key = (name, kind, k)
+        found[key] = found.get(key, 0) + (target in ranking[:k])
+
+    kinds = {}
+    skipped, skipped_correct = 0, 0
+    for kind, query, query_vector, target in queries:
+        kinds[kind] = kinds.get(kind, 0) + 1
+        start = time.perf_counter()
+        keyword = [document.id for document, _ in index.search(query, args.keyword_top_k)]
+        keyword_ms.append(1000 * (time.perf_counter() - start))
+
+        for k in (args.rerank_top_n, args.top_k):
+            hit('keyword', kind, keyword, target, k)
+        for dense_top_k in args.dense_top_k:
+            dense = dense_search(matrix, ids, query_vector, dense_top_k)
+            fused = reciprocal_rank_fusion([dense, keyword])[:args.top_k]
+            fused_ids = [doc_id for doc_id, _ in fused]
+            for k in (args.rerank_top_n, args.top_k):
+                hit(f'dense@{dense_top_k}', kind, dense, target, k)
+                hit(f'hybrid(dense@{dense_top_k})', kind, fused_ids, target, k)
+            if dense_top_k == min(args.dense_top_k) and fused and fused[0][1] >= args.skip_rerank_score:
+                skipped += 1
+                skipped_correct += fused_ids[0] == target
+
+    results = {
+        'documents': args.documents,
+        'queries': kinds,
+        'index_build_s': build_s,
+        'index_bytes_gzip': len(serialized),
+        'keyword_p50_ms': float(np.percentile(keyword_ms, 50)),
+        'keyword_p99_ms': float(np.percentile(keyword_ms, 99)),
+        # both retrievers run concurrently, the keyword index is in memory
+        'hybrid_latency_ms': max(args.dense_latency_ms, float(np.percentile(keyword_ms, 50))),
+        'rerank_skipped': skipped / len(queries),
+        'rerank_skipped_top1_correct': skipped_correct / skipped if skipped else 0.0,
+        'recall': {},
+    }
+    for (name, kind, k), count in sorted(found.items()):
+        results['recall'].setdefault(name, {})[f'{kind}@{k}'] = count / kinds[kind]
+
+    for name, recall in results['recall'].items():
+        print(f"{name:<22} " + ' '.join(f"{key}={value:.3f}" for key, value in recall.items()))
+    print(f"keyword search p50={results['keyword_p50_ms']:.2f}ms p99={results['keyword_p99_ms']:.2f}ms, "
+          f"index {results['index_bytes_gzip'] / 1024:.0f}KiB gzipped, built in {build_s:.2f}s")
+    print(f"rerank skipped for {results['rerank_skipped']:.1%} of queries, "
+          f"top1 correct in {results['rerank_skipped_top1_correct']:.1%} of those")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
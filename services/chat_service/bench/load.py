@@ -0,0 +1,261 @@
+"""
+Load test of /chat through the real app. The app runs in its own process with OpenAI and
+Unstructured replaced by bench.fake_upstream, and Pinecone, Cohere, GCS, Firestore and
+Firebase auth by in-process fakes, each with the latency and rate limit of the profile
+(`--fake name=value`, see bench.harness.FakeProfile). The vector store and keyword indexes
+are seeded with a synthetic corpus per user, so retrieval, hybrid search and reranking run
+on real data. App settings are passed with `--env NAME=value`.
+
+Reports latency, time to first token, throughput and errors per scenario and concurrency,
+the peak RSS of the app and its time to serve and to be ready. Run from the service
+directory:
+
+    python -m bench.load --scenarios documents agent --concurrency 1 8 32 --output chat.json
+    python -m bench.load --fake openai_first_token_s=0.8 --compare chat.json
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from functools import partial
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from bench.fake_cloud import FakeBucket, FakeFirestore, bench_token, fake_verify_id_token
+from bench.fake_upstream import topic_vector
+from bench.harness import FakeProfile, ServerProcess, drive, summarize, report, save, compare, with_rss_route
+
+TOPICS = [
+    ('budget', 'forecast'), ('roadmap', 'milestones'), ('hiring', 'pipeline'), ('latency', 'targets'),
+    ('invoice', 'totals'), ('vacation', 'itinerary'), ('recipe', 'ingredients'), ('fitness', 'routine'),
+    ('lease', 'renewal'), ('thesis', 'outline'), ('garden', 'schedule'), ('insurance', 'claims'),
+]
+SCENARIOS = ('documents', 'agent', 'sub_questions', 'small_talk')
+
+
+def corpus(uid: str, chunks: int) -> List[Tuple[str, str, Dict[str, Any]]]:
+    documents = []
+    for i in range(chunks):
+        topic, attribute = TOPICS[i % len(TOPICS)]
+        text = (f"{topic} {attribute} part {i}: the {topic} {attribute} were reviewed and the {topic} "
+                f"{attribute} notes record decision {i} with owner {uid} and follow up {i % 7}.")
+        documents.append((f'{uid}-{i}', text, {'user': uid, 'file_name': f'{topic}.md'}))
+    return documents
+
+
+def seed(seed_dir: str, users: int, chunks: int):
+    """
+    Writes the vectors where the app's local vector store reads them, and the keyword
+    indexes as files the fake bucket serves.
+    """
+    from llama_index.schema import TextNode
+
+    from keyword_index import KeywordDocument, KeywordIndex
+    from local_vector_store import LocalVectorStore
+
+    store = LocalVectorStore(path=os.path.join(seed_dir, 'vectors'))
+    os.makedirs(os.path.join(seed_dir, 'keyword-index'), exist_ok=True)
+    for n in range(users):
+        uid = f'user{n}'
+        documents = corpus(uid, chunks)
+        store.add([
+            TextNode(id_=node_id, text=text, metadata=metadata, embedding=topic_vector(text))
+            for node_id, text, metadata in documents
+        ])
+        index = KeywordIndex(KeywordDocument.from_text(node_id, text, metadata) for node_id, text, metadata in documents)
+        with open(os.path.join(seed_dir, 'keyword-index', f'{uid}.json.gz'), 'wb') as f:
+            f.write(index.to_bytes())
+
+
+def seeded_object(seed_dir: str, name: str) -> Optional[Tuple[bytes, str, Dict[str, str]]]:
+    path = os.path.join(seed_dir, name)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read(), 'application/gzip', {}
+
+
+class BenchApplicationContext:
+    def __init__(self, profile: FakeProfile, upstream_url: str, seed_dir: str):
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        from llama_index.llms.openai import OpenAI
+
+        from bench.fakes import FakeRerank, SlowLocalVectorStore
+        from embedding_cache import CachedEmbedding, EmbeddingCache
+        from providers import providers
+
+        api_base = f'{upstream_url}/v1'
+        self.openai_api_key = 'bench'
+        self.gpt3 = providers.share_openai(
+            OpenAI(model='gpt-3.5-turbo', temperature=0, api_key='bench', api_base=api_base)
+        )
+        self.embedding_cache = EmbeddingCache()
+        self.text_small = CachedEmbedding(
+            providers.share_openai(OpenAIEmbedding(model='text-embedding-3-small', api_key='bench', api_base=api_base)),
+            self.embedding_cache
+        )
+        self.document_vector_store = SlowLocalVectorStore(
+            path=os.path.join(seed_dir, 'vectors'), latency_s=profile.vector_s, requests_per_s=profile.vector_rps
+        )
+        self.cohere_rerank = FakeRerank(top_n=3, latency_s=profile.rerank_s, requests_per_s=profile.rerank_rps)
+        self.storage_client = None
+        self.document_bucket = FakeBucket(profile.gcs_s, generate=partial(seeded_object, seed_dir))
+
+
+def create_bench_app(profile: FakeProfile, upstream_url: str, seed_dir: str, env: Dict[str, str]):
+    """
+    Runs in the app process: swaps the clients for fakes before the app module builds them.
+    """
+    # response llms are built per engine and find the fake through the environment
+    os.environ.update({'OPENAI_API_KEY': 'bench', 'OPENAI_API_BASE': f'{upstream_url}/v1',
+                       'OPENAI_BASE_URL': f'{upstream_url}/v1', **env})
+
+    import firebase_admin
+    from firebase_admin import auth, firestore
+
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    auth.verify_id_token = fake_verify_id_token(profile.auth_s)
+    firestore.client = lambda *args, **kwargs: FakeFirestore(profile.firestore_s)
+
+    import app_ctx
+    app_ctx.ApplicationContext = lambda: BenchApplicationContext(profile, upstream_url, seed_dir)
+
+    from chat_impl.auth import CertificateRefresher
+    # signing keys only come from google, verification is faked anyway
+    CertificateRefresher.refresh = lambda self: True
+
+    from main import app
+    return with_rss_route(app)
+
+
+def chat_body(scenario: str, i: int, max_tokens: int) -> Dict[str, Any]:
+    topic, attribute = TOPICS[i % len(TOPICS)]
+    other, other_attribute = TOPICS[(i + 5) % len(TOPICS)]
+    message, mode = {
+        'documents': (f"What do my notes say about the {topic} {attribute}?", 'auto'),
+        'agent': (f"What do my notes say about the {topic} {attribute}?", 'agent'),
+        'sub_questions': (f"Compare the {topic} {attribute} and the {other} {other_attribute}", 'auto'),
+        'small_talk': ("thanks!", 'auto'),
+    }[scenario]
+    return {
+        'model': 'gpt-3.5-turbo',
+        'settings': {'max_token': max_tokens, 'mode': mode},
+        'message': message,
+        'stream': {'compact': True},
+    }
+
+
+async def run_level(client: httpx.AsyncClient, url: str, scenario: str, concurrency: int, requests: int,
+                    args) -> Dict[str, Any]:
+    latencies: List[float] = []
+    first_tokens: List[float] = []
+    counts = {'errors': 0, 'tokens': 0}
+
+    async def request(i: int):
+        uid = f'user{i % args.users}'
+        start = time.perf_counter()
+        first, failed = None, False
+        try:
+            async with client.stream('POST', f'{url}/api/v1/chat', json=chat_body(scenario, i, args.max_tokens),
+                                     headers={'Authorization': f'Bearer {bench_token(uid)}'}) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    failed = True
+                else:
+                    async for line in response.aiter_lines():
+                        if '"response_stream"' in line:
+                            counts['tokens'] += 1
+                            if first is None:
+                                first = time.perf_counter() - start
+                        elif '"agent_error"' in line or '"response_error"' in line:
+                            failed = True
+        except httpx.HTTPError:
+            failed = True
+        if failed:
+            counts['errors'] += 1
+            return
+        latencies.append(time.perf_counter() - start)
+        if first is not None:
+            first_tokens.append(first)
+
+    elapsed_s = await drive(request, concurrency, requests)
+    rss = (await client.get(f'{url}/bench/rss')).json()['peak_rss_mb']
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': counts['errors'],
+        'tokens': counts['tokens'],
+        'elapsed_s': elapsed_s,
+        'throughput_rps': len(latencies) / elapsed_s if elapsed_s else 0.0,
+        'latency': summarize(latencies),
+        'first_token': summarize(first_tokens),
+        'peak_rss_mb': rss,
+    }
+
+
+async def run(url: str, args) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    results = []
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout_s), limits=limits) as client:
+        for scenario in args.scenarios:
+            if args.warmup:
+                await run_level(client, url, scenario, min(args.warmup, max(args.concurrency)), args.warmup, args)
+            for concurrency in args.concurrency:
+                result = await run_level(client, url, scenario, concurrency, args.requests, args)
+                results.append(result)
+                latency, first_token = result['latency'], result['first_token']
+                print(f"{scenario:<13} concurrency={concurrency:<3} "
+                      f"p50={latency['p50_ms'] or 0:.0f}ms p95={latency['p95_ms'] or 0:.0f}ms "
+                      f"p99={latency['p99_ms'] or 0:.0f}ms ttft_p50={first_token['p50_ms'] or 0:.0f}ms "
+                      f"throughput={result['throughput_rps']:.1f}/s errors={result['errors']} "
+                      f"rss={result['peak_rss_mb']:.0f}MB")
+        app_metrics = (await client.get(f'{url}/metrics', params={'format': 'json'})).json()
+    return results, app_metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=['documents', 'agent'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=100, help='per scenario and concurrency')
+    parser.add_argument('--warmup', type=int, default=4)
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--chunks', type=int, default=200, help='seeded chunks per user')
+    parser.add_argument('--max-tokens', type=int, default=256)
+    parser.add_argument('--timeout-s', type=float, default=120)
+    parser.add_argument('--fake', nargs='*', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--compare', type=str, default=None, metavar='BASELINE')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    profile = FakeProfile.parse(args.fake)
+    # repeated benchmark questions would otherwise be answered from the cache
+    env = {'ANSWER_CACHE_ENABLED': 'false', **dict(item.split('=', 1) for item in args.env)}
+
+    with tempfile.TemporaryDirectory() as seed_dir:
+        seed(seed_dir, args.users, args.chunks)
+        with ServerProcess('bench.fake_upstream:create_app', profile) as upstream, \
+                ServerProcess('bench.load:create_bench_app', profile, upstream.url, seed_dir, env) as app:
+            app.wait_ready()
+            print(f"app serving after {app.startup_s:.2f}s, ready after {app.ready_s:.2f}s")
+            results, app_metrics = asyncio.run(run(app.url, args))
+
+    result = report('chat', profile, app.startup_s, results, {**vars(args), 'env': env}, app.ready_s)
+    result['metrics'] = app_metrics
+    if args.output:
+        save(result, args.output)
+    if args.compare:
+        regressions = compare(result, args.compare, args.tolerance)
+        if regressions:
+            print('regressions: ' + ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
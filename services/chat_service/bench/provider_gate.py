@@ -0,0 +1,106 @@
+"""
+Checks that streamed completions give their provider slot back however they end: read to
+the end, cancelled mid-body like a disconnected /chat stream or a deadline, or abandoned
+without the response being closed, which is what llama_index does with the openai stream,
+and then collected. The bodies are read through the gated clients directly, the openai
+SDK closes some of them itself depending on its version. More streams end early than the
+gate has slots, a completion afterwards has to get through. Runs against
+bench.fake_upstream, from the service directory:
+
+    python -m bench.provider_gate --streams 16
+"""
+import argparse
+import asyncio
+import gc
+import time
+
+import httpx
+
+from bench.harness import FakeProfile, ServerProcess
+from providers import ProviderGate, ProviderSettings, providers
+
+COMPLETION = {'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': 'tell me about entropy'}]}
+
+
+async def read_all(client: httpx.AsyncClient, url: str):
+    request = client.build_request('POST', url, json={**COMPLETION, 'stream': True})
+    response = await client.send(request, stream=True)
+    async for _ in response.aiter_lines():
+        pass
+
+
+async def abandon(client: httpx.AsyncClient, url: str, lines: int):
+    request = client.build_request('POST', url, json={**COMPLETION, 'stream': True})
+    response = await client.send(request, stream=True)
+    read = 0
+    async for _ in response.aiter_lines():
+        read += 1
+        if read == lines:
+            break
+
+
+async def released(gate: ProviderGate, timeout_s: float = 2):
+    # the last bodies may still be closing
+    deadline = time.perf_counter() + timeout_s
+    while gate.limit.in_flight and time.perf_counter() < deadline:
+        gc.collect()
+        await asyncio.sleep(0.05)
+
+
+async def check_async(client: httpx.AsyncClient, url: str, gate: ProviderGate, streams: int, lines: int,
+                      timeout_s: float):
+    tasks = [asyncio.create_task(read_all(client, url)) for _ in range(streams)]
+    await asyncio.sleep(0.5)
+    # cancelled while waiting for the next chunk, like a disconnected /chat stream or a deadline
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    del tasks
+    await released(gate)
+    assert gate.limit.in_flight == 0, f'{gate.limit.in_flight} slots still held after cancelled streams'
+    for _ in range(streams):
+        await asyncio.wait_for(abandon(client, url, lines), timeout_s)
+        # the body is closed by the loop once the response is collected
+        gc.collect()
+        await asyncio.sleep(0.05)
+    await released(gate)
+    assert gate.limit.in_flight == 0, f'{gate.limit.in_flight} slots still held after abandoned streams'
+    start = time.perf_counter()
+    await asyncio.wait_for(client.post(url, json=COMPLETION), timeout_s)
+    print(f"async: {streams} cancelled and {streams} abandoned streams released, "
+          f"next completion took {time.perf_counter() - start:.2f}s")
+
+
+def check_sync(client: httpx.Client, url: str, gate: ProviderGate, streams: int, lines: int):
+    for _ in range(streams):
+        response = client.send(client.build_request('POST', url, json={**COMPLETION, 'stream': True}), stream=True)
+        for read, _ in enumerate(response.iter_lines(), 1):
+            if read == lines:
+                break
+        del response
+        gc.collect()
+    assert gate.limit.in_flight == 0, f'{gate.limit.in_flight} slots still held after abandoned streams'
+    client.post(url, json=COMPLETION)
+    print(f"sync: {streams} abandoned streams released")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, default=4, help='slots of the openai gate')
+    parser.add_argument('--lines', type=int, default=3, help='lines read before a stream is dropped')
+    parser.add_argument('--timeout-s', type=float, default=10)
+    args = parser.parse_args()
+
+    profile = FakeProfile(openai_first_token_s=0.05, openai_token_s=0.05, openai_tokens=60)
+    settings = ProviderSettings(rps=0, burst=0, concurrency=args.concurrency, max_concurrency=args.concurrency)
+    gate = providers._gates['openai'] = ProviderGate('openai', settings, max_retries=0)
+    with ServerProcess('bench.fake_upstream:create_app', profile) as upstream:
+        url = f'{upstream.url}/v1/chat/completions'
+        asyncio.run(check_async(providers.async_http('openai', args.timeout_s), url, gate, args.streams,
+                                args.lines, args.timeout_s))
+        check_sync(providers.http('openai', args.timeout_s), url, gate, args.streams, args.lines)
+
+
+if __name__ == '__main__':
+    main()
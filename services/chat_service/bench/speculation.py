@@ -0,0 +1,86 @@
+"""
+Speculative retrieval against a stub agent that plans for a fixed time before it calls
+the document tool with the message, and the real citation engine and AdaptiveRerank in
+front of a fake dense retriever and a blocking remote reranker. Compares the time to the
+tool's nodes with and without speculation, checks that the speculation reports the whole
+retrieval and rerank as saved, and that the tokens of the planning call keep streaming
+meanwhile. Run from the service directory:
+
+    python -m bench.speculation --plan-ms 400 --retrieval-ms 150 --rerank-ms 150
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+from llama_index.schema import QueryBundle
+
+from bench.fakes import FakeRetriever, fake_citation_engine
+from chat_impl.speculation import SpeculativeRetrieval, SpeculationSettings, SpeculationStats
+
+
+class StubEmbedding:
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+
+    async def aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.latency_s)
+        return [float(len(query))]
+
+
+async def run(speculate: bool, args) -> dict:
+    engine = fake_citation_engine(FakeRetriever(args.retrieval_ms / 1000), args.rerank_ms / 1000)
+    stats = SpeculationStats()
+    message = 'what did the onboarding notes say about expenses'
+    start = time.perf_counter()
+    if speculate:
+        engine.speculation = SpeculativeRetrieval(
+            engine=engine,
+            embed_model=StubEmbedding(args.embedding_ms / 1000),
+            message=message,
+            settings=SpeculationSettings(),
+            stats=stats,
+        ).start()
+    # the agent's planning call streams its tokens while the speculation runs
+    last, gap_s = start, 0.0
+    for _ in range(args.plan_tokens):
+        await asyncio.sleep(args.plan_ms / 1000 / args.plan_tokens)
+        now = time.perf_counter()
+        gap_s, last = max(gap_s, now - last), now
+    plan_s = last - start
+    nodes = await engine.aretrieve(QueryBundle(message))
+    elapsed_s = time.perf_counter() - start
+    if speculate:
+        engine.speculation.close()
+    assert nodes, 'nothing retrieved'
+    return {'plan_ms': 1000 * plan_s, 'token_gap_ms': 1000 * gap_s, 'tool_ms': 1000 * elapsed_s, **stats.to_dict()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plan-ms', type=float, default=400)
+    parser.add_argument('--plan-tokens', type=int, default=20)
+    parser.add_argument('--embedding-ms', type=float, default=50)
+    parser.add_argument('--retrieval-ms', type=float, default=150)
+    parser.add_argument('--rerank-ms', type=float, default=150)
+    args = parser.parse_args()
+
+    direct = asyncio.run(run(False, args))
+    speculated = asyncio.run(run(True, args))
+    print(f"direct: tool answered after {direct['tool_ms']:.0f}ms")
+    print(f"speculative: tool answered after {speculated['tool_ms']:.0f}ms, planning took "
+          f"{speculated['plan_ms']:.0f}ms with tokens at most {speculated['token_gap_ms']:.0f}ms apart, "
+          f"saved {speculated['saved_mean_ms']:.0f}ms")
+    assert speculated['hit'] == 1, 'the tool query did not take the speculation'
+    # a rerank blocking the loop would stall the planning stream for its whole latency
+    token_ms = args.plan_ms / args.plan_tokens
+    assert speculated['token_gap_ms'] < token_ms + 30, \
+        f"planning stalled for {speculated['token_gap_ms']:.0f}ms between {token_ms:.0f}ms tokens"
+    retrieval_ms = args.embedding_ms + args.retrieval_ms + args.rerank_ms
+    if args.plan_ms >= retrieval_ms:
+        assert speculated['saved_mean_ms'] > 0.9 * retrieval_ms, \
+            f"saved {speculated['saved_mean_ms']:.0f}ms of a {retrieval_ms:.0f}ms retrieval"
+
+
+if __name__ == '__main__':
+    main()
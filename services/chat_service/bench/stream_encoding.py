@@ -0,0 +1,171 @@
+"""
+Events/s and bytes per response of the /chat stream: the pydantic model per event
+against the precomputed encoder, compact lines, summary verbosity and token coalescing.
+Tokens arrive at a simulated model speed for the coalescing runs. Run from the service
+directory:
+
+    python -m bench.stream_encoding --tokens 400 --token-interval-ms 15
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import List
+
+from llama_index.callbacks import CBEventType
+from llama_index.schema import NodeWithScore, TextNode
+
+from chat_impl.chat_agent import AgentEvent, AgentEventType, TaskEvent
+from chat_impl.streaming import (
+    ChatAgentSources, ChatAgentTask, ChatResponseChunk, ChunkEncoder, TaskFilter, Verbosity, coalesce_tokens
+)
+
+TASK_TYPES = [
+    CBEventType.AGENT_STEP, CBEventType.FUNCTION_CALL, CBEventType.QUERY, CBEventType.RETRIEVE,
+    CBEventType.EMBEDDING, CBEventType.RERANKING, CBEventType.SYNTHESIZE, CBEventType.TEMPLATING,
+    CBEventType.LLM, CBEventType.LLM,
+]
+
+
+def event(event_type: AgentEventType, task=None, chunk: str = '', sources=None) -> AgentEvent:
+    return AgentEvent(type=event_type, task=task, error=None, response_chunk=chunk, sources=sources or [])
+
+
+def synthetic_response(tokens: int, rng: random.Random) -> List[AgentEvent]:
+    events = []
+    parent = 'root'
+    # one nested chain of tasks, like an agent step calling the query engine tool
+    for task_type in TASK_TYPES:
+        event_id = str(uuid.uuid4())
+        events.append(event(AgentEventType.AGENT_EVENT_START, TaskEvent(False, task_type, event_id, parent, 0)))
+        events.append(event(AgentEventType.AGENT_EVENT_STOP, TaskEvent(True, task_type, event_id, parent, 0.12)))
+        parent = event_id if task_type in (CBEventType.AGENT_STEP, CBEventType.FUNCTION_CALL) else parent
+    sources = [
+        NodeWithScore(node=TextNode(text='lorem ipsum dolor sit amet ' * 40,
+                                    metadata={'user': 'bench', 'file_name': f'report_{i}.pdf'}), score=0.8)
+        for i in range(3)
+    ]
+    events.append(event(AgentEventType.RESPONSE_START, sources=sources))
+    words = ['the', 'report', 'shows', 'revenue', 'grew', 'in', 'march', ' [1]', '.', ',']
+    events += [event(AgentEventType.RESPONSE_STREAM, chunk=' ' + rng.choice(words)) for _ in range(tokens)]
+    events.append(event(AgentEventType.RESPONSE_COMPLETE))
+    return events
+
+
+def encode_model(response_id: str, agent_event: AgentEvent) -> str:
+    task = None
+    if agent_event.task:
+        task = ChatAgentTask(
+            completed=agent_event.task.completed,
+            event_type=agent_event.task.event_type,
+            event_id=agent_event.task.event_id,
+            parent_id=agent_event.task.parent_id,
+            duration_s=agent_event.task.duration_s,
+            metrics=agent_event.task.metrics,
+        )
+    return ChatResponseChunk(
+        id=response_id,
+        event_type=agent_event.type,
+        task=task,
+        error=agent_event.error,
+        response_chunk=agent_event.response_chunk,
+        sources=[
+            ChatAgentSources(score=source.score, text=source.text, metadata=source.metadata)
+            for source in agent_event.sources
+            if isinstance(source, NodeWithScore)
+        ]
+    ).json() + '\n'
+
+
+def serialization_rate(events: List[AgentEvent], encode, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for agent_event in events:
+            encode(agent_event)
+    return repeat * len(events) / (time.perf_counter() - start)
+
+
+async def replay(events: List[AgentEvent], interval_s: float):
+    for agent_event in events:
+        if agent_event.type == AgentEventType.RESPONSE_STREAM:
+            await asyncio.sleep(interval_s)
+        yield agent_event
+
+
+async def stream(events: List[AgentEvent], interval_s: float, compact: bool, verbosity: Verbosity,
+                 coalesce_ms: float, coalesce_chars: int):
+    encoder = ChunkEncoder(str(uuid.uuid4()), compact=compact)
+    task_filter = TaskFilter(verbosity)
+    source = replay(events, interval_s)
+    if coalesce_ms > 0:
+        source = coalesce_tokens(source, coalesce_ms / 1000, coalesce_chars)
+    lines, size, text = 0, 0, []
+    async for agent_event in source:
+        agent_event = task_filter(agent_event)
+        if agent_event is None:
+            continue
+        line = encoder.encode(agent_event)
+        lines += 1
+        size += len(line.encode('utf-8'))
+        text.append(json.loads(line).get('response_chunk', ''))
+    return lines, size, ''.join(text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, default=400)
+    parser.add_argument('--token-interval-ms', type=float, default=15)
+    parser.add_argument('--coalesce-ms', type=float, default=50)
+    parser.add_argument('--coalesce-chars', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    events = synthetic_response(args.tokens, random.Random(args.seed))
+    response_id = str(uuid.uuid4())
+    encoder = ChunkEncoder(response_id)
+    compact = ChunkEncoder(response_id, compact=True)
+    rates = {
+        'pydantic': serialization_rate(events, lambda e: encode_model(response_id, e), args.repeat),
+        'encoder': serialization_rate(events, encoder.encode, args.repeat),
+        'encoder_compact': serialization_rate(events, compact.encode, args.repeat),
+    }
+    for name, rate in rates.items():
+        print(f"{name:<16} {rate:>10.0f} events/s")
+
+    legacy = [encode_model(response_id, e) for e in events]
+    variants = {
+        'pydantic': (len(legacy), sum(len(line.encode('utf-8')) for line in legacy)),
+    }
+    expected = ''.join(e.response_chunk for e in events)
+    interval_s = args.token_interval_ms / 1000
+    for name, compact_lines, verbosity, coalesce_ms in [
+        ('encoder', False, Verbosity.FULL, 0),
+        ('compact', True, Verbosity.FULL, 0),
+        ('compact+summary', True, Verbosity.SUMMARY, 0),
+        ('compact+summary+coalesce', True, Verbosity.SUMMARY, args.coalesce_ms),
+    ]:
+        lines, size, text = asyncio.run(
+            stream(events, interval_s, compact_lines, verbosity, coalesce_ms, args.coalesce_chars)
+        )
+        assert text == expected, f"{name} changed the response text"
+        variants[name] = (lines, size)
+
+    results = {
+        'events': len(events),
+        'events_per_s': rates,
+        'responses': {name: {'lines': lines, 'bytes': size} for name, (lines, size) in variants.items()},
+    }
+    for name, (lines, size) in variants.items():
+        print(f"{name:<26} lines={lines:<5} bytes={size}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Fan out of the sub-question engine against stub llm, embedding, dense retrieval and remote
+reranker with fixed latencies, so it runs offline: wall time of sequential vs concurrent
+retrieval, and the sub-questions and sources shared between parts. Retrieval goes through
+the engine's real citation engine and AdaptiveRerank, the blocking remote reranker must
+not serialize the parts. Run from the service directory:
+
+    python -m bench.sub_questions --questions 4 --retrieval-ms 150 --rerank-ms 150 --concurrency 1 2 4
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+from types import SimpleNamespace
+from typing import List
+
+from llama_index.core.llms.types import ChatMessage, MessageRole
+
+from bench.fakes import FakeRetriever, fake_citation_engine
+from chat_impl.sub_questions import SubQuestionEngine, SubQuestionSettings, SubQuestionStats
+
+
+class StubLLM:
+    def __init__(self, questions: List[str], latency_s: float):
+        self.questions = questions
+        self.latency_s = latency_s
+
+    async def achat(self, messages: List[ChatMessage], **kwargs):
+        await asyncio.sleep(self.latency_s)
+        return SimpleNamespace(message=ChatMessage(role=MessageRole.ASSISTANT, content=json.dumps(self.questions)))
+
+    async def astream_chat(self, messages: List[ChatMessage], **kwargs):
+        async def stream():
+            for word in 'the answer cites [1] and [2] .'.split():
+                yield SimpleNamespace(delta=' ' + word)
+        return stream()
+
+
+class StubEmbedding:
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+
+    async def aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.latency_s)
+        return [float(len(query))]
+
+
+async def run(questions: List[str], concurrency: int, args) -> dict:
+    retriever = FakeRetriever(args.retrieval_ms / 1000)
+    stats = SubQuestionStats()
+    engine = SubQuestionEngine(
+        citation_engine=fake_citation_engine(retriever, args.rerank_ms / 1000),
+        llm=StubLLM(questions, args.llm_ms / 1000),
+        embed_model=StubEmbedding(args.embedding_ms / 1000),
+        settings=SubQuestionSettings(max_questions=len(questions), concurrency=concurrency),
+        stats=stats,
+    )
+    start = time.perf_counter()
+    sources, tokens = await engine.answer([], 'compare all of these', parent_id='root')
+    answer = ''.join([token async for token in tokens])
+    elapsed_s = time.perf_counter() - start
+    assert answer, 'no answer streamed'
+    return {
+        'concurrency': concurrency,
+        'elapsed_ms': 1000 * elapsed_s,
+        'fan_out_ms': 1000 * stats.fan_out_s,
+        'retrievals': retriever.calls,
+        'sources': len(sources),
+        **stats.to_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=4)
+    parser.add_argument('--retrieval-ms', type=float, default=150)
+    parser.add_argument('--rerank-ms', type=float, default=150)
+    parser.add_argument('--embedding-ms', type=float, default=50)
+    parser.add_argument('--llm-ms', type=float, default=400)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    questions = [f'part {i}' for i in range(args.questions)]
+    # the decomposition repeats the first part, it should only be retrieved once
+    questions.append('Part 0?')
+    part_ms = args.embedding_ms + args.retrieval_ms + args.rerank_ms
+    results = []
+    for concurrency in args.concurrency:
+        result = asyncio.run(run(questions, concurrency, args))
+        assert result['retrievals'] == args.questions, 'duplicate sub-question was retrieved again'
+        # the parts only wait for the semaphore, a rerank blocking the loop makes them queue
+        expected_ms = math.ceil(args.questions / concurrency) * part_ms
+        assert result['fan_out_ms'] < 1.25 * expected_ms, \
+            f"fan out took {result['fan_out_ms']:.0f}ms, {expected_ms:.0f}ms expected at concurrency {concurrency}"
+        results.append(result)
+        print(f"concurrency={concurrency:<2} elapsed={result['elapsed_ms']:.0f}ms fan_out={result['fan_out_ms']:.0f}ms "
+              f"retrievals={result['retrievals']} duplicates={result['duplicates']} "
+              f"shared_nodes={result['shared_nodes']} sources={result['sources']} "
+              f"speedup={result['parallel_speedup']:.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
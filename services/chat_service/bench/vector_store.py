@@ -0,0 +1,105 @@
+"""
+Query throughput of the local vector store: single user top-k with the same user filter
+the chat service applies, heap vs memory-mapped partitions, across partition sizes and
+threads. Run from the service directory:
+
+    python -m bench.vector_store --users 20 --vectors-per-user 1000 5000 20000 --threads 1 4
+"""
+import argparse
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import ExactMatchFilter, MetadataFilters, VectorStoreQuery
+
+from local_vector_store import LocalVectorStore
+
+
+def build_store(path, users: int, vectors_per_user: int, dim: int, rng):
+    store = LocalVectorStore(path=path)
+    start = time.perf_counter()
+    for user in range(users):
+        vectors = rng.normal(size=(vectors_per_user, dim)).astype(np.float32)
+        for i in range(0, vectors_per_user, 100):
+            store.add([
+                TextNode(text=f'chunk {user}-{j}', metadata={'user': f'user-{user}'}, embedding=vectors[j].tolist())
+                for j in range(i, min(i + 100, vectors_per_user))
+            ])
+    return store, time.perf_counter() - start
+
+
+def run_queries(store: LocalVectorStore, users: int, queries: int, dim: int, top_k: int, threads: int, rng):
+    requests = [
+        VectorStoreQuery(
+            query_embedding=rng.normal(size=dim).astype(np.float32).tolist(),
+            similarity_top_k=top_k,
+            filters=MetadataFilters(filters=[ExactMatchFilter(key='user', value=f'user-{rng.integers(users)}')]),
+        )
+        for _ in range(queries)
+    ]
+    latencies = []
+
+    def query(request):
+        start = time.perf_counter()
+        store.query(request)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(query, requests))
+    total_s = time.perf_counter() - start
+    return {
+        'queries_per_s': queries / total_s,
+        'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--vectors-per-user', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for vectors_per_user in args.vectors_per_user:
+        for storage in ('memory', 'mmap'):
+            with tempfile.TemporaryDirectory() as tmp:
+                store, build_s = build_store(
+                    tmp if storage == 'mmap' else None, args.users, vectors_per_user, args.dim, rng
+                )
+                if storage == 'mmap':
+                    # reopen so queries go through the page cache like a second process would
+                    store = LocalVectorStore(path=tmp)
+                # load every partition before timing
+                run_queries(store, args.users, args.users * 4, args.dim, args.top_k, 1, rng)
+                for threads in args.threads:
+                    result = {
+                        'storage': storage,
+                        'vectors_per_user': vectors_per_user,
+                        'threads': threads,
+                        'add_vectors_per_s': args.users * vectors_per_user / build_s,
+                        **run_queries(store, args.users, args.queries, args.dim, args.top_k, threads, rng),
+                    }
+                    results.append(result)
+                    print(f"{storage:<6} vectors/user={vectors_per_user:<6} threads={threads:<2} "
+                          f"qps={result['queries_per_s']:.0f} p50={result['p50_ms']:.2f}ms "
+                          f"p99={result['p99_ms']:.2f}ms add/s={result['add_vectors_per_s']:.0f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
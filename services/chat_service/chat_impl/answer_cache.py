@@ -0,0 +1,240 @@
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional, AsyncIterator, Dict, Any
+
+import numpy as np
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.schema import NodeWithScore
+
+from chat_impl.chat_agent import AgentEvent, AgentEventType
+from local_vector_store import normalize
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    embedding: List[float]
+    answer: str
+    sources: List[NodeWithScore]
+    created_at: float = field(default_factory=time.time)
+    # the embedding scaled to unit length, as float32
+    unit: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        if self.unit is None:
+            self.unit = unit_vector(self.embedding)
+
+
+def unit_vector(embedding: List[float]) -> np.ndarray:
+    return normalize(np.asarray(embedding, dtype=np.float32))
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    return float(unit_vector(a) @ unit_vector(b))
+
+
+class AnswerCacheBackend(ABC):
+    @abstractmethod
+    def lookup(self, uid: str, embedding: List[float], threshold: float) -> Optional[CachedAnswer]:
+        pass
+
+    @abstractmethod
+    def store(self, uid: str, answer: CachedAnswer):
+        pass
+
+    @abstractmethod
+    def invalidate(self, uid: str):
+        pass
+
+
+class InMemoryAnswerCacheBackend(AnswerCacheBackend):
+    def __init__(self, ttl_s: float = 3600, max_entries_per_user: int = 64, max_users: int = 1024):
+        self.ttl_s = ttl_s
+        self.max_entries_per_user = max_entries_per_user
+        self.max_users = max_users
+        # invalidation arrives from the firestore listener thread
+        self._lock = threading.Lock()
+        self._users: OrderedDict[str, OrderedDict[int, CachedAnswer]] = OrderedDict()
+        self._next_id = 0
+
+    def lookup(self, uid: str, embedding: List[float], threshold: float) -> Optional[CachedAnswer]:
+        query = unit_vector(embedding)
+        now = time.time()
+        with self._lock:
+            entries = self._users.get(uid)
+            if not entries:
+                return None
+            self._users.move_to_end(uid)
+
+            for entry_id, entry in list(entries.items()):
+                if now - entry.created_at > self.ttl_s:
+                    del entries[entry_id]
+            if not entries:
+                return None
+            ids = list(entries)
+            scores = np.stack([entries[entry_id].unit for entry_id in ids]) @ query
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            entries.move_to_end(ids[best])
+            return entries[ids[best]]
+
+    def store(self, uid: str, answer: CachedAnswer):
+        with self._lock:
+            entries = self._users.setdefault(uid, OrderedDict())
+            self._users.move_to_end(uid)
+            entries[self._next_id] = answer
+            self._next_id += 1
+            while len(entries) > self.max_entries_per_user:
+                entries.popitem(last=False)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def invalidate(self, uid: str):
+        with self._lock:
+            self._users.pop(uid, None)
+
+
+@dataclass
+class AnswerCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    invalidations: int = 0
+
+
+class SemanticAnswerCache:
+    def __init__(self, backend: AnswerCacheBackend, embed_model: BaseEmbedding, threshold: float = 0.95):
+        self.backend = backend
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.stats = AnswerCacheStats()
+        # bumped by every invalidation, an answer generated across one is not stored
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def generation(self, uid: str) -> int:
+        with self._lock:
+            return self._generations.get(uid, 0)
+
+    async def embed(self, message: str) -> List[float]:
+        return await self.embed_model.aget_query_embedding(message)
+
+    def lookup(self, uid: str, embedding: List[float]) -> Optional[CachedAnswer]:
+        cached = self.backend.lookup(uid, embedding, self.threshold)
+        if cached:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+        return cached
+
+    def store(self, uid: str, message: str, embedding: List[float], answer: str, sources: List[NodeWithScore],
+              generation: Optional[int] = None):
+        if generation is not None and generation != self.generation(uid):
+            # the user's documents changed while the answer was generated
+            return
+        self.backend.store(uid, CachedAnswer(
+            query=message,
+            embedding=embedding,
+            answer=answer,
+            sources=sources,
+        ))
+        self.stats.stores += 1
+
+    def invalidate(self, uid: str):
+        logging.info(f"invalidating answer cache uid: {uid}")
+        with self._lock:
+            self._generations[uid] = self._generations.get(uid, 0) + 1
+        self.backend.invalidate(uid)
+        self.stats.invalidations += 1
+
+    async def replay(self, cached: CachedAnswer) -> AsyncIterator[AgentEvent]:
+        yield AgentEvent(
+            type=AgentEventType.RESPONSE_CACHE_HIT,
+            task=None,
+            error=None,
+            response_chunk='',
+            sources=[]
+        )
+        yield AgentEvent(
+            type=AgentEventType.RESPONSE_START,
+            task=None,
+            error=None,
+            response_chunk='',
+            sources=cached.sources
+        )
+        yield AgentEvent(
+            type=AgentEventType.RESPONSE_STREAM,
+            task=None,
+            error=None,
+            response_chunk=cached.answer,
+            sources=[]
+        )
+        yield AgentEvent(
+            type=AgentEventType.RESPONSE_COMPLETE,
+            task=None,
+            error=None,
+            response_chunk='',
+            sources=[]
+        )
+
+    async def record(self, uid: str, message: str, embedding: List[float],
+                     events: AsyncIterator[AgentEvent], generation: Optional[int] = None) -> AsyncIterator[AgentEvent]:
+        """
+        Passes the events through and stores the completed answer, unless the user's cache
+        was invalidated after `generation`, taken before the lookup that missed.
+        """
+        answer, sources = [], []
+        async for event in events:
+            if event.type == AgentEventType.RESPONSE_START:
+                sources = event.sources
+            elif event.type == AgentEventType.RESPONSE_STREAM:
+                answer.append(event.response_chunk)
+            elif event.type == AgentEventType.RESPONSE_COMPLETE:
+                self.store(uid, message, embedding, ''.join(answer), sources, generation)
+            yield event
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.stats.hits + self.stats.misses
+        return {
+            'hits': self.stats.hits,
+            'misses': self.stats.misses,
+            'hit_rate': self.stats.hits / total if total else 0.0,
+            'stores': self.stats.stores,
+            'invalidations': self.stats.invalidations,
+        }
+
+
+class IndexUpdateListener:
+    """
+    Watches the `index_state` collection the ingest service bumps after writing documents
+    for a user and drops whatever the given caches hold for that user.
+    """
+
+    def __init__(self, db_client, *caches, collection: str = 'index_state'):
+        self.db_client = db_client
+        self.caches = caches
+        self.collection = collection
+        self._watch = None
+        self._initial = True
+
+    def start(self):
+        self._watch = self.db_client.collection(self.collection).on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        if self._watch:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        if self._initial:
+            # the first snapshot replays every existing document
+            self._initial = False
+            return
+        for change in changes:
+            for cache in self.caches:
+                cache.invalidate(change.document.id)
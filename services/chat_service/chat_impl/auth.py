@@ -1,18 +1,210 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
 import firebase_admin
 from fastapi import Request, HTTPException
 from firebase_admin import auth
 
+from metrics import metrics
+
 firebase_admin.initialize_app()
 
+# where firebase id token signing keys are published
+ID_TOKEN_CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
 
-async def get_current_user(request: Request):
-    authorization: str = request.headers.get('Authorization')
+
+@dataclass
+class TokenCacheStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    verifications: int = 0
+    failures: int = 0
+    malformed: int = 0
+    expirations: int = 0
+    evictions: int = 0
+    verify_s: float = 0.0
+
+
+class VerifiedTokenCache:
+    """
+    Remembers decoded id tokens by sha256 of the token until their `exp` claim, so only the
+    first request with a token pays for verification. Only touched from the event loop.
+    """
+
+    def __init__(self, max_entries: int = 10000, clock_skew_s: float = 30):
+        self.max_entries = max_entries
+        self.clock_skew_s = clock_skew_s
+        self.stats = TokenCacheStats()
+        self._tokens: OrderedDict[str, Tuple[Dict[str, Any], float]] = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._tokens.get(key)
+        if entry is None:
+            return None
+        decoded, expires_at = entry
+        if time.time() >= expires_at:
+            del self._tokens[key]
+            self.stats.expirations += 1
+            return None
+        self._tokens.move_to_end(key)
+        return decoded
+
+    def put(self, key: str, decoded: Dict[str, Any]):
+        expires_at = float(decoded.get('exp', 0)) - self.clock_skew_s
+        if expires_at <= time.time():
+            return
+        self._tokens[key] = (decoded, expires_at)
+        self._tokens.move_to_end(key)
+        while len(self._tokens) > self.max_entries:
+            self._tokens.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        key = self.key(token)
+        decoded = self.get(key)
+        if decoded is not None:
+            self.stats.hits += 1
+            return decoded
+
+        # a client opening several streams at once sends the same token concurrently
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # only the request that started the verification was cancelled, not this one
+                if not inflight.cancelled():
+                    raise
+            return await self.verify(token)
+
+        self.stats.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        start = time.perf_counter()
+        try:
+            # verification may fetch google's public keys, keep it off the event loop
+            decoded = await asyncio.to_thread(auth.verify_id_token, token)
+            self.put(key, decoded)
+            future.set_result(decoded)
+            return decoded
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            self.stats.failures += 1
+            future.set_exception(err)
+            # marks the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self.stats.verifications += 1
+            self.stats.verify_s += time.perf_counter() - start
+            del self._inflight[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats.hits + self.stats.misses + self.stats.coalesced
+        return {
+            'size': len(self._tokens),
+            'max_entries': self.max_entries,
+            'hits': self.stats.hits,
+            'misses': self.stats.misses,
+            'coalesced': self.stats.coalesced,
+            'hit_rate': (self.stats.hits + self.stats.coalesced) / lookups if lookups else 0.0,
+            'verifications': self.stats.verifications,
+            'failures': self.stats.failures,
+            'malformed': self.stats.malformed,
+            'expirations': self.stats.expirations,
+            'evictions': self.stats.evictions,
+            'verify_mean_ms': 1000 * self.stats.verify_s / self.stats.verifications
+            if self.stats.verifications else 0.0,
+        }
+
+
+class CertificateRefresher:
+    """
+    Periodically requests the token signing keys through firebase's own certificate
+    session. That session caches by Cache-Control, so this is a cache hit until the keys
+    go stale and then refreshes them here instead of inside a user's request.
+    """
+
+    def __init__(self, interval_s: float = 300):
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _certificate_request():
+        # not public api, refreshing is only an optimization so any change just disables it
+        return auth._get_client(None)._token_verifier.request
+
+    def refresh(self) -> bool:
+        try:
+            response = self._certificate_request()(ID_TOKEN_CERT_URL, method='GET')
+            return response.status == 200
+        except Exception as err:
+            logging.warning(f"failed to refresh id token certificates: {err!r}")
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval_s)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cert-refresher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+token_cache = VerifiedTokenCache(max_entries=int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '10000')))
+certificate_refresher = CertificateRefresher(interval_s=float(os.getenv('AUTH_CERT_REFRESH_S', '300')))
+
+
+def parse_bearer_token(authorization: Optional[str]) -> str:
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header missing")
+    scheme, _, token = authorization.strip().partition(' ')
+    token = token.strip()
+    # id tokens are JWTs, three base64url segments
+    if scheme.lower() != 'bearer' or not token or token.count('.') != 2 or ' ' in token:
+        token_cache.stats.malformed += 1
+        raise HTTPException(status_code=401, detail="Malformed authorization header",
+                            headers={'WWW-Authenticate': 'Bearer'})
+    return token
+
+
+AUTH_SECONDS = metrics.histogram('chat_auth_seconds', 'Time to authenticate a request', labels=('result',))
 
-    token = authorization.split(" ")[1]
+
+async def get_current_user(request: Request):
+    start = time.perf_counter()
+    try:
+        token = parse_bearer_token(request.headers.get('Authorization'))
+    except HTTPException:
+        AUTH_SECONDS.labels('malformed').observe(time.perf_counter() - start)
+        raise
     try:
-        decoded_token = auth.verify_id_token(token)
-        return decoded_token
-    except Exception as e:
+        user = await token_cache.verify(token)
+    except Exception:
+        AUTH_SECONDS.labels('rejected').observe(time.perf_counter() - start)
         raise HTTPException(status_code=403, detail="Invalid authentication token")
+    AUTH_SECONDS.labels('ok').observe(time.perf_counter() - start)
+    return user
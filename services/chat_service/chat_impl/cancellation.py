@@ -0,0 +1,136 @@
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional, Set, Dict, Any
+
+# tasks spawned while serving a request, inherited by every task created from it
+_request_tasks: ContextVar[Optional[Set[asyncio.Task]]] = ContextVar('request_tasks', default=None)
+
+
+def _tracking_task_factory(previous):
+    def factory(loop, coro, **kwargs):
+        if previous is not None:
+            task = previous(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        tasks = _request_tasks.get()
+        if tasks is not None:
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        return task
+
+    factory.tracks_request_tasks = True
+    return factory
+
+
+def install_task_tracking(loop: asyncio.AbstractEventLoop):
+    """
+    Wraps the task factory of the loop so tasks started on behalf of a request can be found
+    again. The agent writes the llm stream to history from a task it never hands out, which
+    would otherwise outlive the request.
+    """
+    previous = loop.get_task_factory()
+    if getattr(previous, 'tracks_request_tasks', False):
+        return
+    loop.set_task_factory(_tracking_task_factory(previous))
+
+
+@contextmanager
+def track_tasks():
+    install_task_tracking(asyncio.get_running_loop())
+    tasks: Set[asyncio.Task] = set()
+    token = _request_tasks.set(tasks)
+    try:
+        yield tasks
+    finally:
+        _request_tasks.reset(token)
+
+
+def cancel_tasks(tasks: Set[asyncio.Task]) -> int:
+    pending = [task for task in tasks if not task.done()]
+    for task in pending:
+        task.cancel()
+    return len(pending)
+
+
+@dataclass
+class ChatLimits:
+    # events buffered between the agent and the response stream
+    queue_size: int = 256
+    # wall time for a whole response, the client can only ask for less
+    deadline_s: float = 120
+
+    @classmethod
+    def from_env(cls) -> 'ChatLimits':
+        return cls(
+            queue_size=int(os.getenv('CHAT_EVENT_QUEUE_SIZE', '256')),
+            deadline_s=float(os.getenv('CHAT_DEADLINE_S', '120')),
+        )
+
+    def deadline_for(self, requested_s: Optional[float]) -> float:
+        if requested_s is None or requested_s <= 0:
+            return self.deadline_s
+        return min(requested_s, self.deadline_s)
+
+
+class ChatStreamStats:
+    """
+    Outcomes of chat streams. The work saved by a cancellation is an upper bound: the
+    max_tokens of the response less the tokens it streamed, and the time left until its
+    deadline.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.deadline_exceeded = 0
+        self.cancelled_tasks = 0
+        self.dropped_events = 0
+        self.tokens_streamed_before_cancel = 0
+        self.tokens_saved = 0
+        self.seconds_saved = 0.0
+
+    def record(self, outcome: str, tokens: int, max_tokens: int, cancelled_tasks: int,
+               dropped_events: int, remaining_s: float):
+        with self._lock:
+            self.dropped_events += dropped_events
+            if outcome == 'completed':
+                self.completed += 1
+            elif outcome == 'failed':
+                self.failed += 1
+            else:
+                if outcome == 'deadline':
+                    self.deadline_exceeded += 1
+                else:
+                    self.cancelled += 1
+                if cancelled_tasks:
+                    self.cancelled_tasks += cancelled_tasks
+                    self.tokens_streamed_before_cancel += tokens
+                    self.tokens_saved += max(0, max_tokens - tokens)
+                    self.seconds_saved += max(0.0, remaining_s)
+
+    def start(self):
+        with self._lock:
+            self.started += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'started': self.started,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'deadline_exceeded': self.deadline_exceeded,
+                'in_flight': self.started - self.completed - self.failed - self.cancelled - self.deadline_exceeded,
+                'cancelled_tasks': self.cancelled_tasks,
+                'dropped_events': self.dropped_events,
+                'tokens_streamed_before_cancel': self.tokens_streamed_before_cancel,
+                'tokens_saved': self.tokens_saved,
+                'seconds_saved': self.seconds_saved,
+            }
@@ -1,7 +1,7 @@
 import logging
 import time
 from dataclasses import dataclass
-from asyncio import Queue
+from asyncio import Queue, QueueFull
 from enum import Enum
 from typing import Optional, Dict, Any, List
 
@@ -9,6 +9,13 @@ from llama_index import BaseCallbackHandler
 from llama_index.callbacks import CBEventType
 from llama_index.schema import NodeWithScore
 
+from metrics import metrics, RequestTrace
+
+STAGE_SECONDS = metrics.histogram(
+    'chat_stage_seconds', 'Duration of agent callback events: retrieve, reranking, llm, embedding, ...',
+    labels=('stage',)
+)
+
 
 class AgentEventType(str, Enum):
     AGENT_START = 'agent_start'
@@ -18,6 +25,7 @@ class AgentEventType(str, Enum):
     AGENT_EVENT_START = 'agent_event_start'
     AGENT_EVENT_STOP = 'agent_event_stop'
 
+    RESPONSE_CACHE_HIT = 'response_cache_hit'
     RESPONSE_START = 'response_start'
     RESPONSE_STREAM = 'response_stream'
     RESPONSE_COMPLETE = 'response_complete'
@@ -31,6 +39,7 @@ class TaskEvent:
     event_id: str
     parent_id: str
     duration_s: float
+    metrics: Optional[Dict[str, Any]] = None
 
 
 @dataclass
@@ -43,13 +52,33 @@ class AgentEvent:
 
 
 class RealTimeAgentEvents(BaseCallbackHandler):
-    def __init__(self, event_queue: Queue, allowed_events=None):
+    def __init__(self, event_queue: Queue, allowed_events=None, trace: Optional[RequestTrace] = None):
         if not allowed_events:
             allowed_events = [CBEventType.QUERY, CBEventType.SUB_QUESTION, CBEventType.FUNCTION_CALL]
         allowed = self.get_allowed_events(allowed_events)
         super().__init__([], [])
         self.event_queue = event_queue
+        self.trace = trace
         self.event_start_time = {}
+        # rerank strategies used so far in this request
+        self.rerank_counts = {'skipped': 0, 'remote': 0, 'local': 0}
+        self.dropped_events = 0
+        self._dropped_ids = set()
+
+    def _put(self, event: 'AgentEvent'):
+        # callbacks are synchronous, so a full queue drops progress events instead of blocking
+        # the loop. The stop of a dropped start is dropped as well to keep the tree consistent.
+        task_id = event.task.event_id
+        if task_id in self._dropped_ids:
+            self._dropped_ids.discard(task_id)
+            self.dropped_events += 1
+            return
+        try:
+            self.event_queue.put_nowait(event)
+        except QueueFull:
+            self.dropped_events += 1
+            if not event.task.completed:
+                self._dropped_ids.add(task_id)
 
     @staticmethod
     def get_allowed_events(allowed: list[CBEventType] = None):
@@ -65,7 +94,7 @@ class RealTimeAgentEvents(BaseCallbackHandler):
                        payload: Optional[Dict[str, Any]] = None,
                        event_id: str = "",
                        parent_id: str = "", **kwargs: Any) -> str:
-        self.event_start_time[event_id] = (time.time(), parent_id)
+        self.event_start_time[event_id] = (time.perf_counter(), parent_id)
         agent_task = TaskEvent(
             completed=False,
             event_type=event_type,
@@ -73,7 +102,7 @@ class RealTimeAgentEvents(BaseCallbackHandler):
             parent_id=parent_id,
             duration_s=0
         )
-        self.event_queue.put_nowait(AgentEvent(
+        self._put(AgentEvent(
             type=AgentEventType.AGENT_EVENT_START,
             task=agent_task,
             error=None,
@@ -86,15 +115,32 @@ class RealTimeAgentEvents(BaseCallbackHandler):
                      payload: Optional[Dict[str, Any]] = None,
                      event_id: str = "",
                      **kwargs: Any) -> None:
-        start_time, parent_id = self.event_start_time[event_id]
+        start_time, parent_id = self.event_start_time.pop(event_id)
+        duration_s = time.perf_counter() - start_time
+        task_metrics = None
+        if payload and 'rerank' in payload:
+            rerank = payload['rerank']
+            self.rerank_counts[rerank['strategy']] += 1
+            task_metrics = {**rerank, 'counts': dict(self.rerank_counts)}
+        elif payload and 'route' in payload:
+            task_metrics = payload['route']
+        elif payload and 'sub_question' in payload:
+            task_metrics = payload['sub_question']
+        elif payload and 'speculation' in payload:
+            task_metrics = payload['speculation']
         agent_task = TaskEvent(
             completed=True,
             event_type=event_type,
             event_id=event_id,
             parent_id=parent_id,
-            duration_s=time.time() - start_time
+            duration_s=duration_s,
+            metrics=task_metrics,
         )
-        self.event_queue.put_nowait(AgentEvent(
+        STAGE_SECONDS.labels(event_type.value).observe(duration_s)
+        if self.trace is not None:
+            self.trace.span(event_type.value, start_time, duration_s, event_id=event_id, parent_id=parent_id,
+                            **({'metrics': task_metrics} if task_metrics else {}))
+        self._put(AgentEvent(
             type=AgentEventType.AGENT_EVENT_STOP,
             task=agent_task,
             error=None,
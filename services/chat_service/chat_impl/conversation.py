@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict, Any, AsyncIterator, Tuple, Callable, Set
+
+from llama_index.core.llms.types import ChatMessage, MessageRole
+from llama_index.llms import LLM
+from llama_index.utils import get_tokenizer
+
+from chat_impl.chat_agent import AgentEvent, AgentEventType
+from metrics import metrics
+
+HISTORY_TOKENS = metrics.counter('chat_history_tokens_total', 'Conversation tokens held and sent with messages',
+                                 labels=('kind',))
+
+# role and separators the chat format adds to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """\
+Update the summary of a conversation between a user and an assistant with the new messages \
+below. Keep names, numbers, facts about the user's documents, decisions and open questions \
+the assistant may need later, drop pleasantries. Answer with the summary only.
+
+Summary so far:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:"""
+
+
+class ConversationOutOfSync(Exception):
+    pass
+
+
+@dataclass
+class ConversationTurn:
+    role: str
+    content: str
+    tokens: int
+
+
+@dataclass
+class Conversation:
+    uid: str
+    conversation_id: str
+    turns: List[ConversationTurn] = field(default_factory=list)
+    # turns[:summarized] are folded into the summary
+    summary: str = ''
+    summary_tokens: int = 0
+    summarized: int = 0
+    # bumped whenever the client replaces the turns, pending compactions of an older revision are dropped
+    revision: int = 0
+    updated_at: float = field(default_factory=time.time)
+
+
+class ConversationBackend(ABC):
+    @abstractmethod
+    def get(self, uid: str, conversation_id: str) -> Optional[Conversation]:
+        pass
+
+    @abstractmethod
+    def save(self, conversation: Conversation):
+        pass
+
+    @abstractmethod
+    def delete(self, uid: str, conversation_id: str):
+        pass
+
+    @abstractmethod
+    def size(self) -> int:
+        pass
+
+
+class InMemoryConversationBackend(ConversationBackend):
+    def __init__(self, ttl_s: float = 86400, max_conversations: int = 10000):
+        self.ttl_s = ttl_s
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._conversations: OrderedDict[Tuple[str, str], Conversation] = OrderedDict()
+
+    def get(self, uid: str, conversation_id: str) -> Optional[Conversation]:
+        key = (uid, conversation_id)
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return None
+            if time.time() - conversation.updated_at > self.ttl_s:
+                del self._conversations[key]
+                return None
+            self._conversations.move_to_end(key)
+            return conversation
+
+    def save(self, conversation: Conversation):
+        key = (conversation.uid, conversation.conversation_id)
+        conversation.updated_at = time.time()
+        with self._lock:
+            self._conversations[key] = conversation
+            self._conversations.move_to_end(key)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def delete(self, uid: str, conversation_id: str):
+        with self._lock:
+            self._conversations.pop((uid, conversation_id), None)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._conversations)
+
+
+@dataclass
+class CompactionSettings:
+    # summarize folds older turns into a running summary, truncate drops them
+    mode: str = 'summarize'
+    # history tokens sent along with a message, summary included
+    token_budget: int = 2000
+    summary_max_tokens: int = 300
+
+    @classmethod
+    def from_env(cls) -> 'CompactionSettings':
+        mode = os.getenv('CONVERSATION_COMPACTION', 'summarize')
+        if mode not in ('summarize', 'truncate'):
+            raise ValueError(f"Unknown conversation compaction {mode}, expected summarize or truncate")
+        return cls(
+            mode=mode,
+            token_budget=int(os.getenv('CONVERSATION_TOKEN_BUDGET', '2000')),
+            summary_max_tokens=int(os.getenv('CONVERSATION_SUMMARY_TOKENS', '300')),
+        )
+
+
+@dataclass
+class ConversationStats:
+    opened: int = 0
+    created: int = 0
+    resynced: int = 0
+    out_of_sync: int = 0
+    summaries: int = 0
+    summary_failures: int = 0
+    folded_turns: int = 0
+    history_tokens: int = 0
+    history_tokens_sent: int = 0
+
+
+class ConversationStore:
+    """
+    Server side chat history. The history sent with a message is the running summary
+    followed by the newest turns that fit the token budget. Turns falling out of the budget
+    are summarized after the response, so a request never waits on a summary: turns that
+    are not folded in yet are left out until they are.
+    """
+
+    def __init__(self, backend: ConversationBackend, settings: Optional[CompactionSettings] = None,
+                 llm: Optional[LLM] = None, tokenizer: Optional[Callable[[str], List]] = None):
+        self.backend = backend
+        self.settings = settings or CompactionSettings()
+        self.llm = llm
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.stats = ConversationStats()
+        self._compactions: Set[asyncio.Task] = set()
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text)) + MESSAGE_OVERHEAD_TOKENS
+
+    def open(self, uid: str, conversation_id: str, history: List[Tuple[str, str]],
+             history_length: Optional[int]) -> Conversation:
+        """
+        Resolves the conversation of a request. A non-empty `history` replaces the stored
+        turns. Without one, `history_length` must match what is stored, which catches
+        restarts, other instances and turns the server never saw.
+        """
+        self.stats.opened += 1
+        conversation = self.backend.get(uid, conversation_id)
+        if history:
+            revision = conversation.revision + 1 if conversation else 0
+            conversation = Conversation(
+                uid=uid,
+                conversation_id=conversation_id,
+                turns=[ConversationTurn(role, content, self.count_tokens(content)) for role, content in history],
+                revision=revision,
+            )
+            self.backend.save(conversation)
+            self.stats.resynced += 1
+            return conversation
+        if conversation is None:
+            if history_length:
+                self.stats.out_of_sync += 1
+                raise ConversationOutOfSync(conversation_id)
+            conversation = Conversation(uid=uid, conversation_id=conversation_id)
+            self.backend.save(conversation)
+            self.stats.created += 1
+            return conversation
+        if history_length is not None and history_length != len(conversation.turns):
+            self.stats.out_of_sync += 1
+            raise ConversationOutOfSync(conversation_id)
+        return conversation
+
+    def _window(self, conversation: Conversation) -> int:
+        # index of the oldest turn sent verbatim
+        budget = self.settings.token_budget
+        if conversation.summary:
+            budget -= conversation.summary_tokens
+        start, used = len(conversation.turns), 0
+        while start > conversation.summarized:
+            tokens = conversation.turns[start - 1].tokens
+            if used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+        return start
+
+    def history(self, conversation: Conversation) -> List[ChatMessage]:
+        start = self._window(conversation)
+        messages = []
+        sent = 0
+        if conversation.summary:
+            messages.append(ChatMessage(
+                role=MessageRole.SYSTEM,
+                content=f'Summary of the earlier conversation:\n{conversation.summary}'
+            ))
+            sent += conversation.summary_tokens
+        for turn in conversation.turns[start:]:
+            messages.append(ChatMessage(role=turn.role, content=turn.content))
+            sent += turn.tokens
+        held = sum(turn.tokens for turn in conversation.turns)
+        self.stats.history_tokens += held
+        self.stats.history_tokens_sent += sent
+        HISTORY_TOKENS.labels('held').inc(held)
+        HISTORY_TOKENS.labels('sent').inc(sent)
+        return messages
+
+    async def record(self, conversation: Conversation, message: str,
+                     events: AsyncIterator[AgentEvent]) -> AsyncIterator[AgentEvent]:
+        uid, conversation_id, revision = conversation.uid, conversation.conversation_id, conversation.revision
+        answer = []
+        async for event in events:
+            if event.type == AgentEventType.RESPONSE_STREAM:
+                answer.append(event.response_chunk)
+            elif event.type == AgentEventType.RESPONSE_COMPLETE:
+                self._append(uid, conversation_id, revision, message, ''.join(answer))
+            yield event
+
+    def _append(self, uid: str, conversation_id: str, revision: int, message: str, answer: str):
+        conversation = self.backend.get(uid, conversation_id)
+        if conversation is None or conversation.revision != revision:
+            # replaced while this response was streaming, the client resends its history next time
+            return
+        conversation.turns.append(ConversationTurn(MessageRole.USER.value, message, self.count_tokens(message)))
+        conversation.turns.append(ConversationTurn(MessageRole.ASSISTANT.value, answer, self.count_tokens(answer)))
+        self.backend.save(conversation)
+        self.compact(conversation)
+
+    def compact(self, conversation: Conversation):
+        end = self._window(conversation)
+        if end <= conversation.summarized:
+            return
+        if self.settings.mode == 'truncate' or self.llm is None:
+            self.stats.folded_turns += end - conversation.summarized
+            conversation.summarized = end
+            self.backend.save(conversation)
+            return
+        task = asyncio.create_task(self._summarize(
+            conversation.uid, conversation.conversation_id, conversation.revision,
+            conversation.summary, conversation.summarized, conversation.turns[conversation.summarized:end]
+        ))
+        self._compactions.add(task)
+        task.add_done_callback(self._compactions.discard)
+
+    async def _summarize(self, uid: str, conversation_id: str, revision: int, summary: str,
+                         start: int, turns: List[ConversationTurn]):
+        prompt = SUMMARY_PROMPT.format(
+            summary=summary or '(empty)',
+            messages='\n'.join(f'{turn.role}: {turn.content}' for turn in turns),
+        )
+        try:
+            response = await self.llm.acomplete(prompt, max_tokens=self.settings.summary_max_tokens)
+        except Exception as err:
+            logging.warning(f"conversation summary failed, keeping the older turns out: {err!r}")
+            self.stats.summary_failures += 1
+            return
+        conversation = self.backend.get(uid, conversation_id)
+        if conversation is None or conversation.revision != revision or conversation.summarized != start:
+            return
+        conversation.summary = response.text.strip()
+        conversation.summary_tokens = self.count_tokens(conversation.summary)
+        conversation.summarized = start + len(turns)
+        self.backend.save(conversation)
+        self.stats.summaries += 1
+        self.stats.folded_turns += len(turns)
+        logging.info(f"summarized {len(turns)} turns of conversation {conversation_id}")
+
+    def delete(self, uid: str, conversation_id: str):
+        self.backend.delete(uid, conversation_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = self.stats
+        return {
+            'conversations': self.backend.size(),
+            'opened': stats.opened,
+            'created': stats.created,
+            'resynced': stats.resynced,
+            'out_of_sync': stats.out_of_sync,
+            'summaries': stats.summaries,
+            'summary_failures': stats.summary_failures,
+            'folded_turns': stats.folded_turns,
+            'history_tokens': stats.history_tokens,
+            'history_tokens_sent': stats.history_tokens_sent,
+        }
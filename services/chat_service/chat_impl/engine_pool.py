@@ -0,0 +1,103 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Generic, TypeVar, Dict, List
+
+T = TypeVar('T')
+
+
+@dataclass
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    discarded: int = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@dataclass
+class PooledEntry(Generic[T]):
+    key: str
+    value: T
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class EnginePool(Generic[T]):
+    """
+    Bounded LRU/TTL pool of per-key objects that are expensive to build.
+
+    An entry is leased to exactly one caller between `acquire` and `release`, so
+    concurrent requests for the same key each get their own instance.
+    """
+
+    def __init__(self, build: Callable[[str], T], max_size: int = 64, ttl_s: float = 600):
+        self.build = build
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.stats = PoolStats()
+        self._idle: OrderedDict[str, List[PooledEntry[T]]] = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _expired(self, entry: PooledEntry[T], now: float) -> bool:
+        return now - entry.created_at > self.ttl_s
+
+    def acquire(self, key: str) -> PooledEntry[T]:
+        now = time.monotonic()
+        entries = self._idle.get(key)
+        while entries:
+            entry = entries.pop()
+            self._size -= 1
+            if self._expired(entry, now):
+                self.stats.expirations += 1
+                continue
+            if not entries:
+                del self._idle[key]
+            self.stats.hits += 1
+            entry.last_used = now
+            return entry
+        self._idle.pop(key, None)
+
+        self.stats.misses += 1
+        return PooledEntry(key=key, value=self.build(key))
+
+    def release(self, entry: PooledEntry[T], reusable: bool = True):
+        now = time.monotonic()
+        if not reusable or self._expired(entry, now):
+            self.stats.discarded += 1
+            return
+        entry.last_used = now
+        self._idle.setdefault(entry.key, []).append(entry)
+        self._idle.move_to_end(entry.key)
+        self._size += 1
+        while self._size > self.max_size:
+            self._evict_lru()
+
+    def _evict_lru(self):
+        key, entries = next(iter(self._idle.items()))
+        entries.pop(0)
+        if not entries:
+            del self._idle[key]
+        self._size -= 1
+        self.stats.evictions += 1
+        logging.debug(f"evicted pooled engine for {key}")
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            'size': self._size,
+            'max_size': self.max_size,
+            'hits': self.stats.hits,
+            'misses': self.stats.misses,
+            'hit_rate': self.stats.hit_rate(),
+            'evictions': self.stats.evictions,
+            'expirations': self.stats.expirations,
+            'discarded': self.stats.discarded,
+        }
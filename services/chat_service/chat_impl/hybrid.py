@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Sequence, Tuple
+
+from llama_index.callbacks import CallbackManager
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle, TextNode
+
+from keyword_index import GcsKeywordIndexStore, KeywordIndex
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = 60,
+                           weights: Optional[Sequence[float]] = None) -> List[Tuple[str, float]]:
+    """
+    Fuses ranked id lists by summing weight / (k + rank). Scores are normalized so an id
+    ranked first by every list scores 1.0.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + weight / (k + rank)
+    best = sum(weights) / (k + 1)
+    return sorted(((item_id, score / best) for item_id, score in scores.items()),
+                  key=lambda item: item[1], reverse=True)
+
+
+@dataclass
+class HybridSettings:
+    dense_top_k: int = 6
+    keyword_top_k: int = 6
+    top_k: int = 8
+    skip_rerank_score: float = 0.99
+
+    @classmethod
+    def from_env(cls) -> 'HybridSettings':
+        return cls(
+            dense_top_k=int(os.getenv('HYBRID_DENSE_TOP_K', cls.dense_top_k)),
+            keyword_top_k=int(os.getenv('HYBRID_KEYWORD_TOP_K', cls.keyword_top_k)),
+            top_k=int(os.getenv('HYBRID_TOP_K', cls.top_k)),
+            skip_rerank_score=float(os.getenv('HYBRID_SKIP_RERANK_SCORE', cls.skip_rerank_score)),
+        )
+
+
+@dataclass
+class RetrievalStats:
+    queries: int = 0
+    keyword_queries: int = 0
+    dense_only: int = 0
+    keyword_only: int = 0
+    both: int = 0
+    dense_s: float = 0.0
+    keyword_s: float = 0.0
+
+
+class _KeywordIndexLoad:
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.done = threading.Event()
+        self.index: Optional[KeywordIndex] = None
+
+
+class KeywordIndexCache:
+    """
+    Keeps the most recently used per-user keyword indexes in memory. Entries are dropped
+    when the ingest service reports new documents for the user. Concurrent misses of a
+    user wait for one download instead of starting their own.
+    """
+
+    def __init__(self, store: GcsKeywordIndexStore, max_users: int = 256):
+        self.store = store
+        self.max_users = max_users
+        self._indexes: OrderedDict[str, Optional[KeywordIndex]] = OrderedDict()
+        self._loading: Dict[str, _KeywordIndexLoad] = {}
+        # bumped by invalidate, a download that started before it is returned but not kept
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.hits = 0
+        self.coalesced = 0
+
+    def get(self, uid: str) -> Optional[KeywordIndex]:
+        with self._lock:
+            if uid in self._indexes:
+                self._indexes.move_to_end(uid)
+                self.hits += 1
+                return self._indexes[uid]
+            load = self._loading.get(uid)
+            owner = load is None
+            if owner:
+                load = self._loading[uid] = _KeywordIndexLoad(self._generations.get(uid, 0))
+            else:
+                self.coalesced += 1
+        if not owner:
+            load.done.wait()
+            return load.index
+
+        loaded = False
+        try:
+            load.index, _ = self.store.load(uid)
+            loaded = True
+        except Exception as err:
+            logging.warning(f"failed to load keyword index of {uid}: {err!r}")
+        finally:
+            with self._lock:
+                del self._loading[uid]
+                if loaded and self._generations.get(uid, 0) == load.generation:
+                    self.loads += 1
+                    self._indexes[uid] = load.index
+                    while len(self._indexes) > self.max_users:
+                        self._indexes.popitem(last=False)
+            load.done.set()
+        return load.index
+
+    def invalidate(self, uid: str):
+        with self._lock:
+            self._generations[uid] = self._generations.get(uid, 0) + 1
+            self._indexes.pop(uid, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'users': len(self._indexes), 'loads': self.loads, 'hits': self.hits, 'coalesced': self.coalesced}
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Queries the dense retriever and the user's keyword index concurrently and fuses both
+    rankings. The dense similarity cutoff is applied before fusion, keyword hits are kept
+    as they match query terms exactly. Falls back to dense only without a keyword index.
+    """
+
+    def __init__(self, dense: BaseRetriever, keyword_indexes: KeywordIndexCache, uid: str,
+                 stats: RetrievalStats, keyword_top_k: int = 6, top_k: int = 8,
+                 dense_cutoff: float = 0.25, rrf_k: int = 60,
+                 callback_manager: Optional[CallbackManager] = None):
+        super().__init__(callback_manager)
+        self.dense = dense
+        self.keyword_indexes = keyword_indexes
+        self.uid = uid
+        self.stats = stats
+        self.keyword_top_k = keyword_top_k
+        self.top_k = top_k
+        self.dense_cutoff = dense_cutoff
+        self.rrf_k = rrf_k
+
+    def _keyword_search(self, query: str) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        index = self.keyword_indexes.get(self.uid)
+        if index is None:
+            return []
+        hits = index.search(query, self.keyword_top_k)
+        self.stats.keyword_s += time.perf_counter() - start
+        self.stats.keyword_queries += 1
+        return [
+            NodeWithScore(node=TextNode(id_=document.id, text=document.text, metadata=document.metadata), score=score)
+            for document, score in hits
+        ]
+
+    async def _dense_search(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        nodes = await self.dense.aretrieve(query_bundle)
+        self.stats.dense_s += time.perf_counter() - start
+        return [node for node in nodes if node.score is None or node.score >= self.dense_cutoff]
+
+    def fuse(self, dense: List[NodeWithScore], keyword: List[NodeWithScore]) -> List[NodeWithScore]:
+        self.stats.queries += 1
+        by_id: Dict[str, NodeWithScore] = {}
+        # prefer the dense copy of a node, it carries the full metadata from the vector store
+        for node in keyword + dense:
+            by_id[node.node.node_id] = node
+
+        dense_ids = {node.node.node_id for node in dense}
+        keyword_ids = {node.node.node_id for node in keyword}
+        fused = reciprocal_rank_fusion(
+            [[node.node.node_id for node in dense], [node.node.node_id for node in keyword]],
+            k=self.rrf_k,
+        )[:self.top_k]
+        for node_id, _ in fused:
+            if node_id in dense_ids and node_id in keyword_ids:
+                self.stats.both += 1
+            elif node_id in dense_ids:
+                self.stats.dense_only += 1
+            else:
+                self.stats.keyword_only += 1
+        return [NodeWithScore(node=by_id[node_id].node, score=score) for node_id, score in fused]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        dense = [
+            node for node in self.dense.retrieve(query_bundle)
+            if node.score is None or node.score >= self.dense_cutoff
+        ]
+        return self.fuse(dense, self._keyword_search(query_bundle.query_str))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        dense, keyword = await asyncio.gather(
+            self._dense_search(query_bundle),
+            asyncio.to_thread(self._keyword_search, query_bundle.query_str),
+        )
+        return self.fuse(dense, keyword)
+
+
+def get_retrieval_stats(stats: RetrievalStats, keyword_indexes: Optional[KeywordIndexCache]) -> Dict[str, Any]:
+    fused = stats.both + stats.dense_only + stats.keyword_only
+    return {
+        'enabled': keyword_indexes is not None,
+        'queries': stats.queries,
+        'keyword_queries': stats.keyword_queries,
+        'fused_from_both': stats.both / fused if fused else 0.0,
+        'fused_dense_only': stats.dense_only / fused if fused else 0.0,
+        'fused_keyword_only': stats.keyword_only / fused if fused else 0.0,
+        'dense_mean_ms': 1000 * stats.dense_s / stats.queries if stats.queries else 0.0,
+        'keyword_mean_ms': 1000 * stats.keyword_s / stats.keyword_queries if stats.keyword_queries else 0.0,
+        'keyword_indexes': keyword_indexes.get_stats() if keyword_indexes else {},
+    }
@@ -1,31 +1,144 @@
 import logging
 import os
 import uuid
-from typing import List, Any, Dict
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from firebase_admin import firestore
 from llama_index.core.llms.types import ChatMessage
-from llama_index.llms.openai import OpenAI
-from llama_index.schema import NodeWithScore
+from llama_index.schema import NodeWithScore, TextNode
 
 from pydantic import BaseModel
 
-from app_ctx import ApplicationContext
-from chat_impl.auth import get_current_user
+from app_ctx import get_context
+from chat_impl.answer_cache import SemanticAnswerCache, InMemoryAnswerCacheBackend, IndexUpdateListener
+from chat_impl.auth import get_current_user, token_cache, certificate_refresher
+from chat_impl.cancellation import ChatLimits
+from chat_impl.conversation import (
+    ConversationStore, InMemoryConversationBackend, CompactionSettings, ConversationOutOfSync
+)
+from chat_impl.hybrid import KeywordIndexCache, HybridSettings, get_retrieval_stats
 from chat_impl.query_engine import ContextFactory, QueryEngineFactory
+from chat_impl.rerank import RerankSettings, CrossEncoderScorer
+from chat_impl.router import RouterSettings, QueryMode
+from chat_impl.speculation import SpeculationSettings
+from chat_impl.sub_questions import SubQuestionSettings
+from chat_impl.streaming import ChunkEncoder, TaskFilter, Verbosity, coalesce_tokens
+from keyword_index import GcsKeywordIndexStore
+from metrics import metrics, TraceStore
+from providers import providers
 
 chat_router = APIRouter(prefix='/api/v1')
+# unauthenticated like any scrape target, it only exposes aggregates
+metrics_router = APIRouter()
 
-app_ctx = ApplicationContext()
+app_ctx = get_context()
 ctx_factory = ContextFactory(app_ctx)
-query_engine_factory = QueryEngineFactory(app_ctx, ctx_factory)
+
+keyword_indexes = None
+if os.getenv('HYBRID_RETRIEVAL_ENABLED', 'true').lower() == 'true':
+    keyword_indexes = KeywordIndexCache(
+        GcsKeywordIndexStore(app_ctx.document_bucket),
+        max_users=int(os.getenv('KEYWORD_INDEX_CACHE_USERS', '256')),
+    )
+
+query_engine_factory = QueryEngineFactory(
+    app_ctx, ctx_factory,
+    pool_size=int(os.getenv('ENGINE_POOL_SIZE', '64')),
+    pool_ttl_s=float(os.getenv('ENGINE_POOL_TTL_S', '600')),
+    keyword_indexes=keyword_indexes,
+    hybrid_settings=HybridSettings.from_env(),
+    rerank_settings=RerankSettings.from_env(),
+    limits=ChatLimits.from_env(),
+    router_settings=RouterSettings.from_env(),
+    sub_question_settings=SubQuestionSettings.from_env(),
+    speculation_settings=SpeculationSettings.from_env(),
+)
+
+answer_cache = None
+if os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true':
+    answer_cache = SemanticAnswerCache(
+        backend=InMemoryAnswerCacheBackend(
+            ttl_s=float(os.getenv('ANSWER_CACHE_TTL_S', '3600')),
+            max_entries_per_user=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '64')),
+        ),
+        embed_model=app_ctx.text_small,
+        threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+    )
+
+conversations = None
+if os.getenv('CONVERSATION_STORE_ENABLED', 'true').lower() == 'true':
+    conversations = ConversationStore(
+        backend=InMemoryConversationBackend(
+            ttl_s=float(os.getenv('CONVERSATION_TTL_S', '86400')),
+            max_conversations=int(os.getenv('CONVERSATION_MAX_ENTRIES', '10000')),
+        ),
+        settings=CompactionSettings.from_env(),
+        llm=app_ctx.gpt3,
+    )
+
+invalidated_caches = [cache for cache in (answer_cache, keyword_indexes) if cache is not None]
+if hasattr(app_ctx.document_vector_store, 'invalidate'):
+    # local and tiered vector stores hold per-user partitions in memory
+    invalidated_caches.append(app_ctx.document_vector_store)
+if invalidated_caches:
+    IndexUpdateListener(firestore.client(), *invalidated_caches).start()
+
+certificate_refresher.start()
+
+traces = TraceStore(
+    max_traces=int(os.getenv('METRICS_TRACES_MAX', '256')),
+    sample_rate=float(os.getenv('METRICS_TRACE_SAMPLE_RATE', '0')),
+)
+
+
+def cache_hit_rates():
+    rates = {
+        ('engine_pool',): query_engine_factory.engine_pool.get_stats()['hit_rate'],
+        ('auth',): token_cache.get_stats()['hit_rate'],
+        ('embedding',): app_ctx.embedding_cache.get_stats()['hit_rate'],
+    }
+    if answer_cache:
+        rates[('answer',)] = answer_cache.get_stats()['hit_rate']
+    if keyword_indexes:
+        indexes = keyword_indexes.get_stats()
+        lookups = indexes['hits'] + indexes['loads']
+        rates[('keyword_index',)] = indexes['hits'] / lookups if lookups else 0.0
+    return rates
+
+
+metrics.gauge('chat_cache_hit_rate', 'Hit rate of the in-process caches', cache_hit_rates, labels=('cache',))
+metrics.gauge('chat_streams_in_flight', 'Chat responses being streamed',
+              lambda: query_engine_factory.stream_stats.get_stats()['in_flight'])
+metrics.gauge('chat_engine_pool_size', 'Pooled query engines', lambda: query_engine_factory.engine_pool.get_stats()['size'])
+if conversations:
+    metrics.gauge('chat_conversations', 'Conversations held in memory', conversations.backend.size)
+
+
+def warm_up_tasks():
+    """
+    Work the first chat would otherwise pay for, run at startup once the clients exist.
+    """
+    tasks = {
+        # the tls handshake with openai and the embedding client's first use
+        'warm.embedding': lambda: app_ctx.text_small.get_query_embedding('warm up'),
+    }
+    if isinstance(query_engine_factory.local_scorer, CrossEncoderScorer):
+        # the first prediction of a cross-encoder initializes the model runtime
+        tasks['warm.local_scorer'] = lambda: query_engine_factory.local_scorer(
+            'warm up', [NodeWithScore(node=TextNode(text='warm up'), score=1.0)]
+        )
+    return tasks
 
 
 class ChatRequestSettings(BaseModel):
     temperature: float = 0.8
     max_token: int = 256
     top_p: float = 0.5
+    # capped by CHAT_DEADLINE_S
+    deadline_s: float | None = None
+    # auto lets the router pick, agent and sub_questions force a path
+    mode: QueryMode = QueryMode.AUTO
 
 
 class RequestChatMessage(BaseModel):
@@ -33,11 +146,26 @@ class RequestChatMessage(BaseModel):
     role: str
 
 
+class ChatStreamSettings(BaseModel):
+    verbosity: Verbosity = Verbosity.FULL
+    # merge response tokens for up to this long, 0 streams every token as its own line
+    coalesce_ms: float = 0
+    coalesce_chars: int = 256
+    # leave null and empty fields out of every line
+    compact: bool = False
+    # keep a trace of this response for /api/v1/traces/{id}, the id of its lines
+    trace: bool = False
+
+
 class ChatRequest(BaseModel):
     model: str
     settings: ChatRequestSettings
-    history: list[RequestChatMessage]
+    # with a conversation id the history is kept by the server and only resent when it answers 409
+    conversation_id: str | None = None
+    history_length: int | None = None
+    history: list[RequestChatMessage] = []
     message: str
+    stream: ChatStreamSettings = ChatStreamSettings()
 
 
 class AvailableModelResponse(BaseModel):
@@ -51,71 +179,235 @@ async def get_available(user: dict = Depends(get_current_user)):
     return AvailableModelResponse(available=['gpt-3.5-turbo', 'gpt-4'])
 
 
-class ChatAgentTask(BaseModel):
-    completed: bool
-    event_type: str
-    event_id: str
-    parent_id: str
-    duration_s: float
+class EnginePoolStatsResponse(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    hit_rate: float
+    evictions: int
+    expirations: int
+    discarded: int
 
 
-class ChatAgentSources(BaseModel):
-    score: float | None
-    text: str
-    metadata: Dict[str, Any]
+@chat_router.get('/stats/engine-pool')
+async def get_engine_pool_stats(user: dict = Depends(get_current_user)):
+    return EnginePoolStatsResponse(**query_engine_factory.engine_pool.get_stats())
 
 
-class ChatResponseChunk(BaseModel):
-    id: str
-    event_type: str
-    task: ChatAgentTask | None
-    error: str | None
-    response_chunk: str
-    sources: List[ChatAgentSources]
+class AnswerCacheStatsResponse(BaseModel):
+    enabled: bool
+    hits: int = 0
+    misses: int = 0
+    hit_rate: float = 0
+    stores: int = 0
+    invalidations: int = 0
 
 
-@chat_router.post('/chat')
-async def chat(request: ChatRequest, user: dict = Depends(get_current_user)):
-    logging.info(f"chat request uid: {user['uid']}")
+@chat_router.get('/stats/answer-cache')
+async def get_answer_cache_stats(user: dict = Depends(get_current_user)):
+    if not answer_cache:
+        return AnswerCacheStatsResponse(enabled=False)
+    return AnswerCacheStatsResponse(enabled=True, **answer_cache.get_stats())
+
+
+class AuthStatsResponse(BaseModel):
+    size: int
+    max_entries: int
+    hits: int
+    misses: int
+    coalesced: int
+    hit_rate: float
+    verifications: int
+    failures: int
+    malformed: int
+    expirations: int
+    evictions: int
+    verify_mean_ms: float
+
 
-    response_llm = OpenAI(
-        api_key=os.getenv('OPENAI_API_KEY'),
-        model="gpt-3.5-turbo",
-        temperature=request.settings.temperature,
-        max_tokens=request.settings.max_token,
+@chat_router.get('/stats/auth')
+async def get_auth_stats(user: dict = Depends(get_current_user)):
+    return AuthStatsResponse(**token_cache.get_stats())
+
+
+@chat_router.get('/stats/retrieval')
+async def get_retrieval_stats_endpoint(user: dict = Depends(get_current_user)):
+    return get_retrieval_stats(query_engine_factory.retrieval_stats, keyword_indexes)
+
+
+class RerankStatsResponse(BaseModel):
+    skipped: int
+    remote: int
+    local: int
+    timeouts: int
+    errors: int
+    over_budget: int
+    remote_mean_ms: float
+    remote_latency_ewma_ms: float | None
+
+
+@chat_router.get('/stats/rerank')
+async def get_rerank_stats(user: dict = Depends(get_current_user)):
+    return RerankStatsResponse(
+        **query_engine_factory.rerank_stats.to_dict(query_engine_factory.rerank_health)
     )
-    engine = query_engine_factory.get_query_engine(user['uid'], response_llm)
 
+
+class ChatStreamStatsResponse(BaseModel):
+    started: int
+    completed: int
+    failed: int
+    cancelled: int
+    deadline_exceeded: int
+    in_flight: int
+    cancelled_tasks: int
+    dropped_events: int
+    tokens_streamed_before_cancel: int
+    tokens_saved: int
+    seconds_saved: float
+
+
+@chat_router.get('/stats/chat-streams')
+async def get_chat_stream_stats(user: dict = Depends(get_current_user)):
+    return ChatStreamStatsResponse(**query_engine_factory.stream_stats.get_stats())
+
+
+@chat_router.get('/stats/routing')
+async def get_routing_stats(user: dict = Depends(get_current_user)):
+    return {
+        **query_engine_factory.route_stats.to_dict(),
+        'sub_questions': query_engine_factory.sub_question_stats.to_dict(),
+        'speculation': query_engine_factory.speculation_stats.to_dict(),
+    }
+
+
+@chat_router.get('/stats/vector-store')
+async def get_vector_store_stats(user: dict = Depends(get_current_user)):
+    vector_store = app_ctx.document_vector_store
+    if not hasattr(vector_store, 'get_stats'):
+        return {'backend': 'pinecone'}
+    return vector_store.get_stats()
+
+
+@chat_router.get('/stats/embedding-cache')
+async def get_embedding_cache_stats(user: dict = Depends(get_current_user)):
+    return app_ctx.embedding_cache.get_stats()
+
+
+@chat_router.get('/stats/providers')
+async def get_provider_stats(user: dict = Depends(get_current_user)):
+    return providers.get_stats()
+
+
+class ConversationStatsResponse(BaseModel):
+    enabled: bool
+    conversations: int = 0
+    opened: int = 0
+    created: int = 0
+    resynced: int = 0
+    out_of_sync: int = 0
+    summaries: int = 0
+    summary_failures: int = 0
+    folded_turns: int = 0
+    history_tokens: int = 0
+    history_tokens_sent: int = 0
+
+
+@chat_router.get('/stats/conversations')
+async def get_conversation_stats(user: dict = Depends(get_current_user)):
+    if not conversations:
+        return ConversationStatsResponse(enabled=False)
+    return ConversationStatsResponse(enabled=True, **conversations.get_stats())
+
+
+@chat_router.delete('/conversations/{conversation_id}')
+async def delete_conversation(conversation_id: str, user: dict = Depends(get_current_user)):
+    if conversations:
+        conversations.delete(user['uid'], conversation_id)
+    return {'deleted': conversation_id}
+
+
+@metrics_router.get('/metrics')
+async def get_metrics(format: str = 'prometheus'):
+    if format == 'json':
+        return metrics.to_dict()
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@chat_router.get('/traces/{trace_id}')
+async def get_trace(trace_id: str, user: dict = Depends(get_current_user)):
+    trace = traces.get(trace_id, user['uid'])
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"Trace {trace_id} not found")
+    return trace
+
+
+@chat_router.post('/chat')
+async def chat(request: ChatRequest, user: dict = Depends(get_current_user)):
+    uid = user['uid']
+    logging.info(f"chat request uid: {uid}")
     response_id = str(uuid.uuid4())
-    chat_history = [
-        ChatMessage(role=message.role, content=message.message)
-        for message in request.history
-    ]
+    trace = traces.start(response_id, uid, 'chat', requested=request.stream.trace)
 
-    async def response_generator():
-        async for event in engine.chat(chat_history, request.message):
-            task = None
-            if event.task:
-                task = ChatAgentTask(
-                    completed=event.task.completed,
-                    event_type=event.task.event_type,
-                    event_id=event.task.event_id,
-                    parent_id=event.task.parent_id,
-                    duration_s=event.task.duration_s
-                )
-            response_chunk = ChatResponseChunk(
-                id=response_id,
-                event_type=event.type,
-                task=task,
-                error=event.error,
-                response_chunk=event.response_chunk,
-                sources=[
-                    ChatAgentSources(score=source.score, text=source.text, metadata=source.metadata)
-                    for source in event.sources
-                    if isinstance(source, NodeWithScore)
-                ]
+    conversation = None
+    if request.conversation_id and conversations:
+        try:
+            conversation = conversations.open(
+                uid, request.conversation_id,
+                [(message.role, message.message) for message in request.history],
+                request.history_length,
             )
-            yield response_chunk.json() + '\n'
+        except ConversationOutOfSync:
+            raise HTTPException(status_code=409, detail='conversation out of sync, resend the history')
+        chat_history = conversations.history(conversation)
+    else:
+        chat_history = [
+            ChatMessage(role=message.role, content=message.message)
+            for message in request.history
+        ]
+
+    # answers only depend on the message when there is no prior conversation
+    cacheable = answer_cache is not None and not chat_history
+    embedding, cached, generation = None, None, None
+    if cacheable:
+        generation = answer_cache.generation(uid)
+        embedding = await answer_cache.embed(request.message)
+        cached = answer_cache.lookup(uid, embedding)
+
+    if cached:
+        if trace is not None:
+            trace.attributes['route'] = 'answer_cache'
+        events = answer_cache.replay(cached)
+    else:
+        engine = query_engine_factory.get_query_engine(
+            uid,
+            temperature=request.settings.temperature,
+            max_tokens=request.settings.max_token,
+            deadline_s=request.settings.deadline_s,
+            mode=request.settings.mode,
+            trace=trace,
+        )
+        events = engine.chat(chat_history, request.message)
+        if cacheable:
+            events = answer_cache.record(uid, request.message, embedding, events, generation)
+    if conversation:
+        events = conversations.record(conversation, request.message, events)
+
+    encoder = ChunkEncoder(response_id, compact=request.stream.compact)
+    task_filter = TaskFilter(request.stream.verbosity)
+    if request.stream.coalesce_ms > 0:
+        events = coalesce_tokens(events, request.stream.coalesce_ms / 1000, request.stream.coalesce_chars)
+
+    async def response_generator():
+        try:
+            async for event in events:
+                event = task_filter(event)
+                if event is not None:
+                    yield encoder.encode(event)
+        finally:
+            if trace is not None:
+                trace.finish()
 
     return StreamingResponse(
         response_generator(),
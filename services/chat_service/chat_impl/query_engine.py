@@ -1,22 +1,47 @@
 import asyncio
 import logging
+import time
+import uuid
 from asyncio import Queue
-from typing import List
+from dataclasses import dataclass
+from typing import List, Callable, Optional
 
 from llama_index import StorageContext, ServiceContext, VectorStoreIndex
 from llama_index.agent import OpenAIAgent
 from llama_index.callbacks import CallbackManager, CBEventType
-from llama_index.core.llms.types import ChatMessage
+from llama_index.callbacks.schema import BASE_TRACE_EVENT
+from llama_index.core.llms.types import ChatMessage, MessageRole
+from llama_index.embeddings.base import BaseEmbedding
 from llama_index.indices.vector_store import VectorIndexRetriever
 from llama_index.llms import OpenAI
 from llama_index.postprocessor import SimilarityPostprocessor
-from llama_index.query_engine import CitationQueryEngine
+from llama_index.query_engine.citation_query_engine import CITATION_QA_TEMPLATE
 from llama_index.response_synthesizers import ResponseMode
+from llama_index.schema import QueryBundle
 from llama_index.tools import QueryEngineTool, ToolMetadata
 from llama_index.vector_stores import ExactMatchFilter, MetadataFilters
 
 from app_ctx import ApplicationContext
+from chat_impl.cancellation import ChatLimits, ChatStreamStats, track_tasks, cancel_tasks
 from chat_impl.chat_agent import RealTimeAgentEvents, AgentEvent, AgentEventType
+from chat_impl.engine_pool import EnginePool, PooledEntry
+from chat_impl.hybrid import HybridRetriever, KeywordIndexCache, RetrievalStats, HybridSettings
+from chat_impl.rerank import AdaptiveRerank, RerankSettings, RerankStats, RemoteRerankHealth, build_local_scorer
+from chat_impl.router import HeuristicRouter, RouterSettings, RouteStats, Route, RouteDecision, QueryMode
+from chat_impl.speculation import SpeculativeCitationQueryEngine, SpeculativeRetrieval, SpeculationSettings, \
+    SpeculationStats
+from chat_impl.streaming import llm_deltas
+from chat_impl.sub_questions import SubQuestionEngine, SubQuestionSettings, SubQuestionStats
+from metrics import metrics, RequestTrace, SIZE_BUCKETS
+from providers import providers
+
+FIRST_TOKEN_SECONDS = metrics.histogram('chat_first_token_seconds', 'Time to the first response token',
+                                        labels=('route',))
+RESPONSE_SECONDS = metrics.histogram('chat_response_seconds', 'Time to the end of a response',
+                                     labels=('outcome',))
+RESPONSE_TOKENS = metrics.counter('chat_response_tokens_total', 'Streamed response tokens', labels=('route',))
+QUEUE_DEPTH = metrics.histogram('chat_event_queue_depth', 'Events waiting in the queue of a response when read',
+                                buckets=SIZE_BUCKETS)
 
 
 class ContextFactory:
@@ -26,15 +51,16 @@ class ContextFactory:
     def get_storage_context(self):
         return StorageContext.from_defaults(vector_store=self.ctx.document_vector_store)
 
-    def get_service_context(self, queue: Queue):
-        event_handler = RealTimeAgentEvents(queue, [
+    @staticmethod
+    def get_event_handler(queue: Queue, trace: Optional[RequestTrace] = None):
+        return RealTimeAgentEvents(queue, trace=trace, allowed_events=[
             CBEventType.LLM, CBEventType.QUERY, CBEventType.RETRIEVE,
             CBEventType.SYNTHESIZE, CBEventType.TREE, CBEventType.SUB_QUESTION,
             CBEventType.FUNCTION_CALL, CBEventType.RERANKING, CBEventType.EXCEPTION,
             CBEventType.AGENT_STEP
         ])
-        callback_manager = CallbackManager([event_handler])
 
+    def get_service_context(self, callback_manager: CallbackManager):
         return ServiceContext.from_defaults(
             llm=self.ctx.gpt3,
             embed_model=self.ctx.text_small,
@@ -45,34 +71,162 @@ class ContextFactory:
         )
 
 
+@dataclass
+class EngineComponents:
+    callback_manager: CallbackManager
+    response_llm: OpenAI
+    agent: OpenAIAgent
+    citation_engine: SpeculativeCitationQueryEngine
+
+
 class QueryEngine:
-    def __init__(self, queue: asyncio.Queue[AgentEvent], agent: OpenAIAgent):
+    def __init__(self, queue: asyncio.Queue[AgentEvent], agent: OpenAIAgent,
+                 on_close: Optional[Callable[[bool], None]] = None,
+                 handler: Optional[RealTimeAgentEvents] = None,
+                 stats: Optional[ChatStreamStats] = None,
+                 deadline_s: float = 120, max_tokens: int = 0,
+                 citation_engine: Optional[SpeculativeCitationQueryEngine] = None,
+                 response_llm: Optional[OpenAI] = None,
+                 router: Optional[HeuristicRouter] = None,
+                 route_stats: Optional[RouteStats] = None,
+                 sub_questions: Optional[Callable[[], SubQuestionEngine]] = None,
+                 mode: QueryMode = QueryMode.AUTO,
+                 trace: Optional[RequestTrace] = None,
+                 embed_model: Optional[BaseEmbedding] = None,
+                 speculation_settings: Optional[SpeculationSettings] = None,
+                 speculation_stats: Optional[SpeculationStats] = None):
         self.queue = queue
         self.agent = agent
+        self.on_close = on_close
+        self.handler = handler
+        self.stats = stats or ChatStreamStats()
+        self.deadline_s = deadline_s
+        self.max_tokens = max_tokens
+        self.citation_engine = citation_engine
+        self.response_llm = response_llm
+        self.router = router
+        self.route_stats = route_stats or RouteStats()
+        # built when the route is taken, most messages never decompose
+        self.sub_questions = sub_questions
+        self.mode = mode
+        self.trace = trace
+        self.embed_model = embed_model
+        self.speculation_settings = speculation_settings or SpeculationSettings(enabled=False)
+        self.speculation_stats = speculation_stats or SpeculationStats()
+
+    def decide(self, memory: List[ChatMessage], message: str) -> RouteDecision:
+        if self.mode == QueryMode.AGENT:
+            return RouteDecision(Route.AGENT, 'requested')
+        if self.mode == QueryMode.SUB_QUESTIONS and self.sub_questions is not None:
+            return RouteDecision(Route.SUB_QUESTIONS, 'requested')
+        if self.router is None or self.citation_engine is None or self.response_llm is None:
+            return RouteDecision(Route.AGENT, 'disabled')
+        decision = self.router.route(message, memory)
+        if decision.route == Route.SUB_QUESTIONS and self.sub_questions is None:
+            return RouteDecision(Route.AGENT, decision.reason)
+        return decision
+
+    async def answer_from_documents(self, message: str):
+        # what the document_vector_index tool does, without the agent round trip deciding to call it
+        nodes = await self.citation_engine.aretrieve(QueryBundle(message))
+        if not nodes:
+            return None, None
+        nodes = self.citation_engine._create_citation_nodes(nodes)
+        prompt = CITATION_QA_TEMPLATE.format(
+            context_str='\n\n'.join(node.node.get_content() for node in nodes),
+            query_str=message,
+        )
+        stream = await self.response_llm.astream_chat([ChatMessage(role=MessageRole.USER, content=prompt)])
+        return nodes, llm_deltas(stream)
+
+    def speculate(self, message: str, parent_id: str) -> Optional[SpeculativeRetrieval]:
+        # only the agent plans before it retrieves, the other routes retrieve right away
+        if not self.speculation_settings.enabled or self.citation_engine is None or self.embed_model is None:
+            return None
+        speculation = SpeculativeRetrieval(
+            engine=self.citation_engine,
+            embed_model=self.embed_model,
+            message=message,
+            settings=self.speculation_settings,
+            stats=self.speculation_stats,
+            handler=self.handler,
+            parent_id=parent_id,
+        )
+        self.citation_engine.speculation = speculation
+        return speculation.start()
+
+    async def answer_directly(self, memory: List[ChatMessage], message: str):
+        stream = await self.response_llm.astream_chat(
+            [*memory, ChatMessage(role=MessageRole.USER, content=message)]
+        )
+        return [], llm_deltas(stream)
 
     async def response_generator(self, memory, message):
+        # the queue is bounded, awaiting put stops pulling tokens while the client lags behind
+        start = time.perf_counter()
+        decision = self.decide(memory, message)
+        # reported straight to the handler, through the callback manager it would become the
+        # parent of the llm event that is still open when the first token arrives
+        route_event_id = str(uuid.uuid4())
+        if self.handler:
+            self.handler.on_event_start(CBEventType.QUERY, event_id=route_event_id, parent_id=BASE_TRACE_EVENT)
+        first, streamed = True, 0
+        # a follow up leans on the history, the agent rewrites it into a query of its own
+        speculate = decision.route == Route.AGENT and decision.reason != 'follow_up'
+        speculation = self.speculate(message, route_event_id) if speculate else None
         try:
-            response = await self.agent.astream_chat(
-                message=message,
-                chat_history=memory,
-                tool_choice=None,
-            )
-            self.queue.put_nowait(AgentEvent(
+            sources, tokens = None, None
+            if decision.route == Route.DOCUMENTS:
+                sources, tokens = await self.answer_from_documents(message)
+                if tokens is None:
+                    # nothing retrieved, let the agent answer on its own terms
+                    self.route_stats.record_fallback()
+                    decision = RouteDecision(Route.AGENT, 'no_sources')
+            elif decision.route == Route.SUB_QUESTIONS:
+                sources, tokens = await self.sub_questions().answer(memory, message, parent_id=route_event_id)
+                if tokens is None:
+                    self.route_stats.record_fallback()
+                    decision = RouteDecision(Route.AGENT, 'no_sources')
+            elif decision.route == Route.CHAT:
+                sources, tokens = await self.answer_directly(memory, message)
+            if tokens is None:
+                response = await self.agent.astream_chat(
+                    message=message,
+                    chat_history=memory,
+                    tool_choice=None,
+                )
+                sources, tokens = response.source_nodes, response.async_response_gen()
+            self.route_stats.record(decision.route)
+
+            await self.queue.put(AgentEvent(
                 type=AgentEventType.RESPONSE_START,
                 task=None,
                 error=None,
                 response_chunk='',
-                sources=response.source_nodes
+                sources=sources
             ))
-            async for res in response.async_response_gen():
-                self.queue.put_nowait(AgentEvent(
+            async for res in tokens:
+                if first:
+                    first = False
+                    elapsed_s = time.perf_counter() - start
+                    self.route_stats.record_first_token(decision.route, elapsed_s)
+                    FIRST_TOKEN_SECONDS.labels(decision.route.value).observe(elapsed_s)
+                    self._end_route_event(route_event_id, decision, elapsed_s)
+                streamed += 1
+                await self.queue.put(AgentEvent(
                     type=AgentEventType.RESPONSE_STREAM,
                     task=None,
                     error=None,
                     response_chunk=res,
                     sources=[]
                 ))
-            self.queue.put_nowait(AgentEvent(
+            RESPONSE_TOKENS.labels(decision.route.value).inc(streamed)
+            if first:
+                first = False
+                self._end_route_event(route_event_id, decision, None)
+            if self.trace is not None:
+                self.trace.attributes.update({'route': decision.route.value, 'reason': decision.reason})
+            await self.queue.put(AgentEvent(
                 type=AgentEventType.RESPONSE_COMPLETE,
                 task=None,
                 error=None,
@@ -81,28 +235,70 @@ class QueryEngine:
             ))
         except Exception as err:
             logging.error(err)
-            self.queue.put_nowait(AgentEvent(
+            if first:
+                self._end_route_event(route_event_id, decision, None)
+            await self.queue.put(AgentEvent(
                 type=AgentEventType.RESPONSE_ERROR,
                 task=None,
                 error=repr(err),
                 response_chunk='',
                 sources=[]
             ))
+        finally:
+            if speculation is not None:
+                self.citation_engine.speculation = None
+                speculation.close()
+
+    def _end_route_event(self, event_id: str, decision: RouteDecision, first_token_s: Optional[float]):
+        if not self.handler:
+            return
+        self.handler.on_event_end(CBEventType.QUERY, payload={'route': {
+            'route': decision.route.value,
+            'reason': decision.reason,
+            'first_token_ms': 1000 * first_token_s if first_token_s is not None else None,
+        }}, event_id=event_id)
 
     async def chat(self, memory: List[ChatMessage], message: str):
-        task = asyncio.create_task(self.response_generator(memory, message))
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + self.deadline_s
+        self.stats.start()
+        # everything the agent spawns for this request is tracked, including the task that
+        # streams the llm response into its memory
+        with track_tasks() as tasks:
+            task = asyncio.create_task(self.response_generator(memory, message))
+        # stays cancelled unless the stream runs to its end, the client went away otherwise
+        outcome, tokens, cancelled_tasks = 'cancelled', 0, 0
         try:
             while True:
-                event = await self.queue.get()
+                try:
+                    QUEUE_DEPTH.labels().observe(self.queue.qsize())
+                    event = await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    outcome = 'deadline'
+                    cancelled_tasks = cancel_tasks(tasks)
+                    yield AgentEvent(
+                        type=AgentEventType.AGENT_ERROR,
+                        task=None,
+                        error=f'deadline of {self.deadline_s:g}s exceeded',
+                        response_chunk='',
+                        sources=[]
+                    )
+                    break
+                if event.type == AgentEventType.RESPONSE_STREAM:
+                    tokens += 1
                 yield event
                 if event.type in [
                     AgentEventType.AGENT_ERROR,
                     AgentEventType.RESPONSE_ERROR,
                     AgentEventType.RESPONSE_COMPLETE
                 ]:
+                    outcome = 'completed' if event.type == AgentEventType.RESPONSE_COMPLETE else 'failed'
                     break
-            await task  # exceptions should be thrown here
+            if outcome != 'deadline':
+                await task  # exceptions should be thrown here
         except Exception as err:
+            outcome = 'failed'
             logging.error(err)
             yield AgentEvent(
                 type=AgentEventType.AGENT_ERROR,
@@ -111,35 +307,165 @@ class QueryEngine:
                 response_chunk='',
                 sources=[]
             )
+        finally:
+            if outcome == 'cancelled':
+                cancelled_tasks = cancel_tasks(tasks)
+                if cancelled_tasks:
+                    logging.info(f"chat stream closed by the client, cancelled {cancelled_tasks} tasks")
+            RESPONSE_SECONDS.labels(outcome).observe(loop.time() - started)
+            if self.trace is not None:
+                self.trace.attributes.update({'outcome': outcome, 'tokens': tokens})
+                self.trace.finish()
+            self.stats.record(
+                outcome, tokens, self.max_tokens, cancelled_tasks,
+                dropped_events=self.handler.dropped_events if self.handler else 0,
+                remaining_s=deadline - loop.time(),
+            )
+            if self.on_close:
+                # components are only safe to reuse once the agent has stopped touching them
+                self.on_close(task.done() and not task.cancelled() and not cancelled_tasks)
 
 
 class QueryEngineFactory:
-    def __init__(self, ctx: ApplicationContext, ctx_factory: ContextFactory):
+    def __init__(self, ctx: ApplicationContext, ctx_factory: ContextFactory,
+                 pool_size: int = 64, pool_ttl_s: float = 600,
+                 keyword_indexes: Optional[KeywordIndexCache] = None,
+                 hybrid_settings: Optional[HybridSettings] = None,
+                 rerank_settings: Optional[RerankSettings] = None,
+                 limits: Optional[ChatLimits] = None,
+                 router_settings: Optional[RouterSettings] = None,
+                 sub_question_settings: Optional[SubQuestionSettings] = None,
+                 speculation_settings: Optional[SpeculationSettings] = None):
         self.ctx = ctx
         self.ctx_factory = ctx_factory
+        self.limits = limits or ChatLimits()
+        self.stream_stats = ChatStreamStats()
+        self.router = HeuristicRouter(router_settings or RouterSettings())
+        self.route_stats = RouteStats()
+        self.sub_question_settings = sub_question_settings or SubQuestionSettings()
+        self.sub_question_stats = SubQuestionStats()
+        self.speculation_settings = speculation_settings or SpeculationSettings()
+        self.speculation_stats = SpeculationStats()
+        self.keyword_indexes = keyword_indexes
+        self.hybrid_settings = hybrid_settings or HybridSettings()
+        self.retrieval_stats = RetrievalStats()
+        self.rerank_settings = rerank_settings or RerankSettings()
+        self.rerank_stats = RerankStats()
+        self.rerank_health = RemoteRerankHealth(
+            budget_s=self.rerank_settings.latency_budget_s,
+            probe_interval_s=self.rerank_settings.probe_interval_s,
+        )
+        self.local_scorer = build_local_scorer(self.rerank_settings.local_model)
+        self.engine_pool: EnginePool[EngineComponents] = EnginePool(
+            self.build_components,
+            max_size=pool_size,
+            ttl_s=pool_ttl_s
+        )
+
+    def get_query_engine(self, uid: str, temperature: float, max_tokens: int,
+                         deadline_s: Optional[float] = None, mode: QueryMode = QueryMode.AUTO,
+                         trace: Optional[RequestTrace] = None):
+        queue = asyncio.Queue(maxsize=self.limits.queue_size)
+        handler = self.ctx_factory.get_event_handler(queue, trace)
+        entry = self.engine_pool.acquire(uid)
+        components = entry.value
 
-    def get_query_engine(self, uid: str, response_llm: OpenAI):
-        queue = asyncio.Queue()
-        service_context = self.ctx_factory.get_service_context(queue)
+        # swap in the per-request parts, everything else is reused
+        components.callback_manager.set_handlers([handler])
+        components.response_llm.temperature = temperature
+        components.response_llm.max_tokens = max_tokens
+        components.agent.reset()
+
+        return QueryEngine(
+            queue=queue,
+            agent=components.agent,
+            on_close=lambda reusable: self.release(entry, reusable),
+            handler=handler,
+            stats=self.stream_stats,
+            deadline_s=self.limits.deadline_for(deadline_s),
+            max_tokens=max_tokens,
+            citation_engine=components.citation_engine,
+            response_llm=components.response_llm,
+            router=self.router,
+            route_stats=self.route_stats,
+            sub_questions=lambda: SubQuestionEngine(
+                citation_engine=components.citation_engine,
+                llm=components.response_llm,
+                embed_model=self.ctx.text_small,
+                settings=self.sub_question_settings,
+                stats=self.sub_question_stats,
+                handler=handler,
+            ),
+            mode=mode,
+            trace=trace,
+            embed_model=self.ctx.text_small,
+            speculation_settings=self.speculation_settings,
+            speculation_stats=self.speculation_stats,
+        )
+
+    def release(self, entry: PooledEntry[EngineComponents], reusable: bool):
+        entry.value.callback_manager.set_handlers([])
+        entry.value.citation_engine.speculation = None
+        self.engine_pool.release(entry, reusable)
+
+    def build_components(self, uid: str) -> EngineComponents:
+        callback_manager = CallbackManager([])
+        service_context = self.ctx_factory.get_service_context(callback_manager)
         index = VectorStoreIndex.from_vector_store(
             vector_store=self.ctx.document_vector_store,
             service_context=service_context
         )
         filters = MetadataFilters(filters=[ExactMatchFilter(key="user", value=uid)])
-        retriever = VectorIndexRetriever(
-            index=index,
-            similarity_top_k=10,
-            filters=filters,
+        # the remote reranker is shared by all engines, so it only runs wrapped and never
+        # gets a per-user callback manager of its own
+        rerank = AdaptiveRerank(
+            remote=self.ctx.cohere_rerank,
+            settings=self.rerank_settings,
+            local_scorer=self.local_scorer,
+            health=self.rerank_health,
+            stats=self.rerank_stats,
+            top_n=self.ctx.cohere_rerank.top_n,
+            skip_score=self.hybrid_settings.skip_rerank_score if self.keyword_indexes else None,
+            callback_manager=callback_manager,
         )
-        response_llm.callback_manager = service_context.callback_manager
-        query_engine = CitationQueryEngine.from_args(
+        if self.keyword_indexes:
+            # exact term matches come from the keyword index, so fewer dense hits are needed
+            retriever = HybridRetriever(
+                dense=VectorIndexRetriever(
+                    index=index,
+                    similarity_top_k=self.hybrid_settings.dense_top_k,
+                    filters=filters,
+                ),
+                keyword_indexes=self.keyword_indexes,
+                uid=uid,
+                stats=self.retrieval_stats,
+                keyword_top_k=self.hybrid_settings.keyword_top_k,
+                top_k=self.hybrid_settings.top_k,
+                dense_cutoff=0.25,
+                callback_manager=callback_manager,
+            )
+            node_postprocessors = [rerank]
+        else:
+            retriever = VectorIndexRetriever(
+                index=index,
+                similarity_top_k=10,
+                filters=filters,
+            )
+            node_postprocessors = [
+                SimilarityPostprocessor(similarity_cutoff=0.25),
+                rerank,
+            ]
+        # engines are per user, their llms share the pooled connections and the openai gate
+        response_llm = providers.share_openai(OpenAI(
+            api_key=self.ctx.openai_api_key,
+            model="gpt-3.5-turbo",
+            callback_manager=callback_manager,
+        ))
+        query_engine = SpeculativeCitationQueryEngine.from_args(
             index=index,  # this is not used
             retriever=retriever,
             response_mode=ResponseMode.COMPACT,  # compacts the chunks and refine
-            node_postprocessors=[
-                SimilarityPostprocessor(similarity_cutoff=0.25),
-                self.ctx.cohere_rerank
-            ],
+            node_postprocessors=node_postprocessors,
             callback_manager=service_context.callback_manager,
             verbose=False,
             use_async=True,
@@ -159,23 +485,13 @@ class QueryEngineFactory:
             ),
         ]
 
-        # SubQueryEngine not sure how to get this to work well yet?
-        # final_synth = get_response_synthesizer(
-        #     response_mode=ResponseMode.COM,
-        #     service_context=service_context
-        # )
-        # subquery_engine = SubQuestionQueryEngine.from_defaults(
-        #     query_engine_tools=query_engine_tools,
-        #     response_synthesizer=final_synth,
-        #     service_context=service_context,
-        #     use_async=True
-        # )
-
-        return QueryEngine(
-            queue=queue,
+        return EngineComponents(
+            callback_manager=callback_manager,
+            response_llm=response_llm,
             agent=OpenAIAgent.from_tools(
                 tools=query_engine_tools,
                 llm=response_llm,
                 verbose=False,
-            )
+            ),
+            citation_engine=query_engine,
         )
@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Tuple
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.callbacks import CBEventType
+from llama_index.callbacks.schema import EventPayload
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle, MetadataMode
+
+from keyword_index import tokenize
+
+# remote calls that outlive their timeout keep running here, they are not cancellable
+_remote_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='rerank')
+
+
+class TermOverlapScorer:
+    """
+    Scores candidates by how many distinct query terms they contain, blended with the
+    retrieval score. Microseconds per node, good enough to order a handful of candidates.
+    """
+
+    def __init__(self, weight: float = 0.5):
+        self.weight = weight
+
+    def __call__(self, query: str, nodes: List[NodeWithScore]) -> List[float]:
+        terms = set(tokenize(query))
+        scores = [node.score or 0.0 for node in nodes]
+        low, high = min(scores), max(scores)
+        spread = (high - low) or 1.0
+        result = []
+        for node, score in zip(nodes, scores):
+            coverage = len(terms & set(tokenize(node.node.get_content(metadata_mode=MetadataMode.NONE)))) \
+                / len(terms) if terms else 0.0
+            result.append(self.weight * coverage + (1 - self.weight) * (score - low) / spread)
+        return result
+
+
+class CrossEncoderScorer:
+    """
+    Local cross-encoder, only used when sentence-transformers is installed and
+    RERANK_LOCAL_MODEL names a model.
+    """
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device='cpu')
+        self._lock = threading.Lock()
+
+    def __call__(self, query: str, nodes: List[NodeWithScore]) -> List[float]:
+        pairs = [(query, node.node.get_content(metadata_mode=MetadataMode.NONE)) for node in nodes]
+        with self._lock:
+            return [float(score) for score in self.model.predict(pairs)]
+
+
+def build_local_scorer(model_name: Optional[str]):
+    if model_name:
+        try:
+            return CrossEncoderScorer(model_name)
+        except Exception as err:
+            logging.warning(f"cross-encoder {model_name} unavailable, using term overlap: {err!r}")
+    return TermOverlapScorer()
+
+
+@dataclass
+class RerankSettings:
+    # skip when the best similarity score leads the next by this much
+    skip_margin: float = 0.15
+    timeout_s: float = 1.5
+    # stop calling the remote reranker while its recent latency is above this
+    latency_budget_s: float = 0.8
+    probe_interval_s: float = 30
+    local_model: Optional[str] = None
+
+    @classmethod
+    def from_env(cls) -> 'RerankSettings':
+        return cls(
+            skip_margin=float(os.getenv('RERANK_SKIP_MARGIN', cls.skip_margin)),
+            timeout_s=float(os.getenv('RERANK_TIMEOUT_S', cls.timeout_s)),
+            latency_budget_s=float(os.getenv('RERANK_LATENCY_BUDGET_S', cls.latency_budget_s)),
+            probe_interval_s=float(os.getenv('RERANK_PROBE_INTERVAL_S', cls.probe_interval_s)),
+            local_model=os.getenv('RERANK_LOCAL_MODEL') or None,
+        )
+
+
+class RemoteRerankHealth:
+    """
+    Tracks an exponential moving average of remote rerank latency. While it is over
+    budget requests go local, except for one probe per interval to notice recovery.
+    """
+
+    def __init__(self, budget_s: float, probe_interval_s: float, alpha: float = 0.3):
+        self.budget_s = budget_s
+        self.probe_interval_s = probe_interval_s
+        self.alpha = alpha
+        self.latency_s: Optional[float] = None
+        self._last_probe = 0.0
+        self._lock = threading.Lock()
+
+    def should_call(self) -> bool:
+        with self._lock:
+            if self.latency_s is None or self.latency_s <= self.budget_s:
+                return True
+            now = time.monotonic()
+            if now - self._last_probe >= self.probe_interval_s:
+                self._last_probe = now
+                return True
+            return False
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._last_probe = time.monotonic()
+            self.latency_s = seconds if self.latency_s is None \
+                else self.alpha * seconds + (1 - self.alpha) * self.latency_s
+
+
+@dataclass
+class RerankStats:
+    skipped: int = 0
+    remote: int = 0
+    local: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    over_budget: int = 0
+    remote_s: float = 0.0
+
+    def to_dict(self, health: RemoteRerankHealth) -> Dict[str, Any]:
+        return {
+            'skipped': self.skipped,
+            'remote': self.remote,
+            'local': self.local,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'over_budget': self.over_budget,
+            'remote_mean_ms': 1000 * self.remote_s / self.remote if self.remote else 0.0,
+            'remote_latency_ewma_ms': 1000 * health.latency_s if health.latency_s is not None else None,
+        }
+
+
+class AdaptiveRerank(BaseNodePostprocessor):
+    """
+    Reranks with the remote reranker only when it can change the answer: with more than
+    `top_n` candidates and no clear winner. With `skip_score` set the scores are fused
+    ranks and a clear winner is one at or above it, otherwise it is one leading the
+    runner-up by the settings' margin. Falls back to a local scorer when the remote
+    call fails, times out, or has recently been slower than the latency budget. Each
+    decision is reported as a RERANKING event with a `rerank` payload.
+    """
+
+    remote: BaseNodePostprocessor = Field(description="Remote reranker, e.g. CohereRerank.")
+    settings: Any = Field(description="RerankSettings.")
+    top_n: int = Field(default=3)
+    skip_score: Optional[float] = Field(default=None, description="Fused score that needs no rerank.")
+    _local: Any = PrivateAttr()
+    _health: RemoteRerankHealth = PrivateAttr()
+    _stats: RerankStats = PrivateAttr()
+
+    def __init__(self, remote: BaseNodePostprocessor, settings: RerankSettings, local_scorer,
+                 health: RemoteRerankHealth, stats: RerankStats, **kwargs: Any):
+        super().__init__(remote=remote, settings=settings, **kwargs)
+        self._local = local_scorer
+        self._health = health
+        self._stats = stats
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'AdaptiveRerank'
+
+    def skip_reason(self, nodes: List[NodeWithScore]) -> Optional[str]:
+        if len(nodes) <= self.top_n:
+            return 'few_candidates'
+        scores = sorted((node.score or 0.0 for node in nodes), reverse=True)
+        if self.skip_score is not None:
+            return 'top_agreement' if scores[0] >= self.skip_score else None
+        return 'score_margin' if scores[0] - scores[1] >= self.settings.skip_margin else None
+
+    def _rerank_remote(self, nodes: List[NodeWithScore], query_bundle: QueryBundle) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        future = _remote_executor.submit(self.remote.postprocess_nodes, nodes, query_bundle)
+        try:
+            result = future.result(timeout=self.settings.timeout_s)
+        finally:
+            # a timeout is recorded as the full timeout so the average reflects it
+            self._health.record(time.perf_counter() - start)
+        self._stats.remote_s += time.perf_counter() - start
+        return result
+
+    async def _arerank_remote(self, nodes: List[NodeWithScore], query_bundle: QueryBundle) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(
+            _remote_executor, self.remote.postprocess_nodes, nodes, query_bundle
+        )
+        try:
+            result = await asyncio.wait_for(future, self.settings.timeout_s)
+        finally:
+            self._health.record(time.perf_counter() - start)
+        self._stats.remote_s += time.perf_counter() - start
+        return result
+
+    def _rerank_local(self, nodes: List[NodeWithScore], query_bundle: QueryBundle) -> List[NodeWithScore]:
+        scores = self._local(query_bundle.query_str, nodes)
+        ranked = sorted(zip(nodes, scores), key=lambda item: item[1], reverse=True)[:self.top_n]
+        return [NodeWithScore(node=node.node, score=score) for node, score in ranked]
+
+    def _decide(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle]) -> Tuple[str, str]:
+        if query_bundle is None:
+            return 'skipped', 'no_query'
+        reason = self.skip_reason(nodes)
+        if reason:
+            return 'skipped', reason
+        if not self._health.should_call():
+            self._stats.over_budget += 1
+            return 'local', 'over_budget'
+        return 'remote', 'reranked'
+
+    def _skipped(self, nodes: List[NodeWithScore], reason: str) -> List[NodeWithScore]:
+        if reason == 'no_query':
+            return nodes[:self.top_n]
+        return sorted(nodes, key=lambda node: node.score or 0.0, reverse=True)[:self.top_n]
+
+    def _failed(self, err: Exception) -> str:
+        if isinstance(err, TimeoutError):
+            self._stats.timeouts += 1
+            logging.warning(f"remote rerank timed out after {self.settings.timeout_s}s, using local scorer")
+            return 'timeout'
+        self._stats.errors += 1
+        logging.warning(f"remote rerank failed, using local scorer: {err!r}")
+        return 'error'
+
+    def _rerank(self, nodes: List[NodeWithScore],
+                query_bundle: Optional[QueryBundle]) -> Tuple[List[NodeWithScore], str, str]:
+        strategy, reason = self._decide(nodes, query_bundle)
+        if strategy == 'skipped':
+            return self._skipped(nodes, reason), strategy, reason
+        if strategy == 'remote':
+            try:
+                return self._rerank_remote(nodes, query_bundle), strategy, reason
+            except Exception as err:
+                reason = self._failed(err)
+        return self._rerank_local(nodes, query_bundle), 'local', reason
+
+    async def _arerank(self, nodes: List[NodeWithScore],
+                       query_bundle: Optional[QueryBundle]) -> Tuple[List[NodeWithScore], str, str]:
+        strategy, reason = self._decide(nodes, query_bundle)
+        if strategy == 'skipped':
+            return self._skipped(nodes, reason), strategy, reason
+        if strategy == 'remote':
+            try:
+                return await self._arerank_remote(nodes, query_bundle), strategy, reason
+            except Exception as err:
+                reason = self._failed(err)
+        # the cross-encoder takes tens of milliseconds of cpu
+        return await asyncio.to_thread(self._rerank_local, nodes, query_bundle), 'local', reason
+
+    def _event(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle]):
+        return self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.QUERY_STR: query_bundle.query_str if query_bundle else None,
+                EventPayload.TOP_K: self.top_n,
+            },
+        )
+
+    def _end_event(self, event, nodes: List[NodeWithScore], result: List[NodeWithScore], strategy: str,
+                   reason: str, start: float):
+        setattr(self._stats, strategy, getattr(self._stats, strategy) + 1)
+        event.on_end(payload={
+            EventPayload.NODES: result,
+            'rerank': {
+                'strategy': strategy,
+                'reason': reason,
+                'candidates': len(nodes),
+                'duration_ms': round(1000 * (time.perf_counter() - start), 2),
+            },
+        })
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        with self._event(nodes, query_bundle) as event:
+            start = time.perf_counter()
+            result, strategy, reason = self._rerank(nodes, query_bundle)
+            self._end_event(event, nodes, result, strategy, reason, start)
+        return result
+
+    async def apostprocess_nodes(self, nodes: List[NodeWithScore],
+                                 query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        """
+        `postprocess_nodes` for callers on the event loop: waits for the remote reranker
+        and runs the local scorer without blocking it.
+        """
+        with self._event(nodes, query_bundle) as event:
+            start = time.perf_counter()
+            result, strategy, reason = await self._arerank(nodes, query_bundle)
+            self._end_event(event, nodes, result, strategy, reason, start)
+        return result
@@ -0,0 +1,138 @@
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import List, Dict, Any
+
+from llama_index.core.llms.types import ChatMessage
+
+
+class Route(str, Enum):
+    # straight to retrieval and one citation prompt
+    DOCUMENTS = 'documents'
+    # straight to the llm, nothing to look up
+    CHAT = 'chat'
+    # decomposed into sub-questions retrieved concurrently
+    SUB_QUESTIONS = 'sub_questions'
+    # the function calling agent decides
+    AGENT = 'agent'
+
+
+@dataclass
+class RouteDecision:
+    route: Route
+    reason: str
+
+
+SMALL_TALK_PHRASES = (
+    r"hi|hello|hey|yo|thanks|thank you|thx|ty|good (morning|afternoon|evening|night)|bye|goodbye|"
+    r"ok|okay|cool|great|nice|awesome|perfect|got it|there|so much|a lot|very much|"
+    r"who are you|what are you|what can you do|how are you( doing)?"
+)
+# the whole message, so a greeting in front of a question does not take it away from retrieval
+SMALL_TALK = re.compile(rf"({SMALL_TALK_PHRASES})( ({SMALL_TALK_PHRASES}))*", re.IGNORECASE)
+WORD = re.compile(r"[\w']+")
+DOCUMENT_CUES = re.compile(
+    r"\b(notes?|documents?|docs?|files?|pdfs?|reports?|papers?|slides?|uploaded|according to|"
+    r"summari[sz]e|find|search|look up|mention(s|ed)?)\b",
+    re.IGNORECASE
+)
+QUESTION = re.compile(
+    r"\?|^\W*(what|who|when|where|why|how|which|is|are|does|do|did|can|could|list|explain|describe|"
+    r"tell me|show|give)\b",
+    re.IGNORECASE
+)
+# references to earlier turns need the conversation to become a standalone query
+FOLLOW_UP = re.compile(
+    r"\b(it|its|that|this|those|these|they|them|above|previous|earlier|again|more|else|"
+    r"you said|your answer|the last)\b",
+    re.IGNORECASE
+)
+MULTI_PART = re.compile(r"\b(compare|comparison|versus|vs\.?|difference between|and also|as well as)\b",
+                        re.IGNORECASE)
+
+
+class QueryMode(str, Enum):
+    AUTO = 'auto'
+    AGENT = 'agent'
+    SUB_QUESTIONS = 'sub_questions'
+
+
+@dataclass
+class RouterSettings:
+    enabled: bool = True
+    max_small_talk_words: int = 8
+    # multi-part questions are decomposed instead of left to the agent
+    sub_questions: bool = True
+
+    @classmethod
+    def from_env(cls) -> 'RouterSettings':
+        return cls(
+            enabled=os.getenv('ROUTER_ENABLED', 'true').lower() == 'true',
+            max_small_talk_words=int(os.getenv('ROUTER_MAX_SMALL_TALK_WORDS', '8')),
+            sub_questions=os.getenv('ROUTER_SUB_QUESTIONS', 'true').lower() == 'true',
+        )
+
+
+class HeuristicRouter:
+    """
+    Picks the cheapest path that can answer a message. Only unambiguous messages leave the
+    agent: short small talk goes to the llm, self-contained single questions go to the
+    citation engine, multi-part questions are decomposed. Follow-ups and anything unclear
+    stay with the agent, which can rewrite the query against the conversation.
+    """
+
+    def __init__(self, settings: RouterSettings):
+        self.settings = settings
+
+    def route(self, message: str, history: List[ChatMessage]) -> RouteDecision:
+        if not self.settings.enabled:
+            return RouteDecision(Route.AGENT, 'disabled')
+        text = message.strip()
+        words = len(text.split())
+        if not text:
+            return RouteDecision(Route.AGENT, 'empty')
+        if words <= self.settings.max_small_talk_words \
+                and SMALL_TALK.fullmatch(' '.join(WORD.findall(text))):
+            return RouteDecision(Route.CHAT, 'small_talk')
+        if MULTI_PART.search(text) or text.count('?') > 1:
+            return RouteDecision(Route.SUB_QUESTIONS if self.settings.sub_questions else Route.AGENT, 'multi_part')
+        if history and FOLLOW_UP.search(text):
+            return RouteDecision(Route.AGENT, 'follow_up')
+        if QUESTION.search(text) or DOCUMENT_CUES.search(text):
+            return RouteDecision(Route.DOCUMENTS, 'document_question')
+        return RouteDecision(Route.AGENT, 'unclear')
+
+
+@dataclass
+class RouteStats:
+    counts: Dict[str, int] = field(default_factory=lambda: {route.value: 0 for route in Route})
+    first_token_s: Dict[str, float] = field(default_factory=lambda: {route.value: 0.0 for route in Route})
+    first_tokens: Dict[str, int] = field(default_factory=lambda: {route.value: 0 for route in Route})
+    fallbacks: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, route: Route):
+        with self._lock:
+            self.counts[route.value] += 1
+
+    def record_first_token(self, route: Route, elapsed_s: float):
+        with self._lock:
+            self.first_token_s[route.value] += elapsed_s
+            self.first_tokens[route.value] += 1
+
+    def record_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'counts': dict(self.counts),
+                'fallbacks': self.fallbacks,
+                'first_token_mean_ms': {
+                    route: 1000 * self.first_token_s[route] / count if count else None
+                    for route, count in self.first_tokens.items()
+                },
+            }
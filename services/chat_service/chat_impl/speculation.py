@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any
+
+from llama_index.callbacks import CBEventType
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.query_engine import CitationQueryEngine
+from llama_index.schema import NodeWithScore, QueryBundle
+
+from chat_impl.answer_cache import cosine_similarity
+from chat_impl.rerank import AdaptiveRerank
+from keyword_index import tokenize
+from metrics import metrics
+
+SPECULATIONS = metrics.counter('chat_speculative_retrievals_total', 'Speculative retrievals by outcome',
+                               labels=('outcome',))
+SAVED_SECONDS = metrics.histogram('chat_speculation_saved_seconds',
+                                  'Retrieval time a speculative hit took off the tool call')
+
+
+@dataclass
+class SpeculationSettings:
+    enabled: bool = True
+    # cosine similarity of the tool query to the message that still reuses the retrieval
+    similarity: float = 0.9
+
+    @classmethod
+    def from_env(cls) -> 'SpeculationSettings':
+        return cls(
+            enabled=os.getenv('SPECULATIVE_RETRIEVAL_ENABLED', 'true').lower() == 'true',
+            similarity=float(os.getenv('SPECULATIVE_RETRIEVAL_SIMILARITY', cls.similarity)),
+        )
+
+
+class SpeculationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outcomes = {'hit': 0, 'miss': 0, 'unused': 0, 'failed': 0}
+        self.saved_s = 0.0
+        self.wasted_s = 0.0
+
+    def record(self, outcome: str, saved_s: float = 0.0, wasted_s: float = 0.0):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            self.saved_s += saved_s
+            self.wasted_s += wasted_s
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            started = sum(self.outcomes.values())
+            return {
+                **self.outcomes,
+                'hit_rate': self.outcomes['hit'] / started if started else 0.0,
+                'saved_mean_ms': 1000 * self.saved_s / self.outcomes['hit'] if self.outcomes['hit'] else 0.0,
+                # retrievals that were discarded or never asked for
+                'wasted_ms': 1000 * self.wasted_s,
+            }
+
+
+def _normalize(text: str) -> str:
+    return ' '.join(tokenize(text))
+
+
+class SpeculativeCitationQueryEngine(CitationQueryEngine):
+    """
+    Citation engine whose retrievals first ask the speculation of the current request,
+    set per request like the callback handlers.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.speculation: Optional['SpeculativeRetrieval'] = None
+
+    async def aretrieve_direct(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # CitationQueryEngine.aretrieve runs the postprocessors on the loop, and with them a
+        # remote rerank of up to its timeout
+        nodes = await self._retriever.aretrieve(query_bundle)
+        for postprocessor in self._node_postprocessors:
+            if isinstance(postprocessor, AdaptiveRerank):
+                nodes = await postprocessor.apostprocess_nodes(nodes, query_bundle)
+            else:
+                # score cutoffs, microseconds
+                nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        return nodes
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        speculation = self.speculation
+        if speculation is not None:
+            nodes = await speculation.take(query_bundle)
+            if nodes is not None:
+                return nodes
+        return await self.aretrieve_direct(query_bundle)
+
+
+class SpeculativeRetrieval:
+    """
+    Retrieval for the user's message, embedded, retrieved and reranked as soon as the
+    request arrives, while the agent's llm is still deciding to call the document tool.
+    The first retrieval of the request takes it when its query is the message or embeds
+    within `similarity` of it, and retrieves on its own otherwise, reusing the query
+    embedding computed for the comparison. Reported as a RETRIEVE task event with a
+    `speculation` payload: the outcome, the similarity and the latency saved.
+    """
+
+    def __init__(self, engine: SpeculativeCitationQueryEngine, embed_model: BaseEmbedding, message: str,
+                 settings: SpeculationSettings, stats: SpeculationStats, handler=None, parent_id: str = ''):
+        self.engine = engine
+        self.embed_model = embed_model
+        self.message = message
+        self.settings = settings
+        self.stats = stats
+        self.handler = handler
+        self.parent_id = parent_id
+        self.event_id = str(uuid.uuid4())
+        self.embedding: Optional[asyncio.Future] = None
+        self.task: Optional[asyncio.Task] = None
+        self.retrieve_s: Optional[float] = None
+        self._claimed = False
+        self._finished = False
+
+    def start(self) -> 'SpeculativeRetrieval':
+        if self.handler:
+            self.handler.on_event_start(CBEventType.RETRIEVE, event_id=self.event_id, parent_id=self.parent_id)
+        self.embedding = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    async def _run(self) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        try:
+            embedding = await self.embed_model.aget_query_embedding(self.message)
+        except asyncio.CancelledError:
+            self.embedding.cancel()
+            raise
+        except Exception as err:
+            self.embedding.set_exception(err)
+            raise
+        self.embedding.set_result(embedding)
+        nodes = await self.engine.aretrieve_direct(QueryBundle(self.message, embedding=embedding))
+        self.retrieve_s = time.perf_counter() - start
+        return nodes
+
+    async def similarity(self, query_bundle: QueryBundle) -> float:
+        if _normalize(query_bundle.query_str) == _normalize(self.message):
+            return 1.0
+        message_embedding = await asyncio.shield(self.embedding)
+        if query_bundle.embedding is None:
+            query_bundle.embedding = await self.embed_model.aget_query_embedding(query_bundle.query_str)
+        return cosine_similarity(message_embedding, query_bundle.embedding)
+
+    async def take(self, query_bundle: QueryBundle) -> Optional[List[NodeWithScore]]:
+        """
+        The speculative nodes when they answer `query_bundle`, None when the caller should
+        retrieve itself. Only the first retrieval of a request is considered.
+        """
+        if self._claimed or self.task is None:
+            return None
+        self._claimed = True
+        try:
+            similarity = await self.similarity(query_bundle)
+        except Exception as err:
+            logging.warning(f"speculative retrieval failed: {err!r}")
+            self._finish('failed')
+            return None
+        if similarity < self.settings.similarity:
+            self._finish('miss', similarity)
+            return None
+        waited = time.perf_counter()
+        try:
+            nodes = await asyncio.shield(self.task)
+        except Exception as err:
+            logging.warning(f"speculative retrieval failed: {err!r}")
+            self._finish('failed', similarity)
+            return None
+        waited_s = time.perf_counter() - waited
+        # the tool would have spent the whole retrieval, it only waited for what was left
+        self._finish('hit', similarity, saved_s=max(0.0, self.retrieve_s - waited_s))
+        return nodes
+
+    def close(self):
+        """
+        Ends the speculation at the end of the request, if nothing took it.
+        """
+        if self.task is not None:
+            self._finish('unused')
+
+    def _finish(self, outcome: str, similarity: Optional[float] = None, saved_s: float = 0.0):
+        if self._finished:
+            return
+        self._finished = True
+        for future in (self.embedding, self.task):
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                # a failure nobody awaited would be logged as never retrieved
+                future.exception()
+        wasted_s = 0.0 if outcome == 'hit' else (self.retrieve_s or 0.0)
+        self.stats.record(outcome, saved_s=saved_s, wasted_s=wasted_s)
+        SPECULATIONS.labels(outcome).inc()
+        if outcome == 'hit':
+            SAVED_SECONDS.labels().observe(saved_s)
+        if self.handler:
+            self.handler.on_event_end(CBEventType.RETRIEVE, payload={'speculation': {
+                'outcome': outcome,
+                'similarity': similarity,
+                'retrieve_ms': 1000 * self.retrieve_s if self.retrieve_s is not None else None,
+                'saved_ms': 1000 * saved_s,
+            }}, event_id=self.event_id)
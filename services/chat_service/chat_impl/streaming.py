@@ -0,0 +1,213 @@
+import asyncio
+import json
+from dataclasses import replace
+from enum import Enum
+from typing import List, Optional, Dict, Any, AsyncIterator
+
+from llama_index.callbacks import CBEventType
+from llama_index.schema import NodeWithScore
+from pydantic import BaseModel
+
+from chat_impl.chat_agent import AgentEvent, AgentEventType, TaskEvent
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value, default=str).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+class ChatAgentTask(BaseModel):
+    completed: bool
+    event_type: str
+    event_id: str
+    parent_id: str
+    duration_s: float
+    metrics: Dict[str, Any] | None = None
+
+
+class ChatAgentSources(BaseModel):
+    score: float | None
+    text: str
+    metadata: Dict[str, Any]
+
+
+class ChatResponseChunk(BaseModel):
+    """
+    Layout of one NDJSON line of /chat. In compact mode null and empty fields are left out.
+    """
+    id: str
+    event_type: str
+    task: ChatAgentTask | None
+    error: str | None
+    response_chunk: str
+    sources: List[ChatAgentSources]
+
+
+class Verbosity(str, Enum):
+    FULL = 'full'
+    # the steps a user recognizes, llm calls and templating are folded into their parents
+    SUMMARY = 'summary'
+    NONE = 'none'
+
+
+SUMMARY_EVENTS = {
+    CBEventType.AGENT_STEP, CBEventType.FUNCTION_CALL, CBEventType.QUERY, CBEventType.SUB_QUESTION,
+    CBEventType.RETRIEVE, CBEventType.RERANKING, CBEventType.EXCEPTION,
+}
+
+
+class TaskFilter:
+    """
+    Drops task events below the requested verbosity. Kept tasks are re-parented to their
+    closest kept ancestor so the client can still build the progress tree.
+    """
+
+    def __init__(self, verbosity: Verbosity):
+        self.verbosity = verbosity
+        self._parents: Dict[str, str] = {}
+
+    def __call__(self, event: AgentEvent) -> Optional[AgentEvent]:
+        task = event.task
+        if task is None or self.verbosity == Verbosity.FULL:
+            return event
+        if self.verbosity == Verbosity.NONE:
+            return None
+        parent_id = self._parents.get(task.parent_id, task.parent_id)
+        if task.event_type not in SUMMARY_EVENTS:
+            self._parents[task.event_id] = parent_id
+            return None
+        if parent_id == task.parent_id:
+            return event
+        return replace(event, task=replace(task, parent_id=parent_id))
+
+
+async def coalesce_tokens(events: AsyncIterator[AgentEvent], window_s: float,
+                          max_chars: int) -> AsyncIterator[AgentEvent]:
+    """
+    Merges consecutive RESPONSE_STREAM events until `window_s` passed since the first
+    buffered token, `max_chars` are buffered or any other event arrives.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    buffer: List[str] = []
+    size, deadline = 0, None
+
+    def flush() -> AgentEvent:
+        nonlocal size, deadline
+        chunk = ''.join(buffer)
+        buffer.clear()
+        size, deadline = 0, None
+        return AgentEvent(type=AgentEventType.RESPONSE_STREAM, task=None, error=None,
+                          response_chunk=chunk, sources=[])
+
+    try:
+        while True:
+            if pending is None:
+                # the pending read survives a window timeout, cancelling it would end the stream
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield flush()
+                continue
+            read, pending = pending, None
+            try:
+                event = read.result()
+            except StopAsyncIteration:
+                if buffer:
+                    yield flush()
+                return
+
+            if event.type == AgentEventType.RESPONSE_STREAM and event.task is None and not event.sources:
+                if not buffer:
+                    deadline = loop.time() + window_s
+                buffer.append(event.response_chunk)
+                size += len(event.response_chunk)
+                if size >= max_chars:
+                    yield flush()
+                continue
+            if buffer:
+                yield flush()
+            yield event
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def llm_deltas(stream) -> AsyncIterator[str]:
+    async for chunk in stream:
+        if chunk.delta:
+            yield chunk.delta
+
+
+class ChunkEncoder:
+    """
+    Serializes agent events into ChatResponseChunk lines. The response id and the field
+    layout are fixed for a response, so lines are joined from precomputed pieces and only
+    the changing values are serialized. Token events take a dedicated path.
+    """
+
+    def __init__(self, response_id: str, compact: bool = False):
+        self.compact = compact
+        self._prefix = '{"id":' + dumps(response_id) + ',"event_type":"'
+        if compact:
+            self._stream_prefix = self._prefix + AgentEventType.RESPONSE_STREAM.value + '","response_chunk":'
+            self._stream_suffix = '}\n'
+        else:
+            self._stream_prefix = self._prefix + AgentEventType.RESPONSE_STREAM.value + \
+                '","task":null,"error":null,"response_chunk":'
+            self._stream_suffix = ',"sources":[]}\n'
+
+    def _task(self, task: TaskEvent) -> Dict[str, Any]:
+        encoded = {
+            'completed': task.completed,
+            'event_type': task.event_type.value if isinstance(task.event_type, Enum) else task.event_type,
+            'event_id': task.event_id,
+            'parent_id': task.parent_id,
+            'duration_s': float(task.duration_s),
+        }
+        if task.metrics is not None or not self.compact:
+            encoded['metrics'] = task.metrics
+        return encoded
+
+    @staticmethod
+    def _sources(sources: List[NodeWithScore]) -> List[Dict[str, Any]]:
+        return [
+            {'score': source.score, 'text': source.text, 'metadata': source.metadata}
+            for source in sources
+            if isinstance(source, NodeWithScore)
+        ]
+
+    def encode(self, event: AgentEvent) -> str:
+        if event.type == AgentEventType.RESPONSE_STREAM and event.task is None and not event.sources \
+                and event.error is None:
+            return self._stream_prefix + dumps(event.response_chunk) + self._stream_suffix
+
+        task = self._task(event.task) if event.task else None
+        sources = self._sources(event.sources)
+        parts = [self._prefix, event.type.value, '"']
+        if not self.compact:
+            parts += [
+                ',"task":', dumps(task),
+                ',"error":', dumps(event.error),
+                ',"response_chunk":', dumps(event.response_chunk),
+                ',"sources":', dumps(sources),
+            ]
+        else:
+            if task is not None:
+                parts += [',"task":', dumps(task)]
+            if event.error is not None:
+                parts += [',"error":', dumps(event.error)]
+            if event.response_chunk:
+                parts += [',"response_chunk":', dumps(event.response_chunk)]
+            if sources:
+                parts += [',"sources":', dumps(sources)]
+        parts.append('}\n')
+        return ''.join(parts)
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator
+
+from llama_index.callbacks import CBEventType
+from llama_index.core.llms.types import ChatMessage, MessageRole
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms import LLM
+from llama_index.query_engine import CitationQueryEngine
+from llama_index.query_engine.citation_query_engine import CITATION_QA_TEMPLATE
+from llama_index.schema import NodeWithScore, QueryBundle
+
+from chat_impl.streaming import llm_deltas
+
+DECOMPOSE_PROMPT = """\
+Split the user's last message into at most {max_questions} standalone search questions over \
+their personal documents, one per distinct thing it asks about. Resolve references to the \
+conversation so every question makes sense on its own. A message that asks one thing gets \
+one question. Answer with a JSON list of strings only.
+
+Conversation:
+{history}
+
+Message: {message}
+
+Questions:"""
+
+
+@dataclass
+class SubQuestionSettings:
+    max_questions: int = 4
+    # retrievals in flight per request
+    concurrency: int = 3
+    # nodes the final answer is written from, over all sub-questions
+    max_context_nodes: int = 8
+
+    @classmethod
+    def from_env(cls) -> 'SubQuestionSettings':
+        return cls(
+            max_questions=int(os.getenv('SUB_QUESTION_MAX', '4')),
+            concurrency=int(os.getenv('SUB_QUESTION_CONCURRENCY', '3')),
+            max_context_nodes=int(os.getenv('SUB_QUESTION_CONTEXT_NODES', '8')),
+        )
+
+
+class SubQuestionStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.sub_questions = 0
+        self.duplicates = 0
+        self.shared_nodes = 0
+        self.decompose_failures = 0
+        self.retrieval_s = 0.0
+        self.fan_out_s = 0.0
+
+    def record(self, sub_questions: int, duplicates: int, shared_nodes: int, retrieval_s: float, fan_out_s: float):
+        with self._lock:
+            self.requests += 1
+            self.sub_questions += sub_questions
+            self.duplicates += duplicates
+            self.shared_nodes += shared_nodes
+            self.retrieval_s += retrieval_s
+            self.fan_out_s += fan_out_s
+
+    def record_decompose_failure(self):
+        with self._lock:
+            self.decompose_failures += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'sub_questions': self.sub_questions,
+                'duplicates': self.duplicates,
+                'shared_nodes': self.shared_nodes,
+                'decompose_failures': self.decompose_failures,
+                # sequential retrieval time over the wall time of the concurrent fan out
+                'parallel_speedup': self.retrieval_s / self.fan_out_s if self.fan_out_s else None,
+            }
+
+
+def parse_questions(text: str, max_questions: int) -> List[str]:
+    match = re.search(r'\[.*]', text, re.DOTALL)
+    if not match:
+        return []
+    try:
+        questions = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return []
+    return [question.strip() for question in questions if isinstance(question, str) and question.strip()][
+           :max_questions]
+
+
+def _normalize(question: str) -> str:
+    return ' '.join(re.findall(r'\w+', question.lower()))
+
+
+class SubQuestionEngine:
+    """
+    Answers multi-part messages by retrieving for each part separately. Sub-questions are
+    embedded and retrieved concurrently, at most `concurrency` at a time, through the
+    citation engine so they get the same hybrid retrieval and reranking as single
+    questions. Identical sub-questions are retrieved once, and a node found by several
+    sub-questions is cited once. One streamed citation prompt answers over the merged
+    sources. Each sub-question is reported as a SUB_QUESTION task event.
+    """
+
+    def __init__(self, citation_engine: CitationQueryEngine, llm: LLM, embed_model: BaseEmbedding,
+                 settings: Optional[SubQuestionSettings] = None, stats: Optional[SubQuestionStats] = None,
+                 handler=None):
+        self.citation_engine = citation_engine
+        self.llm = llm
+        self.embed_model = embed_model
+        self.settings = settings or SubQuestionSettings()
+        self.stats = stats or SubQuestionStats()
+        self.handler = handler
+
+    async def decompose(self, history: List[ChatMessage], message: str) -> List[str]:
+        prompt = DECOMPOSE_PROMPT.format(
+            max_questions=self.settings.max_questions,
+            history='\n'.join(f'{turn.role.value}: {turn.content}' for turn in history[-6:]) or '(none)',
+            message=message,
+        )
+        try:
+            response = await self.llm.achat([ChatMessage(role=MessageRole.USER, content=prompt)], temperature=0)
+            questions = parse_questions(response.message.content or '', self.settings.max_questions)
+        except Exception as err:
+            logging.warning(f"sub-question decomposition failed: {err!r}")
+            questions = []
+        if not questions:
+            self.stats.record_decompose_failure()
+            return [message]
+        return questions
+
+    async def _retrieve(self, question: str, semaphore: asyncio.Semaphore,
+                        parent_id: str) -> Tuple[List[NodeWithScore], float]:
+        event_id = str(uuid.uuid4())
+        async with semaphore:
+            if self.handler:
+                self.handler.on_event_start(CBEventType.SUB_QUESTION, event_id=event_id, parent_id=parent_id)
+            start = time.perf_counter()
+            nodes: List[NodeWithScore] = []
+            try:
+                embedding = await self.embed_model.aget_query_embedding(question)
+                nodes = await self.citation_engine.aretrieve(QueryBundle(question, embedding=embedding))
+            except Exception as err:
+                # the other parts can still be answered
+                logging.warning(f"sub-question retrieval failed: {err!r}")
+            finally:
+                elapsed_s = time.perf_counter() - start
+                if self.handler:
+                    self.handler.on_event_end(CBEventType.SUB_QUESTION, payload={'sub_question': {
+                        'question': question,
+                        'nodes': len(nodes),
+                        'duration_ms': 1000 * elapsed_s,
+                    }}, event_id=event_id)
+            return nodes, elapsed_s
+
+    async def retrieve(self, questions: List[str], parent_id: str) -> Tuple[List[NodeWithScore], Dict[str, int]]:
+        unique: Dict[str, str] = {}
+        for question in questions:
+            unique.setdefault(_normalize(question), question)
+        semaphore = asyncio.Semaphore(self.settings.concurrency)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            self._retrieve(question, semaphore, parent_id) for question in unique.values()
+        ))
+        fan_out_s = time.perf_counter() - start
+
+        # round robin over the sub-questions so every part keeps its best sources
+        merged: Dict[str, NodeWithScore] = {}
+        hits: Dict[str, int] = {}
+        rankings = [nodes for nodes, _ in results]
+        for nodes in rankings:
+            for node in nodes:
+                hits[node.node.node_id] = hits.get(node.node.node_id, 0) + 1
+        for rank in range(max((len(nodes) for nodes in rankings), default=0)):
+            for nodes in rankings:
+                if rank < len(nodes) and nodes[rank].node.node_id not in merged \
+                        and len(merged) < self.settings.max_context_nodes:
+                    merged[nodes[rank].node.node_id] = nodes[rank]
+
+        counts = {
+            'sub_questions': len(unique),
+            'duplicates': len(questions) - len(unique),
+            'shared_nodes': sum(1 for count in hits.values() if count > 1),
+        }
+        self.stats.record(
+            counts['sub_questions'], counts['duplicates'], counts['shared_nodes'],
+            retrieval_s=sum(elapsed_s for _, elapsed_s in results), fan_out_s=fan_out_s,
+        )
+        return list(merged.values()), counts
+
+    async def answer(self, history: List[ChatMessage], message: str, parent_id: str) \
+            -> Tuple[Optional[List[NodeWithScore]], Optional[AsyncIterator[str]]]:
+        questions = await self.decompose(history, message)
+        nodes, _ = await self.retrieve(questions, parent_id)
+        if not nodes:
+            return None, None
+        nodes = self.citation_engine._create_citation_nodes(nodes)
+        query = message if len(questions) == 1 else \
+            message + '\n\nCover each of these parts:\n' + '\n'.join(f'- {question}' for question in questions)
+        prompt = CITATION_QA_TEMPLATE.format(
+            context_str='\n\n'.join(node.node.get_content() for node in nodes),
+            query_str=query,
+        )
+        stream = await self.llm.astream_chat([ChatMessage(role=MessageRole.USER, content=prompt)])
+        return nodes, llm_deltas(stream)
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from local_vector_store import LocalVectorStore
+from vector_sharding import ShardedVectorStore
+
+# pinecone caps top_k at 1000 when values are included
+MAX_WARM_VECTORS = 1000
+
+
+@dataclass
+class HotTierStats:
+    hits: int = 0
+    misses: int = 0
+    warms: int = 0
+    too_large: int = 0
+    failures: int = 0
+    evictions: int = 0
+
+
+class TieredVectorStore(BasePydanticVectorStore):
+    """
+    Serves queries of recently active users from an in-memory LocalVectorStore and
+    everyone else from Pinecone. A user's first query goes to Pinecone and copies all of
+    their vectors into the hot tier in the background. Users with more vectors than one
+    Pinecone query returns stay cold. Writes go to Pinecone only.
+    """
+
+    stores_text: bool = True
+
+    _hot: LocalVectorStore = PrivateAttr()
+    _cold: BasePydanticVectorStore = PrivateAttr()
+    _max_users: int = PrivateAttr()
+    _partition_key: str = PrivateAttr()
+    _warm: OrderedDict = PrivateAttr()
+    _too_large: set = PrivateAttr()
+    _warming: set = PrivateAttr()
+    _generations: Dict[str, int] = PrivateAttr()
+    _executor: ThreadPoolExecutor = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    _stats: HotTierStats = PrivateAttr()
+
+    def __init__(self, cold: BasePydanticVectorStore, max_users: int = 64, partition_key: str = 'user',
+                 **kwargs: Any):
+        super().__init__(**kwargs)
+        self._hot = LocalVectorStore(partition_key=partition_key)
+        self._cold = cold
+        self._max_users = max_users
+        self._partition_key = partition_key
+        self._warm = OrderedDict()
+        self._too_large = set()
+        self._warming = set()
+        self._generations = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='hot-tier')
+        self._lock = threading.Lock()
+        self._stats = HotTierStats()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'TieredVectorStore'
+
+    @property
+    def client(self) -> Any:
+        return self._cold.client
+
+    def _uid(self, query: VectorStoreQuery) -> Optional[str]:
+        for metadata_filter in (query.filters.filters if query.filters else []):
+            if metadata_filter.key == self._partition_key:
+                return str(metadata_filter.value)
+        return None
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        uid = self._uid(query)
+        with self._lock:
+            generation = self._generations.get(uid, 0)
+            hot = uid in self._warm
+            if hot:
+                self._warm.move_to_end(uid)
+        if hot:
+            result = self._hot.query(query, **kwargs)
+            with self._lock:
+                # the partition may have been dropped while it was being queried
+                if uid in self._warm and self._generations.get(uid, 0) == generation:
+                    self._stats.hits += 1
+                    return result
+
+        with self._lock:
+            self._stats.misses += 1
+            warm = uid is not None and query.query_embedding is not None \
+                and uid not in self._warm and uid not in self._warming and uid not in self._too_large
+            if warm:
+                self._warming.add(uid)
+        if warm:
+            self._executor.submit(self._load, uid, query.query_embedding, generation)
+        return self._cold.query(query, **kwargs)
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        # misses query pinecone through its blocking client
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+    def _load(self, uid: str, embedding: List[float], generation: int):
+        try:
+            cold = self._cold.shard(uid) if isinstance(self._cold, ShardedVectorStore) else self._cold
+            # any vector works as the query, the filter selects every vector of the user
+            response = cold.client.query(
+                vector=embedding,
+                top_k=MAX_WARM_VECTORS,
+                filter={self._partition_key: uid},
+                include_values=True,
+                include_metadata=True,
+                namespace=cold.namespace,
+            )
+            matches = response.matches
+            if len(matches) >= MAX_WARM_VECTORS:
+                with self._lock:
+                    self._too_large.add(uid)
+                    self._stats.too_large += 1
+                return
+            nodes = []
+            for match in matches:
+                node = metadata_dict_to_node(match.metadata)
+                node.id_ = match.id
+                node.embedding = match.values
+                nodes.append(node)
+
+            with self._lock:
+                if self._generations.get(uid, 0) != generation:
+                    # new documents arrived while loading, the next query loads again
+                    return
+                self._hot.invalidate(uid)
+                self._hot.add(nodes)
+                self._warm[uid] = True
+                self._stats.warms += 1
+                while len(self._warm) > self._max_users:
+                    evicted, _ = self._warm.popitem(last=False)
+                    self._hot.invalidate(evicted)
+                    self._stats.evictions += 1
+        except Exception as err:
+            logging.warning(f"failed to load vectors of {uid} into the hot tier: {err!r}")
+            with self._lock:
+                self._stats.failures += 1
+        finally:
+            with self._lock:
+                self._warming.discard(uid)
+
+    def invalidate(self, uid: str):
+        with self._lock:
+            self._generations[uid] = self._generations.get(uid, 0) + 1
+            self._warm.pop(uid, None)
+            self._too_large.discard(uid)
+            self._hot.invalidate(uid)
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        ids = self._cold.add(nodes, **add_kwargs)
+        for uid in {str(node.metadata.get(self._partition_key, '')) for node in nodes}:
+            self.invalidate(uid)
+        return ids
+
+    def delete(self, ref_doc_id: str, uid: Optional[str] = None, **delete_kwargs: Any) -> None:
+        if isinstance(self._cold, ShardedVectorStore):
+            self._cold.delete(ref_doc_id, uid=uid, **delete_kwargs)
+        else:
+            self._cold.delete(ref_doc_id, **delete_kwargs)
+        if uid is not None:
+            self.invalidate(uid)
+            return
+        with self._lock:
+            uids = list(self._warm)
+        for uid in uids:
+            self.invalidate(uid)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                'backend': 'tiered',
+                'hot_users': len(self._warm),
+                'max_hot_users': self._max_users,
+                'hits': self._stats.hits,
+                'misses': self._stats.misses,
+                'hit_rate': self._stats.hits / max(1, self._stats.hits + self._stats.misses),
+                'warms': self._stats.warms,
+                'too_large': self._stats.too_large,
+                'failures': self._stats.failures,
+                'evictions': self._stats.evictions,
+            }
+        return {**stats, 'hot': self._hot.get_stats()}
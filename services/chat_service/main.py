@@ -1,3 +1,6 @@
+# first, so the startup report measures from close to process start
+from startup import lifespan, startup_router
+
 import logging
 
 from dotenv import load_dotenv
@@ -8,13 +11,12 @@ load_dotenv()
 
 
 def create_app():
-    from chat_impl.main import chat_router
-
     logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
                         datefmt='%Y-%m-%d:%H:%M:%S',
                         level=logging.INFO)
 
-    fastapi = FastAPI()
+    # chat_impl.main and the clients behind it load in the lifespan, see startup.lifespan
+    fastapi = FastAPI(lifespan=lifespan('chat_impl.main', ('chat_router', 'metrics_router')))
     fastapi.add_middleware(
         CORSMiddleware,
         allow_origins=['*'],
@@ -22,7 +24,7 @@ def create_app():
         allow_methods=["*"],
         allow_headers=["*"],
     )
-    fastapi.include_router(chat_router)
+    fastapi.include_router(startup_router)
     return fastapi
 
 
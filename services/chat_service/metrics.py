@@ -0,0 +1,292 @@
+import bisect
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Tuple, Callable, Optional, List, Any, Sequence, Union
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# background work measured in minutes, e.g. ingest jobs up to the partition timeout
+JOB_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+LabelValues = Tuple[str, ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q: float, counts: List[int], count: int) -> Optional[float]:
+        # upper bound of the bucket holding the quantile, coarse but free to compute. Past the
+        # last bucket it is the last bound, json has no infinity
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1] if self.buckets else None
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class MetricFamily:
+    def __init__(self, name: str, help_text: str, kind: str, label_names: Sequence[str], factory: Callable):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self._factory = factory
+        self._children: Dict[LabelValues, Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> Any:
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def children(self) -> List[Tuple[LabelValues, Any]]:
+        with self._lock:
+            return list(self._children.items())
+
+
+class GaugeFamily:
+    """
+    Read when the metrics are collected, so nothing is recorded on the hot path. `read`
+    returns one value, or a value per tuple of label values.
+    """
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], Union[float, Dict[LabelValues, float]]],
+                 label_names: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.kind = 'gauge'
+        self.label_names = tuple(label_names)
+        self.read = read
+
+    def values(self) -> List[Tuple[LabelValues, float]]:
+        value = self.read()
+        if isinstance(value, dict):
+            return [(labels, float(v)) for labels, v in value.items() if v is not None]
+        return [((), float(value))] if value is not None else []
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families: OrderedDict[str, Union[MetricFamily, GaugeFamily]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _register(self, name: str, build: Callable[[], Union[MetricFamily, GaugeFamily]]):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = build()
+            return family
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> MetricFamily:
+        return self._register(name, lambda: MetricFamily(name, help_text, 'histogram', labels,
+                                                         lambda: Histogram(buckets)))
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> MetricFamily:
+        return self._register(name, lambda: MetricFamily(name, help_text, 'counter', labels, Counter))
+
+    def gauge(self, name: str, help_text: str, read: Callable, labels: Sequence[str] = ()) -> GaugeFamily:
+        # registering a gauge again replaces how it is read
+        family = GaugeFamily(name, help_text, read, labels)
+        with self._lock:
+            self._families[name] = family
+        return family
+
+    def families(self) -> List[Union[MetricFamily, GaugeFamily]]:
+        with self._lock:
+            return list(self._families.values())
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format.
+        """
+        lines = []
+        for family in self.families():
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            if isinstance(family, GaugeFamily):
+                try:
+                    values = family.values()
+                except Exception as err:
+                    lines.append(f'# {family.name} unavailable: {err!r}')
+                    continue
+                for labels, value in values:
+                    lines.append(f'{family.name}{_labels(family.label_names, labels)} {_number(value)}')
+                continue
+            for labels, child in family.children():
+                if family.kind == 'counter':
+                    lines.append(f'{family.name}{_labels(family.label_names, labels)} {_number(child.value)}')
+                    continue
+                counts, total, count = child.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip((*child.buckets, float('inf')), counts):
+                    cumulative += bucket_count
+                    le = 'le="' + _number(bound) + '"'
+                    lines.append(f'{family.name}_bucket{_labels(family.label_names, labels, le)} {cumulative}')
+                lines.append(f'{family.name}_sum{_labels(family.label_names, labels)} {_number(total)}')
+                lines.append(f'{family.name}_count{_labels(family.label_names, labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {}
+        for family in self.families():
+            entries = []
+            if isinstance(family, GaugeFamily):
+                try:
+                    values = family.values()
+                except Exception:
+                    values = []
+                entries = [{'labels': dict(zip(family.label_names, labels)), 'value': value}
+                           for labels, value in values]
+            else:
+                for labels, child in family.children():
+                    entry: Dict[str, Any] = {'labels': dict(zip(family.label_names, labels))}
+                    if family.kind == 'counter':
+                        entry['value'] = child.value
+                    else:
+                        counts, total, count = child.snapshot()
+                        entry.update({
+                            'count': count,
+                            'mean': total / count if count else None,
+                            'p50': child.quantile(0.5, counts, count),
+                            'p95': child.quantile(0.95, counts, count),
+                            'p99': child.quantile(0.99, counts, count),
+                        })
+                    entries.append(entry)
+            result[family.name] = {'type': family.kind, 'values': entries}
+        return result
+
+
+# the registry of the process, modules register their metrics when they are imported
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def timed(histogram: Histogram):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+class RequestTrace:
+    """
+    Spans of one request, offsets are relative to its start.
+    """
+
+    def __init__(self, trace_id: str, uid: str, kind: str):
+        self.trace_id = trace_id
+        self.uid = uid
+        self.kind = kind
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_s: Optional[float] = None
+        self.attributes: Dict[str, Any] = {}
+        self.spans: List[Dict[str, Any]] = []
+
+    def span(self, name: str, started: float, duration_s: float, **attributes: Any):
+        """
+        `started` is a time.perf_counter() reading.
+        """
+        self.spans.append({
+            'name': name,
+            'offset_ms': 1000 * (started - self._start),
+            'duration_ms': 1000 * duration_s,
+            **attributes,
+        })
+
+    def finish(self):
+        if self.duration_s is None:
+            self.duration_s = time.perf_counter() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'started_at': self.started_at,
+            'duration_ms': 1000 * self.duration_s if self.duration_s is not None else None,
+            'attributes': self.attributes,
+            'spans': sorted(self.spans, key=lambda span: span['offset_ms']),
+        }
+
+
+class TraceStore:
+    """
+    Keeps the traces of requests that asked for one, plus a sample of the others, for
+    export as JSON. Bounded to the most recent `max_traces`.
+    """
+
+    def __init__(self, max_traces: int = 256, sample_rate: float = 0.0):
+        self.max_traces = max_traces
+        self.sample_rate = sample_rate
+        self._traces: OrderedDict[str, RequestTrace] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, trace_id: str, uid: str, kind: str, requested: bool = False) -> Optional[RequestTrace]:
+        if not self.max_traces or not (requested or (self.sample_rate and random.random() < self.sample_rate)):
+            return None
+        trace = RequestTrace(trace_id, uid, kind)
+        with self._lock:
+            self._traces[trace_id] = trace
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+        return trace
+
+    def get(self, trace_id: str, uid: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            trace = self._traces.get(trace_id)
+        if trace is None or (uid is not None and trace.uid != uid):
+            return None
+        return trace.to_dict()
@@ -0,0 +1,527 @@
+"""
+Shared connections and admission control for the provider apis: OpenAI, Pinecone, Cohere
+and Unstructured. Each provider has one pooled HTTP client per process and a gate in
+front of it: a token bucket for its request rate and an AIMD concurrency limit that
+halves on a 429 and grows back by one slot per `limit` successes. Requests over either
+limit queue instead of failing, the time they waited is provider_queue_wait_seconds.
+
+Per provider, with its name upper cased:
+
+    PROVIDER_<NAME>_RPS              requests per second, 0 is unlimited
+    PROVIDER_<NAME>_BURST            requests the rate limit lets through at once
+    PROVIDER_<NAME>_CONCURRENCY      initial concurrency limit
+    PROVIDER_<NAME>_MAX_CONCURRENCY  the limit never grows past this
+
+PROVIDER_MAX_CONNECTIONS caps the pool of every provider and PROVIDER_MAX_RETRIES is how
+often a throttled request queues again before the 429 reaches its caller.
+"""
+import asyncio
+import functools
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Any, Callable, Optional, Tuple, Sequence
+
+import httpx
+
+from metrics import metrics
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'provider_queue_wait_seconds', 'Time provider requests waited for the rate and concurrency limits',
+    labels=('provider',), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+REQUESTS = metrics.counter('provider_requests_total', 'Provider requests by outcome', labels=('provider', 'outcome'))
+
+# most providers answer 429, pinecone's data plane and cohere also use 503 for capacity
+THROTTLED_STATUS = (429, 503)
+
+
+@dataclass
+class ProviderSettings:
+    rps: float = 0
+    burst: int = 10
+    concurrency: int = 16
+    max_concurrency: int = 64
+
+    @classmethod
+    def from_env(cls, name: str, default: Optional['ProviderSettings'] = None) -> 'ProviderSettings':
+        default = default or cls()
+        prefix = f'PROVIDER_{name.upper()}_'
+        return cls(
+            rps=float(os.getenv(prefix + 'RPS', default.rps)),
+            burst=int(os.getenv(prefix + 'BURST', default.burst)),
+            concurrency=int(os.getenv(prefix + 'CONCURRENCY', default.concurrency)),
+            max_concurrency=int(os.getenv(prefix + 'MAX_CONCURRENCY', default.max_concurrency)),
+        )
+
+
+DEFAULT_SETTINGS = {
+    'openai': ProviderSettings(concurrency=32, max_concurrency=128),
+    'pinecone': ProviderSettings(concurrency=16, max_concurrency=64),
+    'cohere': ProviderSettings(concurrency=4, max_concurrency=16),
+    'unstructured': ProviderSettings(concurrency=4, max_concurrency=16),
+}
+
+
+class TokenBucket:
+    """
+    `reserve` takes a token now and returns how long to wait until it is due, so
+    callers line up in the order they asked instead of polling.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+class _Waiter:
+    __slots__ = ('wake', 'granted')
+
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.granted = False
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit with additive increase and multiplicative decrease. Slots are
+    handed to waiters first come first served, from threads and event loops alike.
+    """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, decrease_interval_s: float = 1.0):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.decrease_interval_s = decrease_interval_s
+        self._decreased_at = 0.0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _grant(self):
+        # callers hold the lock
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            self.in_flight += 1
+            waiter.wake()
+
+    def _enter(self, waiter: _Waiter) -> bool:
+        with self._lock:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def acquire(self):
+        event = threading.Event()
+        if not self._enter(_Waiter(event.set)):
+            event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = _Waiter(wake)
+        if self._enter(waiter):
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    # woken and cancelled before running, pass the slot on
+                    self.in_flight -= 1
+                    self._grant()
+                else:
+                    self._waiters.remove(waiter)
+            raise
+
+    def release(self, throttled: bool = False, succeeded: bool = True):
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                # the requests in flight when the first 429 came back will likely see one too
+                if now - self._decreased_at >= self.decrease_interval_s:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = now
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._grant()
+
+
+class Admission:
+    """
+    A slot of a gate. `throttled()` marks the request as rate limited by the provider,
+    releasing more than once is a no-op so a stream may release on close and on error.
+    """
+
+    def __init__(self, gate: 'ProviderGate'):
+        self.gate = gate
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self, throttled: bool = False, succeeded: bool = True):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.gate.limit.release(throttled=throttled, succeeded=succeeded)
+        REQUESTS.labels(self.gate.name, 'throttled' if throttled else 'ok' if succeeded else 'error').inc()
+
+
+def is_throttled(err: BaseException) -> bool:
+    """
+    Whether a client library error is a provider rate limit. The SDKs disagree on where
+    they keep the status code.
+    """
+    for attribute in ('status_code', 'http_status', 'status'):
+        status = getattr(err, attribute, None)
+        if isinstance(status, int):
+            return status in THROTTLED_STATUS
+    response = getattr(err, 'response', None)
+    return getattr(response, 'status_code', None) in THROTTLED_STATUS
+
+
+def retry_delay(attempt: int, retry_after: Optional[str] = None, base_s: float = 0.5, max_s: float = 20.0) -> float:
+    if retry_after:
+        try:
+            return min(max_s, float(retry_after))
+        except ValueError:
+            pass
+    return min(max_s, base_s * 2 ** attempt) * (0.5 + random.random())
+
+
+class ProviderGate:
+    def __init__(self, name: str, settings: ProviderSettings, max_retries: int = 4):
+        self.name = name
+        self.settings = settings
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(settings.rps, settings.burst)
+        self.limit = AdaptiveLimit(settings.concurrency, settings.max_concurrency)
+
+    def admit(self) -> Admission:
+        start = time.perf_counter()
+        delay = self.bucket.reserve()
+        if delay:
+            time.sleep(delay)
+        self.limit.acquire()
+        QUEUE_WAIT_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+        return Admission(self)
+
+    async def admit_async(self) -> Admission:
+        start = time.perf_counter()
+        delay = self.bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        await self.limit.acquire_async()
+        QUEUE_WAIT_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+        return Admission(self)
+
+    def call(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Calls a blocking client method through the gate, queuing it again when the
+        provider throttles it.
+        """
+        attempt = 0
+        while True:
+            admission = self.admit()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as err:
+                throttled = is_throttled(err)
+                admission.release(throttled=throttled, succeeded=False)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+            else:
+                admission.release()
+                return result
+            delay = retry_delay(attempt)
+            attempt += 1
+            logging.warning(f"{self.name} throttled, queuing again in {delay:.2f}s (attempt {attempt})")
+            time.sleep(delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'limit': self.limit.limit,
+            'in_flight': self.limit.in_flight,
+            'waiting': self.limit.waiting,
+            'rps': self.settings.rps,
+        }
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, admission: Admission):
+        self.stream = stream
+        self.admission = admission
+
+    def __iter__(self):
+        # abandoned bodies end here too, with GeneratorExit, and nobody may close the response
+        succeeded = False
+        try:
+            yield from self.stream
+            succeeded = True
+        finally:
+            self.admission.release(succeeded=succeeded)
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.admission.release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, admission: Admission):
+        self.stream = stream
+        self.admission = admission
+
+    async def __aiter__(self):
+        # a cancelled consumer ends here with CancelledError, llama_index never closes the stream
+        succeeded = False
+        try:
+            async for chunk in self.stream:
+                yield chunk
+            succeeded = True
+        finally:
+            self.admission.release(succeeded=succeeded)
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.admission.release()
+
+
+def _holding(response: httpx.Response, stream) -> httpx.Response:
+    # a streamed completion occupies its slot until the body is closed, not just until the headers
+    return httpx.Response(status_code=response.status_code, headers=response.headers, stream=stream,
+                          extensions=response.extensions)
+
+
+class GatedTransport(httpx.BaseTransport):
+    def __init__(self, gate: ProviderGate, limits: httpx.Limits):
+        self.gate = gate
+        self.inner = httpx.HTTPTransport(limits=limits)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            admission = self.gate.admit()
+            try:
+                response = self.inner.handle_request(request)
+            except Exception:
+                admission.release(succeeded=False)
+                raise
+            if response.status_code not in THROTTLED_STATUS or attempt >= self.gate.max_retries:
+                return _holding(response, _ReleasingStream(response.stream, admission))
+            response.close()
+            admission.release(throttled=True)
+            delay = retry_delay(attempt, response.headers.get('retry-after'))
+            attempt += 1
+            time.sleep(delay)
+
+    def close(self):
+        self.inner.close()
+
+
+class GatedAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Connections belong to the event loop that opened them, and the ingest workers run
+    each job in a loop of its own, so there is one pool per running loop.
+    """
+
+    def __init__(self, gate: ProviderGate, limits: httpx.Limits):
+        self.gate = gate
+        self.limits = limits
+        self._inner: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]' = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._inner.get(loop)
+            if transport is None:
+                transport = self._inner[loop] = httpx.AsyncHTTPTransport(limits=self.limits)
+            return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        transport = self._transport()
+        attempt = 0
+        while True:
+            admission = await self.gate.admit_async()
+            try:
+                response = await transport.handle_async_request(request)
+            except BaseException:
+                admission.release(succeeded=False)
+                raise
+            if response.status_code not in THROTTLED_STATUS or attempt >= self.gate.max_retries:
+                return _holding(response, _AsyncReleasingStream(response.stream, admission))
+            await response.aclose()
+            admission.release(throttled=True)
+            delay = retry_delay(attempt, response.headers.get('retry-after'))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        transport = self._inner.get(asyncio.get_running_loop())
+        if transport is not None:
+            await transport.aclose()
+
+
+class GatedClient:
+    """
+    Wraps a blocking SDK object, e.g. a pinecone index, so that the named methods go
+    through the provider's gate. Everything else passes straight through.
+    """
+
+    def __init__(self, client: Any, gate: ProviderGate, methods: Sequence[str]):
+        self._client = client
+        self._gate = gate
+        self._methods = frozenset(methods)
+
+    def __getattr__(self, name: str) -> Any:
+        value = getattr(self._client, name)
+        if name in self._methods:
+            return lambda *args, **kwargs: self._gate.call(value, *args, **kwargs)
+        return value
+
+
+class Providers:
+    """
+    The gates and pooled clients of this process, created on first use.
+    """
+
+    def __init__(self):
+        self._gates: Dict[str, ProviderGate] = {}
+        self._http: Dict[str, httpx.Client] = {}
+        self._async_http: Dict[str, httpx.AsyncClient] = {}
+        self._openai: Dict[Tuple, Tuple[Any, Any]] = {}
+        self._lock = threading.RLock()
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv('PROVIDER_MAX_CONNECTIONS', '100')),
+            max_keepalive_connections=int(os.getenv('PROVIDER_MAX_CONNECTIONS', '100')),
+            keepalive_expiry=60,
+        )
+        self.max_retries = int(os.getenv('PROVIDER_MAX_RETRIES', '4'))
+
+    def gate(self, name: str) -> ProviderGate:
+        with self._lock:
+            if name not in self._gates:
+                settings = ProviderSettings.from_env(name, DEFAULT_SETTINGS.get(name))
+                self._gates[name] = ProviderGate(name, settings, self.max_retries)
+            return self._gates[name]
+
+    def http(self, name: str, timeout_s: float = 60) -> httpx.Client:
+        with self._lock:
+            if name not in self._http:
+                self._http[name] = httpx.Client(transport=GatedTransport(self.gate(name), self.limits),
+                                                timeout=timeout_s)
+            return self._http[name]
+
+    def async_http(self, name: str, timeout_s: float = 60) -> httpx.AsyncClient:
+        with self._lock:
+            if name not in self._async_http:
+                self._async_http[name] = httpx.AsyncClient(
+                    transport=GatedAsyncTransport(self.gate(name), self.limits), timeout=timeout_s
+                )
+            return self._async_http[name]
+
+    def openai_clients(self, api_key: Optional[str], base_url: Optional[str], max_retries: int,
+                       timeout: float) -> Tuple[Any, Any]:
+        """
+        The sync and async OpenAI SDK clients for these credentials, on the pooled
+        connections. They retry up to `max_retries` times, except for throttled responses,
+        which the gate already retried.
+        """
+        OpenAI, AsyncOpenAI = _gated_openai_types()
+
+        key = (api_key, base_url, max_retries, timeout)
+        with self._lock:
+            if key not in self._openai:
+                self._openai[key] = (
+                    OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries, timeout=timeout,
+                           http_client=self.http('openai', timeout)),
+                    AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries, timeout=timeout,
+                                http_client=self.async_http('openai', timeout)),
+                )
+            return self._openai[key]
+
+    def share_openai(self, model: Any) -> Any:
+        """
+        Points a llama_index OpenAI llm or embedding model at the shared SDK clients
+        instead of the pair it would create for itself. Not public api, a model without
+        the attributes keeps its own clients.
+        """
+        if not all(hasattr(model, name) for name in ('_client', '_aclient', 'api_key', 'api_base')):
+            return model
+        if not getattr(model, 'reuse_client', True):
+            return model
+        model._client, model._aclient = self.openai_clients(
+            model.api_key, model.api_base, getattr(model, 'max_retries', 3), getattr(model, 'timeout', 60.0)
+        )
+        return model
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: gate.get_stats() for name, gate in self._gates.items()}
+
+
+providers = Providers()
+
+
+@functools.lru_cache(maxsize=None)
+def _gated_openai_types() -> Tuple[type, type]:
+    from openai import AsyncOpenAI, OpenAI
+
+    # the sdk retries 429s too, each of its attempts would queue through the gate's retries
+    # again and keep hammering a provider the gate is backing off from
+    class GatedOpenAI(OpenAI):
+        def _should_retry(self, response: httpx.Response) -> bool:
+            return response.status_code not in THROTTLED_STATUS and super()._should_retry(response)
+
+    class GatedAsyncOpenAI(AsyncOpenAI):
+        def _should_retry(self, response: httpx.Response) -> bool:
+            return response.status_code not in THROTTLED_STATUS and super()._should_retry(response)
+
+    return GatedOpenAI, GatedAsyncOpenAI
+
+
+def _gate_values(key: str) -> Dict[Tuple[str, ...], float]:
+    return {(name,): stats[key] for name, stats in providers.get_stats().items()}
+
+
+metrics.gauge('provider_concurrency_limit', 'Current AIMD concurrency limit per provider',
+              lambda: _gate_values('limit'), labels=('provider',))
+metrics.gauge('provider_in_flight', 'Provider requests holding a slot', lambda: _gate_values('in_flight'),
+              labels=('provider',))
+metrics.gauge('provider_waiting', 'Provider requests queued for a slot', lambda: _gate_values('waiting'),
+              labels=('provider',))
@@ -1,39 +1,132 @@
 import os
+import threading
 
-from firebase_admin import firestore, initialize_app
-from google.cloud import storage
-from llama_index.core import StorageContext, ServiceContext, VectorStoreIndex
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.legacy.vector_stores import PineconeVectorStore
-from llama_index.llms.openai import OpenAI
-from pinecone import Pinecone
+from providers import providers, GatedClient
+from startup import lazy
+
+PINECONE_METHODS = ('query', 'upsert', 'delete', 'fetch', 'update')
+
+
+def get_vector_store():
+    """
+    VECTOR_STORE selects `pinecone` or `local`, memory-mapped files under
+    LOCAL_VECTOR_STORE_PATH that a chat service on the same machine can read. Pinecone
+    namespaces follow VECTOR_SHARDING, the local store is always partitioned by user.
+    """
+    backend = os.getenv('VECTOR_STORE', 'pinecone')
+    if backend == 'local':
+        from local_vector_store import LocalVectorStore
+        return LocalVectorStore(path=os.getenv('LOCAL_VECTOR_STORE_PATH', 'vectors'))
+    if backend != 'pinecone':
+        raise ValueError(f"Unknown vector store {backend}")
+
+    from llama_index.legacy.vector_stores import PineconeVectorStore
+    from pinecone import Pinecone
+
+    from vector_sharding import ShardingStrategy, ShardedVectorStore
+    pinecone_index = GatedClient(
+        Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index("text-embedding-3-small-index"),
+        providers.gate('pinecone'), PINECONE_METHODS
+    )
+    strategy = ShardingStrategy.from_env()
+    if strategy.mode == 'none':
+        return PineconeVectorStore(pinecone_index=pinecone_index, namespace=strategy.base)
+    return ShardedVectorStore(
+        strategy,
+        lambda namespace: PineconeVectorStore(pinecone_index=pinecone_index, namespace=namespace),
+    )
 
 
 class ApplicationContext:
-    def __init__(self):
-        initialize_app()
+    """
+    Clients are built on first use and the libraries behind them imported then, so
+    constructing a context is free and startup can build them all concurrently.
+    """
 
+    def __init__(self):
         self.unstructured_api_key = os.getenv('UNSTRUCTURED_API_KEY')
         self.unstructured_api_url = os.getenv('UNSTRUCTURED_API_URL')
 
-        pinecone_index = Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index("text-embedding-3-small-index")
+    @lazy
+    def document_vector_store(self):
+        return get_vector_store()
+
+    @lazy
+    def llm(self):
+        from llama_index.llms.openai import OpenAI
+        return providers.share_openai(OpenAI(model='gpt-3.5-turbo', api_key=os.getenv('OPENAI_API_KEY')))
 
-        self.document_vector_store = PineconeVectorStore(pinecone_index=pinecone_index, namespace='documents')
-        self.llm = OpenAI(model='gpt-3.5-turbo', api_key=os.getenv('OPENAI_API_KEY'))
-        self.embed_model = OpenAIEmbedding(model='text-embedding-3-small', api_key=os.getenv('OPENAI_API_KEY'))
-        self.storage_context = StorageContext.from_defaults(vector_store=self.document_vector_store)
-        self.service_context = ServiceContext.from_defaults(
+    @lazy
+    def embedding_cache(self):
+        from embedding_cache import EmbeddingCache
+        return EmbeddingCache(
+            max_bytes=int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+            disk_path=os.getenv('EMBEDDING_CACHE_PATH'),
+        )
+
+    @lazy
+    def embed_model(self):
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        from embedding_cache import CachedEmbedding
+        return CachedEmbedding(
+            providers.share_openai(
+                OpenAIEmbedding(model='text-embedding-3-small', api_key=os.getenv('OPENAI_API_KEY'))
+            ),
+            self.embedding_cache
+        )
+
+    @lazy(warm=False)
+    def storage_context(self):
+        from llama_index.core import StorageContext
+        return StorageContext.from_defaults(vector_store=self.document_vector_store)
+
+    @lazy
+    def service_context(self):
+        from llama_index.core import ServiceContext
+        return ServiceContext.from_defaults(
             llm=self.llm,
             embed_model=self.embed_model,
             chunk_size=250,
             chunk_size_limit=300,
             chunk_overlap=10,
         )
-        self.document_index = VectorStoreIndex.from_vector_store(
+
+    @lazy(warm=False)
+    def document_index(self):
+        from llama_index.core import VectorStoreIndex
+        return VectorStoreIndex.from_vector_store(
             vector_store=self.document_vector_store,
             storage_context=self.storage_context,
             service_context=self.service_context,
             embed_model=self.embed_model,
         )
-        self.storage_client = storage.Client(project='speedy-atom-413006')
-        self.db_client = firestore.client()
+
+    @lazy
+    def storage_client(self):
+        from google.cloud import storage
+        return storage.Client(project='speedy-atom-413006')
+
+    @lazy
+    def document_bucket(self):
+        return self.storage_client.bucket('speedy-atom-413006.appspot.com')
+
+    @lazy
+    def db_client(self):
+        from firebase_admin import firestore, initialize_app
+        initialize_app()
+        return firestore.client()
+
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_context():
+    """
+    The context shared by the routes and the startup warm-up.
+    """
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = ApplicationContext()
+        return _context
@@ -0,0 +1,63 @@
+"""
+Sweeps embedding/upsert batch sizes and concurrency for BatchedIngestor against fake
+backends. Run from the service directory:
+
+    python -m bench.batch_sizes --chunks 2000 --requests-per-s 20
+"""
+import argparse
+import itertools
+import json
+
+from llama_index.core.schema import TextNode
+
+from bench.fakes import FakeEmbedding, FakeVectorStore
+from bench.harness import FakeRateLimitError
+from pipeline.stages import BatchedIngestor, BatchSettings
+
+
+def synthetic_nodes(count: int):
+    return [
+        TextNode(text=f"chunk {i} " + "lorem ipsum dolor sit amet " * 40, metadata={'user': 'bench'})
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64, 128, 256])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--embed-latency', type=float, default=0.05)
+    parser.add_argument('--upsert-latency', type=float, default=0.03)
+    parser.add_argument('--requests-per-s', type=float, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    results = []
+    for batch_size, concurrency in itertools.product(args.batch_sizes, args.concurrency):
+        ingestor = BatchedIngestor(
+            embed_model=FakeEmbedding(latency_s=args.embed_latency, requests_per_s=args.requests_per_s),
+            vector_store=FakeVectorStore(latency_s=args.upsert_latency),
+            settings=BatchSettings(
+                embed_batch_size=batch_size,
+                embed_concurrency=concurrency,
+                upsert_batch_size=batch_size,
+                upsert_concurrency=concurrency,
+                backoff_s=0.1,
+            ),
+            retry_on=(FakeRateLimitError,),
+        )
+        report = ingestor.run(synthetic_nodes(args.chunks))
+        result = {'batch_size': batch_size, 'concurrency': concurrency, **report.to_dict()}
+        results.append(result)
+        print(f"batch={batch_size:<5} concurrency={concurrency:<3} "
+              f"total={result['total_s']:.2f}s chunks/s={result['chunks_per_s']:.0f} "
+              f"tokens/s={result['embed_tokens_per_s']:.0f} retries={result['retries']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
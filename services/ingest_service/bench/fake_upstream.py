@@ -0,0 +1,195 @@
+"""
+HTTP fakes of the OpenAI chat completion and embedding api and the Unstructured partition
+api, served by bench.harness.ServerProcess so the real clients, retries and stream parsing
+of the apps are exercised. Latency and rate limits come from a FakeProfile, a request over
+the limit gets a 429 like the real services.
+
+Chat completions call the first tool offered when the last message is the user's, and
+otherwise answer with `openai_tokens` words citing the first source. Embeddings hash words
+into a few dimensions each, so texts sharing words are similar and retrieval over a seeded
+corpus finds the documents a question is about.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import re
+import struct
+import time
+import uuid
+from typing import List, Dict, Any
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from bench.harness import FakeProfile, RateLimiter, FakeRateLimitError, with_rss_route
+
+EMBEDDING_DIM = 1536
+FILLER = ('the', 'notes', 'say', 'that', 'this', 'is', 'covered', 'in', 'detail', 'and', 'cited', 'here')
+
+
+def topic_vector(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    vector = [0.0] * dim
+    for word in re.findall(r'[a-z0-9]{3,}', text.lower()):
+        digest = hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest()
+        for i in range(0, 8, 2):
+            index = int.from_bytes(digest[i:i + 2], 'little') % dim
+            vector[index] += 1.0 if digest[i] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def _rate_limited(limiter: RateLimiter):
+    try:
+        limiter.check()
+    except FakeRateLimitError as err:
+        return JSONResponse(
+            {'error': {'message': str(err), 'type': 'rate_limit_exceeded', 'code': 'rate_limit_exceeded'}},
+            status_code=429,
+            headers={'retry-after': '1'},
+        )
+    return None
+
+
+def _content(message: Dict[str, Any]) -> str:
+    content = message.get('content') or ''
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content
+
+
+def _answer(messages: List[Dict[str, Any]], count: int) -> List[str]:
+    prompt = _content(messages[-1]) if messages else ''
+    # sub-question decomposition asks for a json list of the parts of the message
+    if 'JSON list' in prompt:
+        match = re.search(r'^Message: (.*)$', prompt, re.MULTILINE)
+        message = match.group(1) if match else prompt
+        parts = [part.strip(' ?.') for part in re.split(r'\band\b|\?|,', message) if len(part.strip(' ?.')) > 3]
+        return [json.dumps(parts or [message])]
+    words = ['[1]'] if any('Source 1' in _content(message) for message in messages) else []
+    while len(words) < count:
+        words.append(FILLER[len(words) % len(FILLER)])
+    return [word + ' ' for word in words[:count]]
+
+
+def _chunk(completion_id: str, model: str, delta: Dict[str, Any], finish_reason=None) -> str:
+    return 'data: ' + json.dumps({
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    }) + '\n\n'
+
+
+def create_app(profile: FakeProfile) -> FastAPI:
+    app = with_rss_route(FastAPI())
+    chat_limiter = RateLimiter(profile.openai_rps)
+    embedding_limiter = RateLimiter(profile.embedding_rps)
+    unstructured_limiter = RateLimiter(profile.unstructured_rps)
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        limited = _rate_limited(chat_limiter)
+        if limited:
+            return limited
+        body = await request.json()
+        messages = body.get('messages', [])
+        model = body.get('model', 'gpt-3.5-turbo')
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        tools = body.get('tools') or []
+        tool_call = None
+        if tools and messages and messages[-1].get('role') == 'user':
+            tool_call = {
+                'id': f'call_{uuid.uuid4().hex[:24]}',
+                'type': 'function',
+                'function': {
+                    'name': tools[0]['function']['name'],
+                    'arguments': json.dumps({'input': _content(messages[-1])}),
+                },
+            }
+        count = min(profile.openai_tokens, body.get('max_tokens') or profile.openai_tokens)
+        tokens = [] if tool_call else _answer(messages, count)
+
+        if not body.get('stream'):
+            await asyncio.sleep(profile.openai_first_token_s + profile.openai_token_s * len(tokens))
+            message: Dict[str, Any] = {'role': 'assistant', 'content': ''.join(tokens) if tokens else None}
+            if tool_call:
+                message['tool_calls'] = [tool_call]
+            return {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': message,
+                    'finish_reason': 'tool_calls' if tool_call else 'stop',
+                }],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(tokens), 'total_tokens': len(tokens)},
+            }
+
+        async def stream():
+            await asyncio.sleep(profile.openai_first_token_s)
+            if tool_call:
+                yield _chunk(completion_id, model, {
+                    'role': 'assistant', 'content': None, 'tool_calls': [{'index': 0, **tool_call}],
+                })
+                yield _chunk(completion_id, model, {}, 'tool_calls')
+            else:
+                for i, token in enumerate(tokens):
+                    if i:
+                        await asyncio.sleep(profile.openai_token_s)
+                    yield _chunk(completion_id, model, {'role': 'assistant', 'content': token} if not i
+                                 else {'content': token})
+                yield _chunk(completion_id, model, {}, 'stop')
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    @app.post('/v1/embeddings')
+    async def embeddings(request: Request):
+        limited = _rate_limited(embedding_limiter)
+        if limited:
+            return limited
+        body = await request.json()
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        await asyncio.sleep(profile.embedding_s + profile.embedding_per_item_s * len(texts))
+        vectors = [topic_vector(text if isinstance(text, str) else ' '.join(map(str, text))) for text in texts]
+        if body.get('encoding_format') == 'base64':
+            data = [base64.b64encode(struct.pack(f'<{len(vector)}f', *vector)).decode('ascii') for vector in vectors]
+        else:
+            data = vectors
+        tokens = sum(len(str(text).split()) for text in texts)
+        return {
+            'object': 'list',
+            'data': [{'object': 'embedding', 'index': i, 'embedding': vector} for i, vector in enumerate(data)],
+            'model': body.get('model', 'text-embedding-3-small'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        }
+
+    @app.post('/general/v0/general')
+    async def partition(request: Request):
+        limited = _rate_limited(unstructured_limiter)
+        if limited:
+            return limited
+        # multipart upload of the file, synthetic benchmark files carry their page count
+        body = await request.body()
+        pages_match = re.search(rb'%%PAGES (\d+)', body)
+        name_match = re.search(rb'filename="([^"]+)"', body)
+        pages = int(pages_match.group(1)) if pages_match else 1
+        filename = name_match.group(1).decode('utf-8', 'replace') if name_match else 'upload'
+        await asyncio.sleep(profile.unstructured_s + profile.unstructured_per_page_s * pages)
+        return [
+            {
+                'type': 'NarrativeText',
+                'element_id': hashlib.sha256(f'{filename}/{page}/{paragraph}'.encode('utf-8')).hexdigest()[:32],
+                'text': f'{filename} page {page} paragraph {paragraph}. ' + ' '.join(FILLER * 6),
+                'metadata': {'filename': filename, 'page_number': page, 'filetype': 'application/pdf'},
+            }
+            for page in range(1, pages + 1)
+            for paragraph in range(8)
+        ]
+
+    return app
@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from typing import List, Dict, Any
+
+from bench.harness import RateLimiter
+
+
+def fake_vector(text: str, dim: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(dim)]
+
+
+class FakeEmbedding:
+    """
+    Stands in for OpenAIEmbedding: deterministic vectors, latency of
+    `latency_s + per_item_s * len(batch)` and an optional requests/s limit.
+    """
+
+    def __init__(self, dim: int = 1536, latency_s: float = 0.05, per_item_s: float = 0.0005,
+                 requests_per_s: float = 0):
+        self.dim = dim
+        self.latency_s = latency_s
+        self.per_item_s = per_item_s
+        self.rate_limiter = RateLimiter(requests_per_s)
+        self.model_name = 'fake-embedding'
+        self.calls = 0
+
+    def _delay(self, count: int) -> float:
+        return self.latency_s + self.per_item_s * count
+
+    def get_text_embedding_batch(self, texts: List[str], **kwargs) -> List[List[float]]:
+        self.rate_limiter.check()
+        self.calls += 1
+        time.sleep(self._delay(len(texts)))
+        return [fake_vector(text, self.dim) for text in texts]
+
+    async def aget_text_embedding_batch(self, texts: List[str], **kwargs) -> List[List[float]]:
+        self.rate_limiter.check()
+        self.calls += 1
+        await asyncio.sleep(self._delay(len(texts)))
+        return [fake_vector(text, self.dim) for text in texts]
+
+    def get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self._delay(1))
+        return fake_vector(query, self.dim)
+
+    async def aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self._delay(1))
+        return fake_vector(query, self.dim)
+
+
+class FakeVectorStore:
+    """
+    Stands in for PineconeVectorStore: keeps nodes in a dict, sleeps
+    `latency_s + per_item_s * len(nodes)` per call and has an optional requests/s limit.
+    """
+
+    stores_text = True
+
+    def __init__(self, latency_s: float = 0.03, per_item_s: float = 0.0002, keep_nodes: bool = True,
+                 requests_per_s: float = 0):
+        self.latency_s = latency_s
+        self.per_item_s = per_item_s
+        self.keep_nodes = keep_nodes
+        self.rate_limiter = RateLimiter(requests_per_s)
+        self.nodes: Dict[str, Any] = {}
+        self.added = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, nodes, **kwargs) -> List[str]:
+        self.rate_limiter.check()
+        time.sleep(self.latency_s + self.per_item_s * len(nodes))
+        with self._lock:
+            self.calls += 1
+            self.added += len(nodes)
+            if self.keep_nodes:
+                for node in nodes:
+                    self.nodes[node.node_id] = node
+        return [node.node_id for node in nodes]
+
+    def delete_nodes(self, node_ids: List[str], **kwargs):
+        time.sleep(self.latency_s)
+        with self._lock:
+            for node_id in node_ids:
+                self.nodes.pop(node_id, None)
+
+    def delete(self, ref_doc_id: str, **kwargs):
+        time.sleep(self.latency_s)
+        with self._lock:
+            for node_id in [key for key, node in self.nodes.items() if node.ref_doc_id == ref_doc_id]:
+                del self.nodes[node_id]
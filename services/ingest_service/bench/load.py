@@ -0,0 +1,259 @@
+"""
+Load test of /ingest through the real app. The app runs in its own process with OpenAI and
+Unstructured replaced by bench.fake_upstream, and Pinecone, GCS and Firestore by
+in-process fakes, each with the latency and rate limit of the profile (`--fake name=value`,
+see bench.harness.FakeProfile). Uploads are synthetic objects the fake bucket creates on
+first access: markdown partitioned locally, or slides sent to the fake partition api.
+App settings are passed with `--env NAME=value`, jobs always run on the thread executor
+since process workers would build the real clients.
+
+A request is timed from submitting the object until its job is processed, `accepted` is
+the time to the 202. Reports these with throughput in jobs and chunks per second, errors,
+the peak RSS of the app and its time to serve and to be ready. Run from the service
+directory:
+
+    python -m bench.load --scenarios local remote --concurrency 1 4 16 --output ingest.json
+    python -m bench.load --fake embedding_rps=20 --compare ingest.json
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from bench.fake_cloud import FakeBucket, FakeFirestore
+from bench.harness import FakeProfile, ServerProcess, drive, summarize, report, save, compare, with_rss_route
+
+SCENARIOS = ('local', 'remote', 'batch')
+OBJECT_NAME = re.compile(r'^bench/(?P<uid>[^/]+)/(?P<run>[^/]+)/(?P<index>\d+)-(?P<pages>\d+)p\.(?P<ext>md|pptx)$')
+PPTX = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+TERMINAL = ('processed', 'failed')
+
+
+def synthetic_object(name: str) -> Optional[Tuple[bytes, str, Dict[str, str]]]:
+    match = OBJECT_NAME.match(name)
+    if not match:
+        return None
+    uid, run, index, pages, ext = match.group('uid', 'run', 'index', 'pages', 'ext')
+    filename = f'{index}.{ext}'
+    metadata = {'filename': filename, 'userId': uid}
+    if ext == 'pptx':
+        # the fake partition api reads the page count, the bytes are never parsed
+        return f'%%PAGES {pages}\n{name}\n'.encode('utf-8'), PPTX, metadata
+    sections = []
+    for page in range(int(pages)):
+        sections.append(f'# Section {page} of {run} {index}\n')
+        sections.extend(
+            f'Paragraph {paragraph} of section {page} in upload {index} of {run} describes item '
+            f'{page * 8 + paragraph} with enough words to fill a chunk of the document splitter.\n'
+            for paragraph in range(8)
+        )
+    return '\n'.join(sections).encode('utf-8'), 'text/markdown', metadata
+
+
+class BenchApplicationContext:
+    def __init__(self, profile: FakeProfile, upstream_url: str):
+        from llama_index.core import ServiceContext
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        from llama_index.llms.openai import OpenAI
+
+        from bench.fakes import FakeVectorStore
+        from embedding_cache import CachedEmbedding, EmbeddingCache
+        from providers import providers
+
+        api_base = f'{upstream_url}/v1'
+        self.unstructured_api_key = 'bench'
+        self.unstructured_api_url = f'{upstream_url}/general/v0/general'
+        self.document_vector_store = FakeVectorStore(
+            latency_s=profile.vector_s, keep_nodes=False, requests_per_s=profile.vector_rps
+        )
+        self.llm = providers.share_openai(OpenAI(model='gpt-3.5-turbo', api_key='bench', api_base=api_base))
+        self.embedding_cache = EmbeddingCache()
+        self.embed_model = CachedEmbedding(
+            providers.share_openai(OpenAIEmbedding(model='text-embedding-3-small', api_key='bench', api_base=api_base)),
+            self.embedding_cache
+        )
+        self.service_context = ServiceContext.from_defaults(
+            llm=self.llm,
+            embed_model=self.embed_model,
+            chunk_size=250,
+            chunk_size_limit=300,
+            chunk_overlap=10,
+        )
+        self.storage_client = None
+        self.document_bucket = FakeBucket(profile.gcs_s, generate=synthetic_object)
+        self.db_client = FakeFirestore(profile.firestore_s)
+
+
+def create_bench_app(profile: FakeProfile, upstream_url: str, env: Dict[str, str]):
+    """
+    Runs in the app process: swaps the clients for fakes before the app module builds them.
+    """
+    os.environ.update({'OPENAI_API_KEY': 'bench', 'OPENAI_API_BASE': f'{upstream_url}/v1',
+                       'OPENAI_BASE_URL': f'{upstream_url}/v1', **env, 'INGEST_EXECUTOR': 'thread'})
+
+    import app_ctx
+    app_ctx.ApplicationContext = lambda: BenchApplicationContext(profile, upstream_url)
+
+    from main import app
+    return with_rss_route(app)
+
+
+async def chunks_ingested(client: httpx.AsyncClient, url: str) -> float:
+    families = (await client.get(f'{url}/metrics', params={'format': 'json'})).json()
+    return sum(entry['value'] for entry in families.get('ingest_chunks_total', {}).get('values', []))
+
+
+class Outcome:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.accepted: List[float] = []
+        self.errors = 0
+        self.rejected = 0
+        self.objects = 0
+
+
+async def submit(client: httpx.AsyncClient, url: str, path: str, body: Dict[str, Any], outcome: Outcome,
+                 max_attempts: int = 20) -> Optional[Dict[str, Any]]:
+    # a full queue answers 429, clients back off and resubmit
+    for _ in range(max_attempts):
+        response = await client.post(f'{url}/api/v1/{path}', json=body)
+        if response.status_code != 429:
+            return response.json() if response.status_code == 202 else None
+        outcome.rejected += 1
+        await asyncio.sleep(float(response.headers.get('Retry-After', '1')))
+    return None
+
+
+async def wait_for(client: httpx.AsyncClient, url: str, job_ids: List[str], poll_s: float) -> bool:
+    pending = set(job_ids)
+    failed = False
+    while pending:
+        await asyncio.sleep(poll_s)
+        for job_id in list(pending):
+            status = (await client.get(f'{url}/api/v1/ingest/jobs/{job_id}')).json()['status']
+            if status in TERMINAL:
+                pending.discard(job_id)
+                failed = failed or status == 'failed'
+    return not failed
+
+
+async def run_level(client: httpx.AsyncClient, url: str, scenario: str, concurrency: int, requests: int,
+                    run_id: str, args) -> Dict[str, Any]:
+    outcome = Outcome()
+    ext = 'pptx' if scenario == 'remote' else 'md'
+
+    def object_id(i: int) -> str:
+        return f'bench/user{i % args.users}/{run_id}/{i}-{args.pages}p.{ext}'
+
+    async def request(i: int):
+        start = time.perf_counter()
+        try:
+            if scenario == 'batch':
+                # one request carries a folder of objects of the same user
+                uid = i % args.users
+                object_ids = [object_id(uid + args.users * (i * args.batch_size + j)) for j in range(args.batch_size)]
+                response = await submit(client, url, 'ingest/batch', {'object_ids': object_ids}, outcome)
+                job_ids = list({result['job_id'] for result in response['results'] if result.get('job_id')}) \
+                    if response else []
+                objects = len(object_ids)
+            else:
+                response = await submit(client, url, 'ingest', {'object_id': object_id(i)}, outcome)
+                job_ids = [response['job_id']] if response else []
+                objects = 1
+            if not job_ids:
+                outcome.errors += 1
+                return
+            outcome.accepted.append(time.perf_counter() - start)
+            if not await wait_for(client, url, job_ids, args.poll_ms / 1000):
+                outcome.errors += 1
+                return
+        except httpx.HTTPError:
+            outcome.errors += 1
+            return
+        outcome.latencies.append(time.perf_counter() - start)
+        outcome.objects += objects
+
+    chunks_before = await chunks_ingested(client, url)
+    elapsed_s = await drive(request, concurrency, requests)
+    chunks = await chunks_ingested(client, url) - chunks_before
+    rss = (await client.get(f'{url}/bench/rss')).json()['peak_rss_mb']
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': outcome.errors,
+        'rejected': outcome.rejected,
+        'elapsed_s': elapsed_s,
+        'throughput_rps': len(outcome.latencies) / elapsed_s if elapsed_s else 0.0,
+        'objects_per_s': outcome.objects / elapsed_s if elapsed_s else 0.0,
+        'chunks_per_s': chunks / elapsed_s if elapsed_s else 0.0,
+        'latency': summarize(outcome.latencies),
+        'accepted': summarize(outcome.accepted),
+        'peak_rss_mb': rss,
+    }
+
+
+async def run(url: str, args) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    results = []
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout_s), limits=limits) as client:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                # every level uploads objects of its own, unchanged ones would be skipped
+                run_id = f'{scenario}-{concurrency}-{int(time.time())}'
+                result = await run_level(client, url, scenario, concurrency, args.requests, run_id, args)
+                results.append(result)
+                latency = result['latency']
+                print(f"{scenario:<7} concurrency={concurrency:<3} "
+                      f"p50={latency['p50_ms'] or 0:.0f}ms p95={latency['p95_ms'] or 0:.0f}ms "
+                      f"p99={latency['p99_ms'] or 0:.0f}ms accepted_p50={result['accepted']['p50_ms'] or 0:.0f}ms "
+                      f"jobs={result['throughput_rps']:.1f}/s chunks={result['chunks_per_s']:.0f}/s "
+                      f"errors={result['errors']} rejected={result['rejected']} rss={result['peak_rss_mb']:.0f}MB")
+        app_metrics = (await client.get(f'{url}/metrics', params={'format': 'json'})).json()
+    return results, app_metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=['local', 'remote'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=40, help='per scenario and concurrency')
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--pages', type=int, default=4, help='pages per synthetic upload')
+    parser.add_argument('--batch-size', type=int, default=10, help='objects per batch request')
+    parser.add_argument('--poll-ms', type=float, default=50)
+    parser.add_argument('--timeout-s', type=float, default=120)
+    parser.add_argument('--fake', nargs='*', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--compare', type=str, default=None, metavar='BASELINE')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    profile = FakeProfile.parse(args.fake)
+    env = dict(item.split('=', 1) for item in args.env)
+
+    with ServerProcess('bench.fake_upstream:create_app', profile) as upstream, \
+            ServerProcess('bench.load:create_bench_app', profile, upstream.url, env) as app:
+        app.wait_ready()
+        print(f"app serving after {app.startup_s:.2f}s, ready after {app.ready_s:.2f}s")
+        results, app_metrics = asyncio.run(run(app.url, args))
+
+    result = report('ingest', profile, app.startup_s, results, {**vars(args), 'env': env}, app.ready_s)
+    result['metrics'] = app_metrics
+    if args.output:
+        save(result, args.output)
+    if args.compare:
+        regressions = compare(result, args.compare, args.tolerance)
+        if regressions:
+            print('regressions: ' + ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
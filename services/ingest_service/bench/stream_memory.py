@@ -0,0 +1,84 @@
+"""
+Compares peak Python heap of the streaming ingest path against materializing the whole
+document first, on synthetic documents of growing size. Run from the service directory:
+
+    python -m bench.stream_memory --pages 100 400 1600
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
+from unstructured.documents.elements import ElementMetadata, NarrativeText
+
+from bench.fakes import FakeEmbedding, FakeVectorStore
+from pipeline.document import elements_to_nodes
+from pipeline.stages import BatchedIngestor, BatchSettings, IngestReport
+
+PARAGRAPH = "The quick brown fox jumps over the lazy dog while the ingest service keeps its memory flat. " * 6
+
+
+def synthetic_elements(pages: int, paragraphs_per_page: int = 8):
+    for page in range(1, pages + 1):
+        for paragraph in range(paragraphs_per_page):
+            yield NarrativeText(
+                text=f"page {page} paragraph {paragraph}. {PARAGRAPH}",
+                metadata=ElementMetadata(filename='synthetic.pdf', filetype='application/pdf', page_number=page),
+            )
+
+
+def make_ingestor():
+    return BatchedIngestor(
+        embed_model=FakeEmbedding(latency_s=0.001, per_item_s=0),
+        vector_store=FakeVectorStore(latency_s=0.001, per_item_s=0, keep_nodes=False),
+        settings=BatchSettings(embed_batch_size=64, embed_concurrency=4, upsert_batch_size=64),
+    )
+
+
+def run_streaming(pages: int, node_parser) -> IngestReport:
+    nodes = elements_to_nodes(synthetic_elements(pages), 'bench', node_parser)
+    return make_ingestor().run(nodes)
+
+
+def run_materialized(pages: int, node_parser) -> IngestReport:
+    # the previous behaviour: whole partition response, one joined string, all nodes at once
+    elements = list(synthetic_elements(pages))
+    document = Document(text='\n'.join(element.text for element in elements), metadata={'user': 'bench'})
+    nodes = node_parser.get_nodes_from_documents([document])
+    return make_ingestor().run(nodes)
+
+
+def measure(fn, pages: int, node_parser):
+    tracemalloc.start()
+    start = time.perf_counter()
+    report = fn(pages, node_parser)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'pages': pages, 'chunks': report.chunks, 'elapsed_s': elapsed, 'peak_mb': peak / 2 ** 20}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 400, 1600])
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    node_parser = SentenceSplitter(chunk_size=250, chunk_overlap=10)
+    results = []
+    for pages in args.pages:
+        for name, fn in [('materialized', run_materialized), ('streaming', run_streaming)]:
+            result = {'mode': name, **measure(fn, pages, node_parser)}
+            results.append(result)
+            print(f"{name:<13} pages={pages:<6} chunks={result['chunks']:<7} "
+                  f"peak={result['peak_mb']:.1f}MB elapsed={result['elapsed_s']:.2f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
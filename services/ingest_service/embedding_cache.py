@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Callable
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.embeddings import BaseEmbedding
+
+Embedding = List[float]
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+@dataclass
+class EmbeddingCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    provider_calls: int = 0
+    saved_tokens: int = 0
+    evictions: int = 0
+
+
+class SqliteEmbeddingStore:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # one connection shared by the threads that embed
+        self._lock = threading.Lock()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)'
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, array]:
+        found = {}
+        # stay below sqlite's bound variable limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+            for key, blob in rows:
+                vector = array('f')
+                vector.frombytes(blob)
+                found[key] = vector
+        return found
+
+    def put_many(self, model: str, items: Dict[str, array]):
+        rows = [(key, model, vector.tobytes()) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+
+
+class EmbeddingCache:
+    """
+    Two tier embedding cache keyed by sha256(model, kind, text). Vectors are kept as float32.
+    The disk tier is read and written outside the lock of the memory tier.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_path: Optional[str] = None,
+                 count_tokens: Callable[[str], int] = estimate_tokens):
+        self.max_bytes = max_bytes
+        self.count_tokens = count_tokens
+        self.disk = SqliteEmbeddingStore(disk_path) if disk_path else None
+        self.stats = EmbeddingCacheStats()
+        self._memory: OrderedDict[str, array] = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, kind: str, text: str) -> str:
+        return hashlib.sha256(f'{model}\0{kind}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _put_memory(self, key: str, vector: array):
+        if key in self._memory:
+            return
+        self._memory[key] = vector
+        self._memory_bytes += vector.itemsize * len(vector)
+        while self._memory_bytes > self.max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.itemsize * len(evicted)
+            self.stats.evictions += 1
+
+    def get_many(self, keys: List[str], texts: List[str]) -> Dict[str, Embedding]:
+        found: Dict[str, Embedding] = {}
+        missing = []
+        with self._lock:
+            for key, text in zip(keys, texts):
+                vector = self._memory.get(key)
+                if vector is None:
+                    missing.append((key, text))
+                    continue
+                self._memory.move_to_end(key)
+                found[key] = vector.tolist()
+                self.stats.memory_hits += 1
+                self.stats.saved_tokens += self.count_tokens(text)
+
+        if missing and self.disk:
+            from_disk = self.disk.get_many([key for key, _ in missing])
+            with self._lock:
+                for key, text in missing:
+                    if key in from_disk:
+                        self._put_memory(key, from_disk[key])
+                        found[key] = from_disk[key].tolist()
+                        self.stats.disk_hits += 1
+                        self.stats.saved_tokens += self.count_tokens(text)
+        return found
+
+    def put_many(self, model: str, items: Dict[str, Embedding]):
+        vectors = {key: array('f', embedding) for key, embedding in items.items()}
+        with self._lock:
+            for key, vector in vectors.items():
+                self._put_memory(key, vector)
+        if self.disk:
+            try:
+                self.disk.put_many(model, vectors)
+            except sqlite3.Error as err:
+                logging.warning(f"failed to persist embeddings: {err!r}")
+
+    def record(self, misses: int = 0, provider_calls: int = 0):
+        with self._lock:
+            self.stats.misses += misses
+            self.stats.provider_calls += provider_calls
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.stats.memory_hits + self.stats.disk_hits
+            total = hits + self.stats.misses
+            return {
+                'memory_hits': self.stats.memory_hits,
+                'disk_hits': self.stats.disk_hits,
+                'misses': self.stats.misses,
+                'hit_rate': hits / total if total else 0.0,
+                'provider_calls': self.stats.provider_calls,
+                'saved_tokens': self.stats.saved_tokens,
+                'evictions': self.stats.evictions,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+            }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model with an `EmbeddingCache`. Cache misses of a batch are sent to
+    the wrapped model in a single call.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+            **kwargs
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'CachedEmbedding'
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _lookup(self, kind: str, texts: List[str]):
+        keys = [EmbeddingCache.key(self.model_name, kind, text) for text in texts]
+        found = self._cache.get_many(keys, texts)
+        misses: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                misses.setdefault(key, text)
+        self._cache.record(misses=len(misses))
+        return keys, found, misses
+
+    def _finish(self, keys: List[str], found: Dict[str, Embedding],
+                misses: Dict[str, str], embeddings: List[Embedding]) -> List[Embedding]:
+        computed = dict(zip(misses.keys(), embeddings))
+        if computed:
+            self._cache.put_many(self.model_name, computed)
+        found.update(computed)
+        return [found[key] for key in keys]
+
+    async def _off_loop(self, fn: Callable[..., Any], *args: Any) -> Any:
+        # only the disk tier blocks, memory lookups are cheaper than a thread hop
+        if self._cache.disk is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def _embed_texts(self, texts: List[str]) -> List[Embedding]:
+        keys, found, misses = self._lookup('text', texts)
+        embeddings = []
+        if misses:
+            self._cache.record(provider_calls=1)
+            embeddings = self._inner._get_text_embeddings(list(misses.values()))
+        return self._finish(keys, found, misses, embeddings)
+
+    async def _aembed_texts(self, texts: List[str]) -> List[Embedding]:
+        keys, found, misses = await self._off_loop(self._lookup, 'text', texts)
+        embeddings = []
+        if misses:
+            self._cache.record(provider_calls=1)
+            embeddings = await self._inner._aget_text_embeddings(list(misses.values()))
+        return await self._off_loop(self._finish, keys, found, misses, embeddings)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        keys, found, misses = self._lookup('query', [query])
+        embeddings = []
+        if misses:
+            self._cache.record(provider_calls=1)
+            embeddings = [self._inner._get_query_embedding(query)]
+        return self._finish(keys, found, misses, embeddings)[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        keys, found, misses = await self._off_loop(self._lookup, 'query', [query])
+        embeddings = []
+        if misses:
+            self._cache.record(provider_calls=1)
+            embeddings = [await self._inner._aget_query_embedding(query)]
+        return (await self._off_loop(self._finish, keys, found, misses, embeddings))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed_texts([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aembed_texts([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed_texts(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._aembed_texts(texts)
@@ -0,0 +1,182 @@
+import gzip
+import json
+import logging
+import math
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Any, Iterable
+
+WORD = re.compile(r'\w+', re.UNICODE)
+# identifier pieces: lowerCamel/UpperCamel humps, acronyms, digit runs
+SUBWORD = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+')
+STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have how i in is it its my of on or that the this '
+    'to was were what when where which who why will with you your'.split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased words, plus the pieces of identifiers like `parse_config`, `getUserId` or
+    `report-2023` so both the whole symbol and its parts match.
+    """
+    tokens = []
+    for word in WORD.findall(text):
+        lowered = word.lower()
+        if lowered in STOPWORDS:
+            continue
+        tokens.append(lowered)
+        parts = [part.lower() for piece in word.split('_') for part in SUBWORD.findall(piece)]
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part not in STOPWORDS)
+    return tokens
+
+
+@dataclass
+class KeywordDocument:
+    id: str
+    text: str
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    terms: Dict[str, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_text(cls, id: str, text: str, metadata: Dict[str, Any], searchable: Optional[str] = None):
+        return cls(id, text, metadata, dict(Counter(tokenize(searchable if searchable is not None else text))))
+
+    @property
+    def length(self) -> int:
+        return sum(self.terms.values())
+
+
+class KeywordIndex:
+    """
+    In-memory BM25 over one user's chunks. Term frequencies are computed at ingest time
+    and stored with the chunk, so loading only rebuilds the postings.
+    """
+
+    VERSION = 1
+
+    def __init__(self, documents: Iterable[KeywordDocument] = (), k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents: Dict[str, KeywordDocument] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self._total_length = 0
+        for document in documents:
+            self.add(document)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, document: KeywordDocument):
+        if document.id in self.documents:
+            self.remove(document.id)
+        self.documents[document.id] = document
+        self._total_length += document.length
+        for term, count in document.terms.items():
+            self.postings.setdefault(term, {})[document.id] = count
+
+    def remove(self, document_id: str):
+        document = self.documents.pop(document_id, None)
+        if document is None:
+            return
+        self._total_length -= document.length
+        for term in document.terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(document_id, None)
+                if not posting:
+                    del self.postings[term]
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[KeywordDocument, float]]:
+        if not self.documents:
+            return []
+        n = len(self.documents)
+        avg_length = self._total_length / n or 1
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for document_id, count in posting.items():
+                length = self.documents[document_id].length
+                norm = count + self.k1 * (1 - self.b + self.b * length / avg_length)
+                scores[document_id] = scores.get(document_id, 0.0) + idf * count * (self.k1 + 1) / norm
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(self.documents[document_id], score) for document_id, score in best]
+
+    def to_bytes(self) -> bytes:
+        payload = {
+            'version': self.VERSION,
+            'documents': [
+                {'id': doc.id, 'text': doc.text, 'metadata': doc.metadata, 'terms': doc.terms}
+                for doc in self.documents.values()
+            ],
+        }
+        return gzip.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'KeywordIndex':
+        payload = json.loads(gzip.decompress(data))
+        if payload.get('version') != cls.VERSION:
+            raise ValueError(f"unsupported keyword index version {payload.get('version')}")
+        return cls(KeywordDocument(**doc) for doc in payload['documents'])
+
+
+class GcsKeywordIndexStore:
+    """
+    One gzipped index object per user. Updates are read-modify-write guarded by the
+    object generation, so concurrent ingest jobs of a user retry instead of losing chunks.
+    """
+
+    def __init__(self, bucket, prefix: str = 'keyword-index', max_retries: int = 5):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_retries = max_retries
+
+    def path(self, uid: str) -> str:
+        return f'{self.prefix}/{uid}.json.gz'
+
+    def load(self, uid: str) -> Tuple[Optional[KeywordIndex], int]:
+        """
+        Returns the index and its generation, or (None, 0) when the user has none yet.
+        Raises PreconditionFailed when the object is replaced while it is read.
+        """
+        from google.api_core.exceptions import NotFound
+
+        blob = self.bucket.get_blob(self.path(uid))
+        if blob is None:
+            return None, 0
+        try:
+            data = blob.download_as_bytes(if_generation_match=blob.generation)
+        except NotFound:
+            return None, 0
+        return KeywordIndex.from_bytes(data), blob.generation
+
+    def update(self, uid: str, added: List[KeywordDocument], removed: List[str]):
+        from google.api_core.exceptions import PreconditionFailed
+
+        if not added and not removed:
+            return
+        for attempt in range(self.max_retries):
+            try:
+                # the load fails the same way when the object is replaced between its metadata and bytes
+                index, generation = self.load(uid)
+                index = index or KeywordIndex()
+                for document_id in removed:
+                    index.remove(document_id)
+                for document in added:
+                    index.add(document)
+                self.bucket.blob(self.path(uid)).upload_from_string(
+                    index.to_bytes(),
+                    content_type='application/gzip',
+                    if_generation_match=generation,
+                )
+                return
+            except PreconditionFailed:
+                logging.info(f"keyword index of {uid} changed concurrently, retrying")
+                time.sleep(0.1 * 2 ** attempt)
+        raise RuntimeError(f"could not update keyword index of {uid} after {self.max_retries} attempts")
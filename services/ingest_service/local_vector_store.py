@@ -0,0 +1,368 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import List, Optional, Dict, Any, Tuple, Iterable
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore, MetadataFilters, VectorStoreQuery, VectorStoreQueryResult
+)
+from llama_index.core.vector_stores.utils import node_to_metadata_dict, metadata_dict_to_node
+
+MIN_CAPACITY = 64
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class VectorPartition:
+    """
+    One user's vectors as a dense float32 matrix where rows [0, count) are live. Deleting
+    moves the last row into the hole, so a query is a single matrix-vector product. With a
+    path the matrix is a memory-mapped file, otherwise it lives on the heap.
+    """
+
+    def __init__(self, dim: int, path: Optional[str] = None):
+        self.dim = dim
+        self.path = path
+        self.ids: List[str] = []
+        self.records: List[Dict[str, Any]] = []
+        self.rows: Dict[str, int] = {}
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, dim: int, path: str, ids: List[str], records: List[Dict[str, Any]]) -> 'VectorPartition':
+        partition = cls(dim, path)
+        partition.ids = ids
+        partition.records = records
+        partition.rows = {node_id: row for row, node_id in enumerate(ids)}
+        capacity = os.path.getsize(path) // (4 * dim) if os.path.exists(path) else 0
+        if capacity < len(ids):
+            raise ValueError(f"{path} holds {capacity} vectors, expected at least {len(ids)}")
+        if capacity:
+            partition.vectors = np.memmap(path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+        return partition
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes
+
+    def _resize(self, capacity: int):
+        if self.path is None:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        else:
+            # write the grown matrix next to the old one and swap it in, readers that still
+            # map the old file keep a consistent view
+            tmp = self.path + '.tmp'
+            vectors = np.memmap(tmp, dtype=np.float32, mode='w+', shape=(capacity, self.dim))
+        vectors[:len(self)] = self.vectors[:len(self)]
+        if self.path is not None:
+            vectors.flush()
+            os.replace(tmp, self.path)
+        self.vectors = vectors
+
+    def add(self, ids: List[str], vectors: np.ndarray, records: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Inserts or overwrites rows and returns the row of every id written.
+        """
+        written = {}
+        for node_id, vector, record in zip(ids, vectors, records):
+            row = self.rows.get(node_id)
+            if row is None:
+                row = len(self.ids)
+                if row >= len(self.vectors):
+                    self._resize(max(MIN_CAPACITY, 2 * len(self.vectors)))
+                self.ids.append(node_id)
+                self.records.append(record)
+                self.rows[node_id] = row
+            else:
+                self.records[row] = record
+            self.vectors[row] = vector
+            written[node_id] = row
+        return written
+
+    def remove(self, ids: Iterable[str]) -> Tuple[List[str], Dict[str, int]]:
+        """
+        Removes rows and returns the removed ids and the new row of every id that was moved.
+        """
+        removed, moved = [], {}
+        for node_id in ids:
+            row = self.rows.pop(node_id, None)
+            if row is None:
+                continue
+            removed.append(node_id)
+            moved.pop(node_id, None)
+            last = len(self.ids) - 1
+            if row != last:
+                last_id = self.ids[last]
+                self.vectors[row] = self.vectors[last]
+                self.ids[row] = last_id
+                self.records[row] = self.records[last]
+                self.rows[last_id] = row
+                moved[last_id] = row
+            self.ids.pop()
+            self.records.pop()
+        return removed, moved
+
+    def flush(self):
+        if isinstance(self.vectors, np.memmap):
+            self.vectors.flush()
+
+    def mask(self, filters: List[Tuple[str, Any]], node_ids: Optional[List[str]]) -> Optional[np.ndarray]:
+        if not filters and not node_ids:
+            return None
+        mask = np.fromiter(
+            (all(record.get(key) == value for key, value in filters) for record in self.records),
+            dtype=bool, count=len(self),
+        )
+        if node_ids:
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[[self.rows[node_id] for node_id in node_ids if node_id in self.rows]] = True
+            mask &= allowed
+        return mask
+
+    def search(self, query: np.ndarray, top_k: int, mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        count = len(self)
+        if not count or top_k <= 0:
+            return []
+        scores = self.vectors[:count] @ query
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        top_k = min(top_k, count)
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top if scores[row] != -np.inf]
+
+
+class LocalVectorStore(BasePydanticVectorStore):
+    """
+    In-process vector store partitioned by the `partition_key` metadata, the key the
+    services filter every query on. Queries with an exact match on it only scan that
+    user's matrix. With a path, vectors are memory-mapped files and node records are kept
+    in sqlite, so a second process can read what the ingest service wrote after calling
+    `invalidate`. Without a path everything is in memory and `invalidate` drops the data.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+    path: Optional[str] = Field(default=None, description="Directory for vectors and records.")
+    partition_key: str = Field(default='user')
+
+    _db: Optional[sqlite3.Connection] = PrivateAttr()
+    _partitions: Dict[str, VectorPartition] = PrivateAttr()
+    _owners: Dict[str, str] = PrivateAttr()
+    _lock: threading.RLock = PrivateAttr()
+
+    def __init__(self, path: Optional[str] = None, partition_key: str = 'user', **kwargs: Any):
+        super().__init__(path=path, partition_key=partition_key, **kwargs)
+        self._partitions = {}
+        self._owners = {}
+        self._lock = threading.RLock()
+        self._db = None
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(path, 'nodes.db'), check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS partitions (uid TEXT PRIMARY KEY, dim INTEGER)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS nodes '
+                '(id TEXT PRIMARY KEY, uid TEXT, row INTEGER, ref_doc_id TEXT, record TEXT)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS nodes_uid ON nodes (uid, row)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS nodes_ref_doc_id ON nodes (ref_doc_id)')
+            self._db.commit()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'LocalVectorStore'
+
+    @property
+    def client(self) -> Any:
+        return self._db
+
+    def _file(self, uid: str) -> str:
+        return os.path.join(self.path, hashlib.sha256(uid.encode('utf-8')).hexdigest()[:32] + '.f32')
+
+    def _partition(self, uid: str, dim: Optional[int] = None) -> Optional[VectorPartition]:
+        """
+        Returns the loaded partition of a user, loading it from disk or creating it when
+        `dim` is given.
+        """
+        with self._lock:
+            partition = self._partitions.get(uid)
+            if partition is not None:
+                return partition
+            if self._db is not None:
+                row = self._db.execute('SELECT dim FROM partitions WHERE uid = ?', (uid,)).fetchone()
+                if row is not None:
+                    rows = self._db.execute(
+                        'SELECT id, record FROM nodes WHERE uid = ? ORDER BY row', (uid,)
+                    ).fetchall()
+                    partition = VectorPartition.open(
+                        row[0], self._file(uid),
+                        [node_id for node_id, _ in rows],
+                        [json.loads(record) for _, record in rows],
+                    )
+                elif dim is not None:
+                    partition = VectorPartition(dim, self._file(uid))
+                    self._db.execute('INSERT INTO partitions (uid, dim) VALUES (?, ?)', (uid, dim))
+            elif dim is not None:
+                partition = VectorPartition(dim)
+            if partition is not None:
+                self._partitions[uid] = partition
+            return partition
+
+    def _uids(self) -> List[str]:
+        with self._lock:
+            if self._db is None:
+                return list(self._partitions)
+            return [uid for uid, in self._db.execute('SELECT uid FROM partitions').fetchall()]
+
+    def _owners_of(self, node_ids: List[str]) -> Dict[str, List[str]]:
+        owners = defaultdict(list)
+        if self._db is None:
+            for node_id in node_ids:
+                if node_id in self._owners:
+                    owners[self._owners[node_id]].append(node_id)
+            return owners
+        for i in range(0, len(node_ids), 500):
+            chunk = node_ids[i:i + 500]
+            for node_id, uid in self._db.execute(
+                    f"SELECT id, uid FROM nodes WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall():
+                owners[uid].append(node_id)
+        return owners
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        by_uid: Dict[str, List[BaseNode]] = defaultdict(list)
+        for node in nodes:
+            by_uid[str(node.metadata.get(self.partition_key, ''))].append(node)
+
+        for uid, group in by_uid.items():
+            vectors = normalize(np.asarray([node.get_embedding() for node in group], dtype=np.float32))
+            records = [
+                node_to_metadata_dict(node, remove_text=False, flat_metadata=self.flat_metadata)
+                for node in group
+            ]
+            with self._lock:
+                partition = self._partition(uid, dim=vectors.shape[1])
+                if partition.dim != vectors.shape[1]:
+                    raise ValueError(f"expected {partition.dim} dimensional vectors, got {vectors.shape[1]}")
+                with partition.lock:
+                    written = partition.add([node.node_id for node in group], vectors, records)
+                    partition.flush()
+                if self._db is None:
+                    self._owners.update((node.node_id, uid) for node in group)
+                else:
+                    # vectors are flushed first, so a record never points at a row that is not on disk
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO nodes (id, uid, row, ref_doc_id, record) VALUES (?, ?, ?, ?, ?)',
+                        [
+                            (node.node_id, uid, written[node.node_id], node.ref_doc_id, json.dumps(record))
+                            for node, record in zip(group, records)
+                        ]
+                    )
+                    self._db.commit()
+        return [node.node_id for node in nodes]
+
+    def delete_nodes(self, node_ids: List[str], **delete_kwargs: Any) -> None:
+        with self._lock:
+            for uid, ids in self._owners_of(list(node_ids)).items():
+                partition = self._partition(uid)
+                if partition is None:
+                    continue
+                with partition.lock:
+                    removed, moved = partition.remove(ids)
+                    partition.flush()
+                for node_id in removed:
+                    self._owners.pop(node_id, None)
+                if self._db is not None:
+                    self._db.executemany('DELETE FROM nodes WHERE id = ?', [(node_id,) for node_id in removed])
+                    self._db.executemany('UPDATE nodes SET row = ? WHERE id = ?',
+                                         [(row, node_id) for node_id, row in moved.items()])
+                    self._db.commit()
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            if self._db is not None:
+                ids = [node_id for node_id, in self._db.execute(
+                    'SELECT id FROM nodes WHERE ref_doc_id = ?', (ref_doc_id,)
+                ).fetchall()]
+            else:
+                ids = [
+                    node_id
+                    for partition in self._partitions.values()
+                    for node_id, record in zip(partition.ids, partition.records)
+                    if record.get('ref_doc_id') == ref_doc_id
+                ]
+            self.delete_nodes(ids)
+
+    def _split_filters(self, filters: Optional[MetadataFilters]) -> Tuple[Optional[str], List[Tuple[str, Any]]]:
+        if filters is None:
+            return None, []
+        condition = getattr(getattr(filters, 'condition', None), 'value', 'and')
+        if condition != 'and' and len(filters.filters) > 1:
+            raise ValueError(f"unsupported filter condition {condition}")
+        uid, pairs = None, []
+        for metadata_filter in filters.filters:
+            operator = getattr(getattr(metadata_filter, 'operator', None), 'value', '==')
+            if operator != '==':
+                raise ValueError(f"unsupported filter operator {operator}")
+            if metadata_filter.key == self.partition_key:
+                uid = str(metadata_filter.value)
+            else:
+                pairs.append((metadata_filter.key, metadata_filter.value))
+        return uid, pairs
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.query_embedding is None:
+            raise ValueError("local vector store only supports embedding queries")
+        uid, filters = self._split_filters(query.filters)
+        vector = normalize(np.asarray(query.query_embedding, dtype=np.float32))
+
+        hits = []
+        for partition_uid in ([uid] if uid is not None else self._uids()):
+            partition = self._partition(partition_uid)
+            if partition is None:
+                continue
+            with partition.lock:
+                mask = partition.mask(filters, query.node_ids)
+                for row, score in partition.search(vector, query.similarity_top_k, mask):
+                    hits.append((score, partition.ids[row], partition.records[row]))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        hits = hits[:query.similarity_top_k]
+
+        return VectorStoreQueryResult(
+            nodes=[metadata_dict_to_node(record) for _, _, record in hits],
+            similarities=[score for score, _, _ in hits],
+            ids=[node_id for _, node_id, _ in hits],
+        )
+
+    def invalidate(self, uid: str):
+        with self._lock:
+            partition = self._partitions.pop(uid, None)
+            if partition is not None and self._db is None:
+                for node_id in partition.ids:
+                    self._owners.pop(node_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            partitions = list(self._partitions.values())
+        return {
+            'backend': 'local',
+            'persistent': self._db is not None,
+            'loaded_users': len(partitions),
+            'loaded_vectors': sum(len(partition) for partition in partitions),
+            'loaded_bytes': sum(partition.nbytes for partition in partitions),
+        }
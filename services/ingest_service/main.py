@@ -1,3 +1,6 @@
+# first, so the startup report measures from close to process start
+from startup import lifespan, startup_router
+
 import logging
 
 from dotenv import load_dotenv
@@ -8,10 +11,9 @@ load_dotenv()
 
 
 def create_app():
-    from pipeline.ingest import ingest_router
-
     logging.basicConfig(level=logging.INFO)
-    fastapi = FastAPI()
+    # pipeline.ingest and the clients behind it load in the lifespan, see startup.lifespan
+    fastapi = FastAPI(lifespan=lifespan('pipeline.ingest', ('ingest_router', 'metrics_router')))
     fastapi.add_middleware(
         CORSMiddleware,
         allow_origins=['*'],
@@ -19,7 +21,7 @@ def create_app():
         allow_methods=["*"],
         allow_headers=["*"],
     )
-    fastapi.include_router(ingest_router)
+    fastapi.include_router(startup_router)
     return fastapi
 
 
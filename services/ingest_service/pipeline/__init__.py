@@ -1,13 +1,84 @@
 from abc import ABC, abstractmethod
-from typing import IO
+from enum import Enum
+from typing import IO, Callable, Optional, Iterable, Tuple, Dict, Any, Sequence
+
+from llama_index.core.schema import BaseNode, TextNode, NodeRelationship, RelatedNodeInfo
 
 from app_ctx import ApplicationContext
 
 
+class IngestStatus(str, Enum):
+    QUEUED = 'queued'
+    PARTITIONING = 'partitioning'
+    EMBEDDING = 'embedding'
+    UPSERTING = 'upserting'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+
+
+class CostClass(str, Enum):
+    CHEAP = 'cheap'
+    EXPENSIVE = 'expensive'
+
+
+ProgressCallback = Callable[[IngestStatus], None]
+
+
+def no_progress(status: IngestStatus):
+    pass
+
+
+def make_node(text: str, metadata: Dict[str, Any], source_id: str,
+              excluded_llm_keys: Sequence[str] = ('user',),
+              excluded_embed_keys: Sequence[str] = ('user',)) -> TextNode:
+    return TextNode(
+        text=text,
+        metadata=metadata,
+        excluded_llm_metadata_keys=list(excluded_llm_keys),
+        excluded_embed_metadata_keys=list(excluded_embed_keys),
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=source_id)},
+    )
+
+
 class IngestPipeline(ABC):
+    # routing and scheduling hints, read from the class so the job queue can use them
+    # without building the pipeline
+    name: str = ''
+    mimetypes: Tuple[str, ...] = ()
+    extensions: Tuple[str, ...] = ()
+    cost_class: CostClass = CostClass.EXPENSIVE
+    concurrency: int = 2
+
     def __init__(self, ctx: ApplicationContext):
         self.ctx = ctx
+        self._ingestor = None
+
+    @classmethod
+    def cost_class_for(cls, filename: str, mimetype: str) -> CostClass:
+        return cls.cost_class
+
+    @property
+    def ingestor(self):
+        if self._ingestor is None:
+            from pipeline.stages import BatchedIngestor, BatchSettings
+            self._ingestor = BatchedIngestor(
+                embed_model=self.ctx.embed_model,
+                vector_store=self.ctx.document_vector_store,
+                settings=BatchSettings.from_env(),
+            )
+        return self._ingestor
 
     @abstractmethod
-    def ingest(self, file: IO[bytes], filename: str, mimetype: str, uid: str):
+    def prepare(self, file: IO[bytes], filename: str, mimetype: str, uid: str, report) -> Iterable[BaseNode]:
         pass
+
+    def ingest(self, file: IO[bytes], filename: str, mimetype: str, uid: str,
+               progress: Optional[ProgressCallback] = None):
+        from pipeline.stages import IngestReport
+
+        progress = progress or no_progress
+        report = IngestReport()
+
+        progress(IngestStatus.PARTITIONING)
+        nodes = self.prepare(file, filename, mimetype, uid, report)
+        return self.ingestor.run(nodes, report, progress)
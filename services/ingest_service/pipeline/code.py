@@ -0,0 +1,226 @@
+import ast
+import io
+import logging
+import os
+import re
+import uuid
+from dataclasses import dataclass
+from typing import IO, List, Iterator, Optional
+
+from llama_index.core.schema import BaseNode
+
+from app_ctx import ApplicationContext
+from pipeline import IngestPipeline, CostClass, make_node
+from pipeline.partition import timed
+from pipeline.stages import IngestReport
+
+LANGUAGES = {
+    '.py': 'python',
+    '.js': 'javascript',
+    '.jsx': 'javascript',
+    '.mjs': 'javascript',
+    '.ts': 'typescript',
+    '.tsx': 'tsx',
+    '.java': 'java',
+    '.kt': 'kotlin',
+    '.go': 'go',
+    '.rs': 'rust',
+    '.c': 'c',
+    '.h': 'c',
+    '.cc': 'cpp',
+    '.cpp': 'cpp',
+    '.hpp': 'cpp',
+    '.cs': 'c_sharp',
+    '.rb': 'ruby',
+    '.php': 'php',
+    '.swift': 'swift',
+    '.scala': 'scala',
+    '.sh': 'bash',
+    '.sql': 'sql',
+}
+
+# top level definitions of brace languages, used when tree-sitter is not installed
+DEFINITION = re.compile(
+    r'^(export\s+)?(default\s+)?(public\s+|private\s+|protected\s+|internal\s+|static\s+|abstract\s+|async\s+)*'
+    r'(function|class|interface|enum|struct|impl|trait|fn|func|def|type|const\s+\w+\s*=\s*(async\s+)?\(|'
+    r'[\w<>\[\],\s]+\s+\w+\s*\()'
+)
+
+
+@dataclass
+class CodeChunk:
+    text: str
+    symbol: str
+    start_line: int
+    end_line: int
+
+
+def split_lines(chunk: CodeChunk, max_chars: int) -> Iterator[CodeChunk]:
+    """
+    Splits an oversized definition on line boundaries, repeating its first line so every
+    piece still says what it belongs to.
+    """
+    if len(chunk.text) <= max_chars:
+        yield chunk
+        return
+    lines = chunk.text.splitlines()
+    header = lines[0]
+    piece, size, start = [], 0, chunk.start_line
+    for offset, line in enumerate(lines):
+        if piece and size + len(line) + 1 > max_chars:
+            yield CodeChunk('\n'.join(piece), chunk.symbol, start, chunk.start_line + offset - 1)
+            piece, size, start = [header], len(header) + 1, chunk.start_line + offset
+        piece.append(line[:max_chars])
+        size += len(line) + 1
+    yield CodeChunk('\n'.join(piece), chunk.symbol, start, chunk.end_line)
+
+
+def python_chunks(source: str, max_chars: int) -> Iterator[CodeChunk]:
+    """
+    One chunk per top level function or class, methods of large classes become their own
+    chunks. Statements between definitions are grouped into module chunks.
+    """
+    lines = source.splitlines()
+
+    def segment(start: int, end: int) -> str:
+        return '\n'.join(lines[start - 1:end])
+
+    def definitions(body: List[ast.stmt], prefix: str) -> Iterator[CodeChunk]:
+        loose: List[ast.stmt] = []
+
+        def flush():
+            if loose:
+                start, end = loose[0].lineno, loose[-1].end_lineno
+                text = segment(start, end)
+                if text.strip():
+                    yield CodeChunk(text, prefix or '<module>', start, end)
+                loose.clear()
+
+        for node in body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                loose.append(node)
+                continue
+            yield from flush()
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            symbol = f'{prefix}.{node.name}' if prefix else node.name
+            text = segment(start, node.end_lineno)
+            if isinstance(node, ast.ClassDef) and len(text) > max_chars:
+                yield from definitions(node.body, symbol)
+            else:
+                yield CodeChunk(text, symbol, start, node.end_lineno)
+        yield from flush()
+
+    yield from definitions(ast.parse(source).body, '')
+
+
+def tree_sitter_chunks(source: str, language: str, max_chars: int) -> Optional[List[CodeChunk]]:
+    try:
+        from llama_index.core.node_parser import CodeSplitter
+        splitter = CodeSplitter(language=language, max_chars=max_chars)
+        texts = splitter.split_text(source)
+    except Exception as err:
+        # tree-sitter is an optional dependency, and not every language has a grammar
+        logging.debug(f"tree-sitter chunking for {language} unavailable: {err!r}")
+        return None
+
+    chunks, cursor = [], 0
+    for text in texts:
+        found = source.find(text, cursor)
+        start = source.count('\n', 0, found) + 1 if found >= 0 else 0
+        end = start + text.count('\n') if found >= 0 else 0
+        cursor = found + len(text) if found >= 0 else cursor
+        chunks.append(CodeChunk(text, '', start, end))
+    return chunks
+
+
+def definition_chunks(source: str) -> Iterator[CodeChunk]:
+    """
+    Starts a new chunk at every unindented line that looks like a definition, which is
+    close enough for brace languages formatted the usual way.
+    """
+    lines = source.splitlines()
+    start = 0
+    for index in range(1, len(lines) + 1):
+        at_end = index == len(lines)
+        if at_end or (lines[index][:1].strip() and DEFINITION.match(lines[index])
+                      and not lines[index - 1].strip().startswith('@')):
+            text = '\n'.join(lines[start:index])
+            if text.strip():
+                symbol = next((line.strip() for line in lines[start:index] if DEFINITION.match(line)), '')
+                yield CodeChunk(text, symbol[:120], start + 1, index)
+            start = index
+
+
+def pack(chunks: Iterator[CodeChunk], max_chars: int, min_chars: int) -> Iterator[CodeChunk]:
+    """
+    Merges runs of tiny chunks (one line constants, imports) so they are not embedded alone.
+    """
+    pending: Optional[CodeChunk] = None
+    for chunk in chunks:
+        if pending and len(pending.text) + len(chunk.text) + 1 <= max_chars \
+                and (len(pending.text) < min_chars or len(chunk.text) < min_chars):
+            pending = CodeChunk(
+                f'{pending.text}\n{chunk.text}',
+                ', '.join(filter(None, [pending.symbol, chunk.symbol]))[:200],
+                pending.start_line,
+                chunk.end_line,
+            )
+            continue
+        if pending:
+            yield pending
+        pending = chunk
+    if pending:
+        yield pending
+
+
+class CodePipeline(IngestPipeline):
+    name = 'code'
+    mimetypes = ('text/x-python', 'application/x-python-code', 'text/javascript', 'application/javascript',
+                 'text/x-java-source', 'text/x-go', 'text/x-rust', 'text/x-c', 'text/x-c++')
+    extensions = tuple(LANGUAGES)
+    cost_class = CostClass.CHEAP
+    concurrency = 4
+
+    def __init__(self, ctx: ApplicationContext, max_chars: int = 1500, min_chars: int = 200):
+        super().__init__(ctx)
+        self.max_chars = max_chars
+        self.min_chars = min_chars
+
+    def chunks(self, source: str, language: str) -> Iterator[CodeChunk]:
+        chunks = None
+        if language == 'python':
+            try:
+                chunks = list(python_chunks(source, self.max_chars))
+            except SyntaxError as err:
+                logging.info(f"python source does not parse, chunking by definitions: {err}")
+                chunks = None
+        if chunks is None:
+            chunks = tree_sitter_chunks(source, language, self.max_chars)
+        if chunks is None:
+            chunks = definition_chunks(source)
+        for chunk in pack(iter(chunks), self.max_chars, self.min_chars):
+            yield from split_lines(chunk, self.max_chars)
+
+    def prepare(self, file: IO[bytes], filename: str, mimetype: str, uid: str,
+                report: IngestReport) -> Iterator[BaseNode]:
+        source = io.TextIOWrapper(file, encoding='utf-8', errors='replace').read()
+        language = LANGUAGES.get(os.path.splitext(filename)[1].lower(), 'text')
+        source_id = str(uuid.uuid4())
+
+        chunks = timed(self.chunks(source, language), lambda seconds: report.add_time('chunk', seconds))
+        for chunk in chunks:
+            yield make_node(
+                text=chunk.text,
+                metadata={
+                    'filename': filename,
+                    'filetype': mimetype,
+                    'language': language,
+                    'symbol': chunk.symbol,
+                    'start_line': chunk.start_line,
+                    'end_line': chunk.end_line,
+                    'user': uid,
+                },
+                source_id=source_id,
+                excluded_llm_keys=('filetype', 'user'),
+                excluded_embed_keys=('filetype', 'start_line', 'end_line', 'user'),
+            )
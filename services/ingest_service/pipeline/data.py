@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+import logging
+import uuid
+from typing import IO, Any, Dict, Iterable, Iterator, List, Tuple
+
+from llama_index.core.schema import BaseNode
+
+from app_ctx import ApplicationContext
+from pipeline import IngestPipeline, CostClass, make_node
+from pipeline.partition import timed
+from pipeline.stages import IngestReport
+
+CSV_MIMETYPES = ('text/csv', 'text/tab-separated-values', 'application/csv')
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson')
+
+
+def flatten(value: Any, prefix: str = '') -> Iterator[Tuple[str, Any]]:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}.{key}' if prefix else str(key))
+    elif isinstance(value, list) and any(isinstance(item, (dict, list)) for item in value):
+        for index, item in enumerate(value):
+            yield from flatten(item, f'{prefix}[{index}]')
+    else:
+        yield prefix or 'value', value
+
+
+def render_record(record: Any) -> str:
+    return '\n'.join(f'{key}: {value}' for key, value in flatten(record) if value not in (None, ''))
+
+
+def csv_records(file: IO[bytes], delimiter: str = ',') -> Iterator[Dict[str, str]]:
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', errors='replace', newline='')
+    for row in csv.DictReader(text, delimiter=delimiter):
+        # rows with more fields than the header put the rest under None
+        extra = row.pop(None, None)
+        if extra:
+            row['extra'] = ', '.join(extra)
+        yield row
+
+
+def json_lines_records(file: IO[bytes]) -> Iterator[Any]:
+    for number, line in enumerate(io.TextIOWrapper(file, encoding='utf-8', errors='replace'), start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as err:
+            logging.warning(f"skipping malformed json line {number}: {err}")
+
+
+def json_records(file: IO[bytes]) -> Iterator[Any]:
+    """
+    Streams the items of a top level array, or the key/value pairs of a top level object,
+    without loading the whole file.
+    """
+    import ijson
+
+    head = file.read(64).lstrip()
+    file.seek(0)
+    if head.startswith(b'['):
+        yield from ijson.items(file, 'item', use_float=True)
+    elif head.startswith(b'{'):
+        for key, value in ijson.kvitems(file, '', use_float=True):
+            yield {key: value}
+    else:
+        yield json.load(file)
+
+
+class DataPipeline(IngestPipeline):
+    """
+    Ingests tabular and structured data. Records are streamed and rendered as `key: value`
+    lines, then packed into chunks of whole records, so memory stays bounded by one chunk.
+    """
+
+    name = 'data'
+    mimetypes = CSV_MIMETYPES + ('application/json', 'application/x-ndjson', 'application/jsonl')
+    extensions = ('.csv', '.tsv', '.json') + JSON_LINES_EXTENSIONS
+    cost_class = CostClass.CHEAP
+    concurrency = 4
+
+    def __init__(self, ctx: ApplicationContext, max_chars: int = 1000):
+        super().__init__(ctx)
+        self.max_chars = max_chars
+
+    @staticmethod
+    def records(file: IO[bytes], filename: str, mimetype: str) -> Iterator[Any]:
+        lowered = filename.lower()
+        if lowered.endswith('.tsv') or mimetype == 'text/tab-separated-values':
+            return csv_records(file, delimiter='\t')
+        if lowered.endswith('.csv') or mimetype in CSV_MIMETYPES:
+            return csv_records(file)
+        if lowered.endswith(JSON_LINES_EXTENSIONS) or mimetype in ('application/x-ndjson', 'application/jsonl'):
+            return json_lines_records(file)
+        return json_records(file)
+
+    def pack(self, records: Iterable[Any]) -> Iterator[Tuple[str, int, int]]:
+        """
+        Yields (text, first record, last record). Records longer than a chunk are cut into
+        pieces instead of being dropped.
+        """
+        texts: List[str] = []
+        size, first, last = 0, 0, 0
+        for index, record in enumerate(records):
+            text = render_record(record)
+            if not text:
+                continue
+            if texts and size + len(text) + 2 > self.max_chars:
+                yield '\n\n'.join(texts), first, last
+                texts, size = [], 0
+            if not texts:
+                first = index
+            if len(text) > self.max_chars:
+                for offset in range(0, len(text), self.max_chars):
+                    yield text[offset:offset + self.max_chars], index, index
+                continue
+            texts.append(text)
+            size += len(text) + 2
+            last = index
+        if texts:
+            yield '\n\n'.join(texts), first, last
+
+    def prepare(self, file: IO[bytes], filename: str, mimetype: str, uid: str,
+                report: IngestReport) -> Iterator[BaseNode]:
+        source_id = str(uuid.uuid4())
+        chunks = timed(self.pack(self.records(file, filename, mimetype)),
+                       lambda seconds: report.add_time('chunk', seconds))
+        for text, first, last in chunks:
+            yield make_node(
+                text=text,
+                metadata={
+                    'filename': filename,
+                    'filetype': mimetype,
+                    'first_record': first,
+                    'last_record': last,
+                    'user': uid,
+                },
+                source_id=source_id,
+                excluded_llm_keys=('filetype', 'user'),
+                excluded_embed_keys=('filetype', 'first_record', 'last_record', 'user'),
+            )
@@ -1,18 +1,37 @@
-from typing import IO
+import logging
+import time
+from typing import IO, Optional, List, Iterable, Iterator
 
 from llama_index.core import Document
-from unstructured.partition.api import partition_via_api
+from llama_index.core.node_parser import NodeParser
+from llama_index.core.schema import BaseNode
+from unstructured.documents.elements import Element
 
 from app_ctx import ApplicationContext
-from pipeline import IngestPipeline
+from pipeline import IngestPipeline, CostClass
+from pipeline.partition import DEFAULT_LOCAL_PARTITIONERS, PDF, PartitionRouter, timed, partition_via_pooled_api
+from pipeline.stages import IngestReport
 
 
 class DocumentPipeline(IngestPipeline):
+    # fallback for everything no other pipeline claims
+    name = 'document'
+    cost_class = CostClass.EXPENSIVE
+    concurrency = 4
+
     def __init__(self, ctx: ApplicationContext):
         super().__init__(ctx)
+        self.partitioner = PartitionRouter(remote=self.partition_remote)
+
+    @classmethod
+    def cost_class_for(cls, filename: str, mimetype: str) -> CostClass:
+        # pdfs may still need OCR when they have no text layer
+        if mimetype in DEFAULT_LOCAL_PARTITIONERS and mimetype != PDF:
+            return CostClass.CHEAP
+        return CostClass.EXPENSIVE
 
-    def ingest(self, file: IO[bytes], filename: str, mimetype: str, uid: str):
-        response = partition_via_api(
+    def partition_remote(self, file: IO[bytes], filename: str, mimetype: str):
+        return partition_via_pooled_api(
             file=file,
             metadata_filename=filename,
             api_key=self.ctx.unstructured_api_key,
@@ -21,16 +40,51 @@ class DocumentPipeline(IngestPipeline):
             coordinates=False,
             strategy='hi_res',
         )
-        doc_metadata = {
+
+    def prepare(self, file: IO[bytes], filename: str, mimetype: str, uid: str,
+                report: IngestReport) -> Iterator[BaseNode]:
+        elements, strategy = self.partitioner.partition(file, filename, mimetype)
+        logging.info(f"partitioning {filename} ({mimetype}) with {strategy}")
+        elements = timed(elements, lambda seconds: report.add_time('partition', seconds))
+        return elements_to_nodes(elements, uid, self.ctx.service_context.node_parser, report)
+
+
+def group_elements(elements: Iterable[Element], max_chars: int = 8000) -> Iterator[List[Element]]:
+    """
+    Groups consecutive elements of the same page, so chunks keep their page number
+    without materializing the whole document.
+    """
+    group, size, page = [], 0, None
+    for element in elements:
+        if not element.text:
+            continue
+        element_page = element.metadata.page_number
+        if group and (element_page != page or size + len(element.text) > max_chars):
+            yield group
+            group, size = [], 0
+        group.append(element)
+        size += len(element.text)
+        page = element_page
+    if group:
+        yield group
+
+
+def elements_to_nodes(elements: Iterable[Element], uid: str, node_parser: NodeParser,
+                      report: Optional[IngestReport] = None) -> Iterator[BaseNode]:
+    for group in group_elements(elements):
+        start = time.perf_counter()
+        metadata = {
             key: str(value)
-            for key, value in response[0].metadata.to_dict().items()
+            for key, value in group[0].metadata.to_dict().items()
         }
-        doc_metadata.update({'user': uid})
-
-        self.ctx.document_index.insert(
-            Document(
-                text='\n'.join(node.text for node in response),
-                metadata=doc_metadata,
-                excluded_llm_metadata_keys=['languages', 'filetype', 'user'],
-            )
+        metadata.update({'user': uid})
+
+        document = Document(
+            text='\n'.join(element.text for element in group),
+            metadata=metadata,
+            excluded_llm_metadata_keys=['languages', 'filetype', 'user'],
         )
+        nodes = node_parser.get_nodes_from_documents([document])
+        if report:
+            report.add_time('chunk', time.perf_counter() - start)
+        yield from nodes
@@ -0,0 +1,113 @@
+import logging
+import time
+from typing import IO, Any, Callable, Dict, Iterator, Optional
+
+from llama_index.core import Document
+from llama_index.core.schema import BaseNode
+
+from app_ctx import ApplicationContext
+from pipeline import IngestPipeline, CostClass
+from pipeline.stages import IngestReport
+
+# hooks take the open file, the filename and the mimetype, so tests can swap them for fakes
+MetadataReader = Callable[[IO[bytes], str, str], Dict[str, Any]]
+TextExtractor = Callable[[IO[bytes], str, str], str]
+
+EXIF_TAGS = {
+    0x010F: 'camera_make',
+    0x0110: 'camera_model',
+    0x0132: 'modified_at',
+    0x9003: 'taken_at',
+    0x010E: 'image_description',
+}
+
+
+def read_image_metadata(file: IO[bytes], filename: str, mimetype: str) -> Dict[str, Any]:
+    from PIL import Image
+
+    with Image.open(file) as image:
+        metadata: Dict[str, Any] = {
+            'width': image.width,
+            'height': image.height,
+            'format': image.format or '',
+        }
+        exif = image.getexif()
+        for tag, name in EXIF_TAGS.items():
+            value = exif.get(tag) if exif else None
+            if value:
+                metadata[name] = str(value).strip('\x00 ')
+    return metadata
+
+
+class RemoteTextExtractor:
+    """
+    OCRs an image with the unstructured hi_res API, the same service documents go through.
+    """
+
+    def __init__(self, ctx: ApplicationContext):
+        self.ctx = ctx
+
+    def __call__(self, file: IO[bytes], filename: str, mimetype: str) -> str:
+        from pipeline.partition import partition_via_pooled_api
+
+        elements = partition_via_pooled_api(
+            file=file,
+            metadata_filename=filename,
+            api_key=self.ctx.unstructured_api_key,
+            api_url=self.ctx.unstructured_api_url,
+            content_type=mimetype,
+            coordinates=False,
+            strategy='hi_res',
+        )
+        return '\n'.join(element.text for element in elements if element.text)
+
+
+def describe(filename: str, metadata: Dict[str, Any]) -> str:
+    parts = [f"Image {filename}"]
+    if metadata.get('width') and metadata.get('height'):
+        parts.append(f"{metadata['width']}x{metadata['height']} {metadata.get('format', '')}".strip())
+    if metadata.get('taken_at'):
+        parts.append(f"taken {metadata['taken_at']}")
+    camera = ' '.join(filter(None, [metadata.get('camera_make'), metadata.get('camera_model')]))
+    if camera:
+        parts.append(f"with {camera}")
+    if metadata.get('image_description'):
+        parts.append(metadata['image_description'])
+    return ', '.join(parts)
+
+
+class ImagePipeline(IngestPipeline):
+    name = 'image'
+    mimetypes = ('image/*',)
+    extensions = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp', '.tif', '.tiff', '.heic')
+    cost_class = CostClass.EXPENSIVE
+    concurrency = 2
+
+    def __init__(self, ctx: ApplicationContext, read_metadata: Optional[MetadataReader] = None,
+                 extract_text: Optional[TextExtractor] = None):
+        super().__init__(ctx)
+        self.read_metadata = read_metadata or read_image_metadata
+        self.extract_text = extract_text or RemoteTextExtractor(ctx)
+
+    def prepare(self, file: IO[bytes], filename: str, mimetype: str, uid: str,
+                report: IngestReport) -> Iterator[BaseNode]:
+        start = time.perf_counter()
+        try:
+            metadata = self.read_metadata(file, filename, mimetype)
+        except Exception as err:
+            logging.warning(f"could not read image metadata of {filename}: {err!r}")
+            metadata = {}
+        file.seek(0)
+        text = self.extract_text(file, filename, mimetype)
+        report.add_time('partition', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        document = Document(
+            text='\n\n'.join(filter(None, [describe(filename, metadata), text])),
+            metadata={'filename': filename, 'filetype': mimetype, **metadata, 'user': uid},
+            excluded_llm_metadata_keys=['filetype', 'width', 'height', 'format', 'user'],
+            excluded_embed_metadata_keys=['filetype', 'width', 'height', 'format', 'user'],
+        )
+        nodes = self.ctx.service_context.node_parser.get_nodes_from_documents([document])
+        report.add_time('chunk', time.perf_counter() - start)
+        return iter(nodes)
@@ -1,16 +1,52 @@
-from datetime import datetime
-from pathlib import Path
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Optional
 
-from fastapi import APIRouter
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from google.cloud.storage import Bucket, Blob
+from pydantic import BaseModel, Field
 
-from app_ctx import ApplicationContext
+from app_ctx import get_context
+from metrics import metrics
+from providers import providers
 from pipeline.document import DocumentPipeline
+from pipeline.jobs import IngestJob, IngestJobQueue, QueueFullError, IngestBatchJob
 
 ingest_router = APIRouter(prefix='/api/v1')
+# unauthenticated like any scrape target, it only exposes aggregates
+metrics_router = APIRouter()
 
-context = ApplicationContext()
-document_pipeline = DocumentPipeline(context)
+context = get_context()
+job_queue = IngestJobQueue.create(
+    context,
+    kind=os.getenv('INGEST_EXECUTOR', 'thread'),
+    max_workers=int(os.getenv('INGEST_WORKERS', '4')),
+    max_pending=int(os.getenv('INGEST_MAX_PENDING', '100')),
+    per_user_limit=int(os.getenv('INGEST_PER_USER_LIMIT', '2')),
+    reserved_cheap_workers=int(os.getenv('INGEST_RESERVED_CHEAP_WORKERS', '1')),
+)
+
+metrics.gauge('ingest_jobs', 'Ingest jobs waiting and running',
+              lambda: {(state,): job_queue.get_stats()[state] for state in ('queued', 'running')}, labels=('state',))
+metrics.gauge('ingest_embedding_cache_hit_rate', 'Hit rate of the embedding cache',
+              lambda: context.embedding_cache.get_stats()['hit_rate'])
+
+
+def warm_up_tasks():
+    """
+    Work the first upload would otherwise pay for, run at startup once the clients exist.
+    """
+    if isinstance(job_queue.executor, ProcessPoolExecutor):
+        # jobs run in the workers, which warm their own clients
+        return {'warm.workers': job_queue.start_workers}
+    return {
+        # the tls handshake with openai and the embedding client's first use
+        'warm.embedding': lambda: context.embed_model.get_query_embedding('warm up'),
+        # most uploads are documents, pipelines are otherwise built by their first job
+        'warm.document_pipeline': lambda: job_queue.registry.get(DocumentPipeline.name),
+    }
 
 
 class IngestRequest(BaseModel):
@@ -18,27 +54,167 @@ class IngestRequest(BaseModel):
 
 
 class IngestResponse(BaseModel):
-    pass
+    job_id: str
+    status: str
 
 
-@ingest_router.post('/ingest')
-async def ingest(request: IngestRequest):
-    bucket = context.storage_client.bucket('speedy-atom-413006.appspot.com')
-    blob = bucket.get_blob(request.object_id)
+REQUIRED_METADATA = ('userId', 'filename')
+
+
+def metadata_error(blob: Blob) -> Optional[str]:
+    missing = [key for key in REQUIRED_METADATA if not (blob.metadata or {}).get(key)]
+    return f"object metadata has no {', '.join(missing)}" if missing else None
+
+
+def job_from_blob(blob: Blob) -> IngestJob:
     filename = blob.metadata['filename']
-    uid = blob.metadata['userId']
-    content_type = blob.content_type
+    folder_id = blob.metadata.get('folderId')
+    return IngestJob(
+        object_id=blob.name,
+        uid=blob.metadata['userId'],
+        filename=filename,
+        content_type=blob.content_type,
+        document_key=f'{folder_id}/{filename}' if folder_id else filename,
+        content_hash=blob.md5_hash or '',
+    )
+
+
+@ingest_router.post('/ingest', status_code=202)
+async def ingest(request: IngestRequest):
+    blob = await run_in_threadpool(context.document_bucket.get_blob, request.object_id)
+    if blob is None:
+        raise HTTPException(status_code=404, detail=f"Object {request.object_id} not found")
+    error = metadata_error(blob)
+    if error:
+        raise HTTPException(status_code=422, detail=f"Object {request.object_id}: {error}")
+
+    job = job_from_blob(blob)
+    try:
+        await job_queue.submit(job)
+    except QueueFullError as err:
+        raise HTTPException(status_code=429, detail=str(err), headers={'Retry-After': '5'})
+
+    return IngestResponse(job_id=job.job_id, status=job.status.value)
+
+
+class IngestBatchRequest(BaseModel):
+    object_ids: List[str] = Field(min_length=1, max_length=500)
+
+
+class IngestObjectResult(BaseModel):
+    object_id: str
+    status: str
+    job_id: Optional[str] = None
+    error: Optional[str] = None
+
 
-    with blob.open("rb") as file:
-        document_pipeline.ingest(file, filename, content_type, uid)
+class IngestBatchResponse(BaseModel):
+    results: List[IngestObjectResult]
 
-    file_data = {
-        'objectId': request.object_id,
-        'timestamp': str(datetime.now()),
-        'status': 'processed'
+
+def fetch_blobs(bucket: Bucket, object_ids: List[str], concurrency: int = 16) -> List[Optional[Blob]]:
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(object_ids))) as pool:
+        return list(pool.map(bucket.get_blob, object_ids))
+
+
+@ingest_router.post('/ingest/batch', status_code=202)
+async def ingest_batch(request: IngestBatchRequest):
+    object_ids = list(dict.fromkeys(request.object_ids))
+    blobs = await run_in_threadpool(fetch_blobs, context.document_bucket, object_ids)
+
+    results = {}
+    # one batch job per user and pipeline, batches share embedding batches within a pipeline
+    jobs_by_key: dict[tuple, List[IngestJob]] = {}
+    seen_content = {}
+    for object_id, blob in zip(object_ids, blobs):
+        if blob is None:
+            results[object_id] = IngestObjectResult(object_id=object_id, status='not_found')
+            continue
+        error = metadata_error(blob)
+        if error:
+            results[object_id] = IngestObjectResult(object_id=object_id, status='invalid', error=error)
+            continue
+        uid = blob.metadata['userId']
+        # composite objects have no md5, their content cannot be compared
+        content_key = (uid, blob.md5_hash) if blob.md5_hash else None
+        if content_key in seen_content:
+            results[object_id] = IngestObjectResult(
+                object_id=object_id,
+                status='duplicate',
+                error=f"same content as {seen_content[content_key]}"
+            )
+            continue
+        if content_key:
+            seen_content[content_key] = object_id
+        job = job_queue.classify(job_from_blob(blob))
+        jobs_by_key.setdefault((uid, job.pipeline), []).append(job)
+
+    for (uid, _), items in jobs_by_key.items():
+        job = IngestBatchJob(uid=uid, items=items)
+        try:
+            await job_queue.submit(job)
+            status, error = job.status.value, None
+        except QueueFullError as err:
+            status, error = 'rejected', str(err)
+        for item in items:
+            results[item.object_id] = IngestObjectResult(
+                object_id=item.object_id,
+                status=status,
+                job_id=job.job_id if not error else None,
+                error=error,
+            )
+
+    return IngestBatchResponse(results=[results[object_id] for object_id in object_ids])
+
+
+@ingest_router.get('/ingest/jobs/{job_id}')
+async def get_job(job_id: str):
+    job = job_queue.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return IngestResponse(job_id=job.job_id, status=job.status.value)
+
+
+@ingest_router.get('/ingest/jobs/{job_id}/trace')
+async def get_job_trace(job_id: str):
+    job = job_queue.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return {
+        'job_id': job.job_id,
+        'pipeline': job.pipeline,
+        'status': job.status.value,
+        'error': job.error,
+        'report': job.report.to_dict() if job.report else None,
     }
-    object_name = Path(request.object_id).name
-    queue = context.db_client.collection('users').document(uid).collection('file_queue')
-    queue.document(object_name).set(file_data)
 
-    return IngestResponse()
+
+@ingest_router.get('/stats/jobs')
+async def get_job_stats():
+    return job_queue.get_stats()
+
+
+@ingest_router.get('/stats/partition')
+async def get_partition_stats():
+    # pipelines live in the worker processes when INGEST_EXECUTOR=process
+    pipeline = job_queue.registry.built(DocumentPipeline.name)
+    partitioner = getattr(pipeline, 'partitioner', None)
+    return partitioner.get_stats() if partitioner else {}
+
+
+@ingest_router.get('/stats/embedding-cache')
+async def get_embedding_cache_stats():
+    return context.embedding_cache.get_stats()
+
+
+@ingest_router.get('/stats/providers')
+async def get_provider_stats():
+    # gates live in the worker processes when INGEST_EXECUTOR=process
+    return providers.get_stats()
+
+
+@metrics_router.get('/metrics')
+async def get_metrics(format: str = 'prometheus'):
+    if format == 'json':
+        return metrics.to_dict()
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,554 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Deque, Optional, List, Union, Iterator
+
+from llama_index.core.schema import BaseNode, MetadataMode
+
+from app_ctx import ApplicationContext
+from keyword_index import GcsKeywordIndexStore, KeywordDocument
+from metrics import metrics, JOB_BUCKETS
+from pipeline import IngestStatus, CostClass
+from pipeline.manifest import IncrementalIndexer, ManifestBuilder, ManifestDiff, FirestoreManifestStore, \
+    SqliteManifestStore, delete_vectors
+from pipeline.registry import PipelineRegistry, build_registry
+from pipeline.stages import BatchedIngestor, BatchSettings, IngestReport, merge_streams
+from startup import lazy_names, warm_up
+
+QUEUE_WAIT_SECONDS = metrics.histogram('ingest_queue_wait_seconds', 'Time jobs wait for a worker',
+                                       labels=('cost_class',), buckets=JOB_BUCKETS)
+JOB_SECONDS = metrics.histogram('ingest_job_seconds', 'Run time of ingest jobs', labels=('pipeline', 'status'),
+                                buckets=JOB_BUCKETS)
+STAGE_SECONDS = metrics.histogram('ingest_stage_seconds', 'Busy time of an ingest job in each stage',
+                                  labels=('pipeline', 'stage'), buckets=JOB_BUCKETS)
+CHUNKS = metrics.counter('ingest_chunks_total', 'Chunks ingested', labels=('pipeline',))
+TOKENS = metrics.counter('ingest_tokens_total', 'Tokens embedded', labels=('pipeline',))
+RETRIES = metrics.counter('ingest_retries_total', 'Retried embedding and upsert batches', labels=('pipeline',))
+
+
+@dataclass
+class IngestJob:
+    object_id: str
+    uid: str
+    filename: str
+    content_type: str
+    # identifies the logical file across uploads, and the hash of this upload's bytes
+    document_key: str = ''
+    content_hash: str = ''
+    # set by the queue from the pipeline registry when left empty
+    pipeline: str = ''
+    cost_class: CostClass = CostClass.EXPENSIVE
+    job_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: IngestStatus = IngestStatus.QUEUED
+    error: Optional[str] = None
+    # set by the runner, kept on the job for its trace
+    report: Optional[IngestReport] = None
+
+    def __post_init__(self):
+        self.document_key = self.document_key or self.filename
+
+
+@dataclass
+class IngestBatchJob:
+    """
+    Objects of one user that go through the same pipeline.
+    """
+
+    uid: str
+    items: List[IngestJob]
+    job_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: IngestStatus = IngestStatus.QUEUED
+    error: Optional[str] = None
+    report: Optional[IngestReport] = None
+
+    @property
+    def pipeline(self) -> str:
+        return self.items[0].pipeline if self.items else ''
+
+    @property
+    def cost_class(self) -> CostClass:
+        if any(item.cost_class == CostClass.EXPENSIVE for item in self.items):
+            return CostClass.EXPENSIVE
+        return CostClass.CHEAP
+
+    def set_status(self, status: IngestStatus, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        for item in self.items:
+            if item.status != IngestStatus.FAILED:
+                item.status = status
+                item.error = error
+                item.job_id = self.job_id
+
+
+AnyIngestJob = Union[IngestJob, IngestBatchJob]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobStatusStore(ABC):
+    @abstractmethod
+    def update(self, job: IngestJob):
+        pass
+
+    def update_many(self, jobs: List[IngestJob]):
+        for job in jobs:
+            self.update(job)
+
+    def write(self, job: AnyIngestJob):
+        if isinstance(job, IngestBatchJob):
+            self.update_many(job.items)
+        else:
+            self.update(job)
+
+
+class FirestoreJobStatusStore(JobStatusStore):
+    # firestore caps a batched write at 500 operations
+    MAX_BATCH_WRITES = 500
+
+    def __init__(self, db_client):
+        self.db_client = db_client
+
+    def _writes(self, job: IngestJob):
+        file_data = {
+            'objectId': job.object_id,
+            'jobId': job.job_id,
+            'timestamp': str(datetime.now()),
+            'status': job.status.value,
+        }
+        if job.error:
+            file_data['error'] = job.error
+        object_name = Path(job.object_id).name
+        queue = self.db_client.collection('users').document(job.uid).collection('file_queue')
+        yield queue.document(object_name), file_data
+
+    def _index_state_write(self, uid: str, object_id: str):
+        # lets the chat service drop anything it cached for this user
+        return self.db_client.collection('index_state').document(uid), {
+            'objectId': object_id,
+            'timestamp': str(datetime.now()),
+        }
+
+    def update(self, job: IngestJob):
+        for ref, data in self._writes(job):
+            ref.set(data)
+        if job.status == IngestStatus.PROCESSED:
+            ref, data = self._index_state_write(job.uid, job.object_id)
+            ref.set(data)
+
+    def update_many(self, jobs: List[IngestJob]):
+        writes = [write for job in jobs for write in self._writes(job)]
+        processed = {job.uid: job.object_id for job in jobs if job.status == IngestStatus.PROCESSED}
+        writes.extend(self._index_state_write(uid, object_id) for uid, object_id in processed.items())
+
+        for i in range(0, len(writes), self.MAX_BATCH_WRITES):
+            batch = self.db_client.batch()
+            for ref, data in writes[i:i + self.MAX_BATCH_WRITES]:
+                batch.set(ref, data)
+            batch.commit()
+
+
+class InMemoryJobStatusStore(JobStatusStore):
+    def __init__(self):
+        self.history: Dict[str, list[IngestStatus]] = {}
+
+    def update(self, job: IngestJob):
+        self.history.setdefault(job.object_id, []).append(job.status)
+
+
+class IngestJobRunner:
+    def __init__(self, ctx: ApplicationContext, registry: PipelineRegistry, status_store: JobStatusStore,
+                 ingestor: BatchedIngestor, indexer: IncrementalIndexer, partition_concurrency: int = 4,
+                 keyword_store: Optional[GcsKeywordIndexStore] = None):
+        self.ctx = ctx
+        self.registry = registry
+        self.status_store = status_store
+        self.ingestor = ingestor
+        self.indexer = indexer
+        self.keyword_store = keyword_store
+        self.partition_concurrency = partition_concurrency
+
+    def set_status(self, job: AnyIngestJob, status: IngestStatus, error: Optional[str] = None):
+        if isinstance(job, IngestBatchJob):
+            job.set_status(status, error)
+        else:
+            job.status = status
+            job.error = error
+        try:
+            self.status_store.write(job)
+        except Exception as err:
+            logging.error(f"failed to update status of job {job.job_id}: {err!r}")
+
+    def __call__(self, job: AnyIngestJob) -> AnyIngestJob:
+        try:
+            if isinstance(job, IngestBatchJob):
+                self.run_batch(job)
+            else:
+                self.run(job)
+            self.set_status(job, IngestStatus.PROCESSED)
+        except Exception as err:
+            logging.exception(f"ingest job {job.job_id} failed")
+            self.set_status(job, IngestStatus.FAILED, repr(err))
+        return job
+
+    def _is_unchanged(self, item: IngestJob) -> bool:
+        if self.indexer.is_unchanged(item.uid, item.document_key, item.content_hash):
+            logging.info(f"skipping {item.object_id}, {item.document_key} is unchanged")
+            return True
+        return False
+
+    def _stream(self, item: IngestJob, builder: ManifestBuilder, report: IngestReport,
+                keywords: List[KeywordDocument]) -> Iterator[BaseNode]:
+        pipeline = self.registry.get(item.pipeline or self.registry.classify(item.filename, item.content_type)[0])
+        blob = self.ctx.document_bucket.blob(item.object_id)
+        with blob.open("rb") as file:
+            nodes = pipeline.prepare(file, item.filename, item.content_type, item.uid, report)
+            for node in builder.filter(nodes):
+                if self.keyword_store:
+                    keywords.append(keyword_document(node))
+                yield node
+
+    def _finish(self, item: IngestJob, builder: ManifestBuilder) -> ManifestDiff:
+        diff = builder.finish()
+        logging.info(f"{item.object_id}: {diff.new_chunks} new, {diff.unchanged} unchanged, "
+                     f"{len(diff.stale_ids)} stale chunks")
+        return diff
+
+    def _commit(self, uid: str, diffs: List[ManifestDiff], keywords: List[KeywordDocument]):
+        stale_ids = [node_id for diff in diffs for node_id in diff.stale_ids]
+        if self.keyword_store:
+            self.keyword_store.update(uid, keywords, stale_ids)
+        # stale vectors are removed only once their replacements are in the index
+        delete_vectors(self.ctx.document_vector_store, uid, stale_ids)
+        for diff in diffs:
+            self.indexer.commit(diff)
+
+    def run(self, job: IngestJob):
+        if self._is_unchanged(job):
+            return
+        self.set_status(job, IngestStatus.PARTITIONING)
+        report = job.report = IngestReport()
+        builder = self.indexer.begin(job.uid, job.document_key, job.content_hash)
+        keywords: List[KeywordDocument] = []
+        self.ingestor.run(
+            self._stream(job, builder, report, keywords),
+            report,
+            progress=lambda status: self.set_status(job, status)
+        )
+        self._commit(job.uid, [self._finish(job, builder)], keywords)
+        logging.info(f"ingested {job.object_id}: {report.to_dict()}")
+
+    def run_batch(self, job: IngestBatchJob):
+        """
+        Streams the objects of the batch concurrently into one ingestor run, so the chunks
+        of all objects share embedding/upsert batches.
+        """
+        report = job.report = IngestReport()
+        items = [item for item in job.items if not self._is_unchanged(item)]
+        builders = [self.indexer.begin(item.uid, item.document_key, item.content_hash) for item in items]
+        keywords: List[List[KeywordDocument]] = [[] for _ in items]
+
+        def on_error(index: int, err: Exception):
+            item = items[index]
+            logging.error(f"failed to ingest {item.object_id}: {err!r}")
+            item.status = IngestStatus.FAILED
+            item.error = repr(err)
+
+        self.set_status(job, IngestStatus.PARTITIONING)
+        nodes = merge_streams(
+            [self._stream(item, builder, report, item_keywords)
+             for item, builder, item_keywords in zip(items, builders, keywords)],
+            concurrency=self.partition_concurrency,
+            on_error=on_error,
+        )
+        try:
+            self.ingestor.run(nodes, report, progress=lambda status: self.set_status(job, status))
+        finally:
+            # stops the partition threads when the ingestor gave up on the stream
+            nodes.close()
+
+        succeeded = [
+            (item, builder, item_keywords) for item, builder, item_keywords in zip(items, builders, keywords)
+            if item.status != IngestStatus.FAILED
+        ]
+        if items and not succeeded:
+            raise RuntimeError(f"all {len(items)} changed objects failed to ingest")
+        self._commit(
+            job.uid,
+            [self._finish(item, builder) for item, builder, _ in succeeded],
+            [document for _, _, item_keywords in succeeded for document in item_keywords],
+        )
+        logging.info(f"ingested batch {job.job_id} ({len(job.items)} objects): {report.to_dict()}")
+
+
+def keyword_document(node: BaseNode) -> KeywordDocument:
+    # metadata such as the filename is searchable, the stored text is the chunk alone
+    return KeywordDocument.from_text(
+        node.node_id,
+        node.get_content(metadata_mode=MetadataMode.NONE),
+        node.metadata,
+        searchable=node.get_content(metadata_mode=MetadataMode.EMBED),
+    )
+
+
+def build_manifest_store(ctx: ApplicationContext):
+    if os.getenv('INGEST_MANIFEST_STORE', 'firestore') == 'sqlite':
+        return SqliteManifestStore(os.getenv('INGEST_MANIFEST_PATH', 'manifest.db'))
+    return FirestoreManifestStore(ctx.db_client)
+
+
+def build_runner(ctx: ApplicationContext, registry: Optional[PipelineRegistry] = None) -> IngestJobRunner:
+    return IngestJobRunner(
+        ctx,
+        registry or build_registry(ctx),
+        FirestoreJobStatusStore(ctx.db_client),
+        ingestor=BatchedIngestor(ctx.embed_model, ctx.document_vector_store, BatchSettings.from_env()),
+        indexer=IncrementalIndexer(build_manifest_store(ctx)),
+        partition_concurrency=int(os.getenv('INGEST_PARTITION_CONCURRENCY', '4')),
+        keyword_store=GcsKeywordIndexStore(ctx.document_bucket)
+        if os.getenv('KEYWORD_INDEX_ENABLED', 'true').lower() == 'true' else None,
+    )
+
+
+_process_runner: Optional[IngestJobRunner] = None
+
+
+def _init_worker_process():
+    global _process_runner
+    ctx = ApplicationContext()
+    # the first job should not wait on the clients one after another
+    warm_up({name: lambda name=name: getattr(ctx, name) for name in lazy_names(ctx)}, timed=False)
+    _process_runner = build_runner(ctx)
+
+
+def _run_in_worker_process(job: AnyIngestJob) -> AnyIngestJob:
+    return _process_runner(job)
+
+
+def _snapshot(job: AnyIngestJob) -> AnyIngestJob:
+    if isinstance(job, IngestBatchJob):
+        return replace(job, items=[replace(item) for item in job.items])
+    return replace(job)
+
+
+class IngestJobQueue:
+    """
+    Runs ingest jobs on a thread or process pool. Jobs wait in per-user queues that are
+    dispatched round-robin, so one user uploading a folder cannot starve everyone else.
+
+    Cheap jobs are dispatched first and expensive ones never take the last
+    `reserved_cheap_workers` workers, so a batch of videos cannot hold up markdown notes.
+    Each pipeline is further capped at the concurrency it declares.
+    """
+
+    def __init__(self, runner: Callable[[AnyIngestJob], AnyIngestJob], status_store: JobStatusStore,
+                 executor: Executor, max_workers: int, registry: PipelineRegistry, max_pending: int = 100,
+                 per_user_limit: int = 2, max_finished: int = 1000, reserved_cheap_workers: int = 1):
+        self.runner = runner
+        self.status_store = status_store
+        self.executor = executor
+        self.max_workers = max_workers
+        self.registry = registry
+        self.max_pending = max_pending
+        self.per_user_limit = per_user_limit
+        self.max_finished = max_finished
+        self.max_expensive = max(1, max_workers - reserved_cheap_workers)
+        self.jobs: OrderedDict[str, AnyIngestJob] = OrderedDict()
+        self._waiting: Dict[CostClass, OrderedDict[str, Deque[AnyIngestJob]]] = {
+            cost_class: OrderedDict() for cost_class in (CostClass.CHEAP, CostClass.EXPENSIVE)
+        }
+        self._running_by_user: Dict[str, int] = {}
+        self._running_by_pipeline: Dict[str, int] = {}
+        self._running_expensive = 0
+        self._running = 0
+        self._queued = 0
+        self._queued_at: Dict[str, float] = {}
+
+    @classmethod
+    def create(cls, ctx: ApplicationContext, kind: str = 'thread', max_workers: int = 4,
+               **kwargs) -> 'IngestJobQueue':
+        status_store = FirestoreJobStatusStore(ctx.db_client)
+        registry = build_registry(ctx)
+        if kind == 'process':
+            # spawn so workers build their own clients instead of inheriting the parent's
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker_process,
+            )
+            return cls(_run_in_worker_process, status_store, executor, max_workers, registry, **kwargs)
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        return cls(build_runner(ctx, registry), status_store, executor, max_workers, registry, **kwargs)
+
+    def start_workers(self):
+        """
+        Starts every worker process now rather than with the first jobs. Blocks until each
+        has built its runner.
+        """
+        if isinstance(self.executor, ProcessPoolExecutor):
+            # the pool spawns a worker per submit while none is idle
+            for future in [self.executor.submit(os.getpid) for _ in range(self.max_workers)]:
+                future.result()
+
+    @property
+    def pending(self) -> int:
+        return self._queued + self._running
+
+    def get_job(self, job_id: str) -> Optional[AnyIngestJob]:
+        return self.jobs.get(job_id)
+
+    def classify(self, job: IngestJob) -> IngestJob:
+        if not job.pipeline:
+            job.pipeline, job.cost_class = self.registry.classify(job.filename, job.content_type)
+        return job
+
+    async def submit(self, job: AnyIngestJob) -> AnyIngestJob:
+        if self.pending >= self.max_pending:
+            raise QueueFullError(f"ingest queue is full ({self.pending} pending)")
+
+        if isinstance(job, IngestBatchJob):
+            for item in job.items:
+                self.classify(item)
+            if len({item.pipeline for item in job.items}) > 1:
+                raise ValueError("a batch job must only contain objects of one pipeline")
+            job.set_status(IngestStatus.QUEUED)
+        else:
+            self.classify(job)
+            job.status = IngestStatus.QUEUED
+        self.jobs[job.job_id] = job
+        self._queued += 1
+        self._queued_at[job.job_id] = time.perf_counter()
+        self._trim_finished()
+
+        # written before the job becomes runnable so it cannot overwrite a later stage
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.status_store.write, _snapshot(job))
+        except BaseException:
+            # never runnable, so nothing would ever give its place in the queue back
+            self.jobs.pop(job.job_id, None)
+            self._queued -= 1
+            self._queued_at.pop(job.job_id, None)
+            raise
+        self._waiting[job.cost_class].setdefault(job.uid, deque()).append(job)
+        self._dispatch()
+        return job
+
+    def _can_start(self, job: AnyIngestJob) -> bool:
+        if self._running_by_user.get(job.uid, 0) >= self.per_user_limit:
+            return False
+        if self._running_by_pipeline.get(job.pipeline, 0) >= self.registry.concurrency(job.pipeline):
+            return False
+        return job.cost_class != CostClass.EXPENSIVE or self._running_expensive < self.max_expensive
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        progressed = True
+        while progressed and self._running < self.max_workers:
+            progressed = False
+            for cost_class, waiting_by_user in self._waiting.items():
+                for uid in list(waiting_by_user):
+                    if self._running >= self.max_workers:
+                        return
+                    waiting = waiting_by_user[uid]
+                    # skip past jobs whose pipeline is saturated instead of blocking the user
+                    job = next((job for job in waiting if self._can_start(job)), None)
+                    if job is None:
+                        continue
+                    waiting.remove(job)
+                    if not waiting:
+                        del waiting_by_user[uid]
+                    else:
+                        waiting_by_user.move_to_end(uid)
+
+                    self._queued -= 1
+                    self._running += 1
+                    QUEUE_WAIT_SECONDS.labels(cost_class.value).observe(
+                        time.perf_counter() - self._queued_at.pop(job.job_id, time.perf_counter())
+                    )
+                    self._running_by_user[uid] = self._running_by_user.get(uid, 0) + 1
+                    self._running_by_pipeline[job.pipeline] = self._running_by_pipeline.get(job.pipeline, 0) + 1
+                    if cost_class == CostClass.EXPENSIVE:
+                        self._running_expensive += 1
+                    future = loop.run_in_executor(self.executor, self.runner, job)
+                    future.add_done_callback(
+                        lambda f, job=job, cost_class=cost_class: self._on_done(job, cost_class, f)
+                    )
+                    progressed = True
+
+    def _on_done(self, job: AnyIngestJob, cost_class: CostClass, future: asyncio.Future):
+        self._running -= 1
+        self._running_by_user[job.uid] -= 1
+        if not self._running_by_user[job.uid]:
+            del self._running_by_user[job.uid]
+        self._running_by_pipeline[job.pipeline] -= 1
+        if cost_class == CostClass.EXPENSIVE:
+            self._running_expensive -= 1
+
+        if future.cancelled() or future.exception():
+            error = repr(future.exception()) if not future.cancelled() else 'cancelled'
+            if isinstance(job, IngestBatchJob):
+                job.set_status(IngestStatus.FAILED, error)
+            else:
+                job.status = IngestStatus.FAILED
+                job.error = error
+            logging.error(f"ingest job {job.job_id} did not complete: {job.error}")
+            asyncio.get_running_loop().run_in_executor(None, self.status_store.write, _snapshot(job))
+        else:
+            # process workers return a copy of the job
+            result = future.result()
+            job.status, job.error, job.report = result.status, result.error, result.report
+            if isinstance(job, IngestBatchJob):
+                job.items = result.items
+        self._observe(job)
+        self._dispatch()
+
+    @staticmethod
+    def _observe(job: AnyIngestJob):
+        # recorded here rather than in the runner so process workers count too
+        report = job.report
+        if report is None:
+            return
+        pipeline = job.pipeline
+        JOB_SECONDS.labels(pipeline, job.status.value).observe(report.total_s)
+        for stage, seconds in report.stage_s.items():
+            STAGE_SECONDS.labels(pipeline, stage).observe(seconds)
+        CHUNKS.labels(pipeline).inc(report.chunks)
+        TOKENS.labels(pipeline).inc(report.tokens)
+        RETRIES.labels(pipeline).inc(report.retries)
+
+    def _trim_finished(self):
+        finished = [
+            job_id for job_id, job in self.jobs.items()
+            if job.status in (IngestStatus.PROCESSED, IngestStatus.FAILED)
+        ]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'queued': self._queued,
+            'running': self._running,
+            'running_expensive': self._running_expensive,
+            'running_by_pipeline': {name: count for name, count in self._running_by_pipeline.items() if count},
+            'queued_by_cost_class': {
+                cost_class.value: sum(len(waiting) for waiting in waiting_by_user.values())
+                for cost_class, waiting_by_user in self._waiting.items()
+            },
+            'max_workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'users_waiting': len({uid for waiting_by_user in self._waiting.values() for uid in waiting_by_user}),
+        }
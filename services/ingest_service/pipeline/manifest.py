@@ -0,0 +1,200 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional, Iterable, Iterator
+
+from llama_index.core.schema import BaseNode, MetadataMode
+
+
+def short_hash(*parts: str) -> str:
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+
+@dataclass
+class DocumentManifest:
+    uid: str
+    document_key: str
+    file_hash: str
+    chunk_hashes: List[str] = field(default_factory=list)
+    updated_at: str = field(default_factory=lambda: str(datetime.now()))
+
+    @property
+    def doc_id(self) -> str:
+        return document_id(self.uid, self.document_key)
+
+    def node_ids(self, chunk_hashes: Optional[List[str]] = None) -> List[str]:
+        if chunk_hashes is None:
+            chunk_hashes = self.chunk_hashes
+        return [node_id(self.doc_id, digest) for digest in chunk_hashes]
+
+
+def document_id(uid: str, document_key: str) -> str:
+    return short_hash(uid, document_key)
+
+
+def node_id(doc_id: str, chunk_hash: str) -> str:
+    return f'{doc_id}-{chunk_hash}'
+
+
+def chunk_hash(node: BaseNode) -> str:
+    return short_hash(node.get_content(metadata_mode=MetadataMode.NONE))
+
+
+class ManifestStore(ABC):
+    @abstractmethod
+    def get(self, uid: str, document_key: str) -> Optional[DocumentManifest]:
+        pass
+
+    @abstractmethod
+    def put(self, manifest: DocumentManifest):
+        pass
+
+    @abstractmethod
+    def delete(self, uid: str, document_key: str):
+        pass
+
+
+class SqliteManifestStore(ManifestStore):
+    def __init__(self, path: str = ':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS manifests ('
+            'uid TEXT, document_key TEXT, file_hash TEXT, chunk_hashes TEXT, updated_at TEXT, '
+            'PRIMARY KEY (uid, document_key))'
+        )
+        self._conn.commit()
+
+    def get(self, uid: str, document_key: str) -> Optional[DocumentManifest]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT file_hash, chunk_hashes, updated_at FROM manifests WHERE uid = ? AND document_key = ?',
+                (uid, document_key)
+            ).fetchone()
+        if not row:
+            return None
+        return DocumentManifest(uid, document_key, row[0], json.loads(row[1]), row[2])
+
+    def put(self, manifest: DocumentManifest):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?)',
+                (manifest.uid, manifest.document_key, manifest.file_hash,
+                 json.dumps(manifest.chunk_hashes), manifest.updated_at)
+            )
+            self._conn.commit()
+
+    def delete(self, uid: str, document_key: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM manifests WHERE uid = ? AND document_key = ?', (uid, document_key))
+            self._conn.commit()
+
+
+class FirestoreManifestStore(ManifestStore):
+    def __init__(self, db_client):
+        self.db_client = db_client
+
+    def _ref(self, uid: str, document_key: str):
+        return self.db_client.collection('users').document(uid) \
+            .collection('ingest_manifest').document(document_id(uid, document_key))
+
+    def get(self, uid: str, document_key: str) -> Optional[DocumentManifest]:
+        snapshot = self._ref(uid, document_key).get()
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        return DocumentManifest(uid, document_key, data['fileHash'], data['chunkHashes'], data['updatedAt'])
+
+    def put(self, manifest: DocumentManifest):
+        self._ref(manifest.uid, manifest.document_key).set({
+            'documentKey': manifest.document_key,
+            'fileHash': manifest.file_hash,
+            'chunkHashes': manifest.chunk_hashes,
+            'updatedAt': manifest.updated_at,
+        })
+
+    def delete(self, uid: str, document_key: str):
+        self._ref(uid, document_key).delete()
+
+
+@dataclass
+class ManifestDiff:
+    manifest: DocumentManifest
+    new_chunks: int
+    stale_ids: List[str]
+    unchanged: int
+
+
+class ManifestBuilder:
+    def __init__(self, manifest: DocumentManifest, previous: Optional[DocumentManifest]):
+        self.manifest = manifest
+        self.known = set(previous.chunk_hashes) if previous else set()
+        self.previous = previous
+        self.new_chunks = 0
+        self._seen = set()
+
+    def filter(self, nodes: Iterable[BaseNode]) -> Iterator[BaseNode]:
+        """
+        Assigns stable ids while streaming and only yields chunks that are not indexed yet.
+        """
+        for node in nodes:
+            digest = chunk_hash(node)
+            if digest in self._seen:
+                continue
+            self._seen.add(digest)
+            self.manifest.chunk_hashes.append(digest)
+            node.id_ = node_id(self.manifest.doc_id, digest)
+            if digest not in self.known:
+                self.new_chunks += 1
+                yield node
+
+    def finish(self) -> ManifestDiff:
+        stale = [digest for digest in self.previous.chunk_hashes if digest not in self._seen] \
+            if self.previous else []
+        return ManifestDiff(
+            manifest=self.manifest,
+            new_chunks=self.new_chunks,
+            stale_ids=self.manifest.node_ids(stale),
+            unchanged=len(self._seen) - self.new_chunks,
+        )
+
+
+class IncrementalIndexer:
+    """
+    Gives every chunk a stable id derived from the user, the document and the chunk text,
+    so re-ingesting a document only embeds new chunks and deletes the ones that went away.
+    """
+
+    def __init__(self, store: ManifestStore):
+        self.store = store
+
+    def is_unchanged(self, uid: str, document_key: str, file_hash: Optional[str]) -> bool:
+        if not file_hash:
+            return False
+        manifest = self.store.get(uid, document_key)
+        return manifest is not None and manifest.file_hash == file_hash
+
+    def begin(self, uid: str, document_key: str, file_hash: str) -> ManifestBuilder:
+        previous = self.store.get(uid, document_key)
+        return ManifestBuilder(DocumentManifest(uid, document_key, file_hash or ''), previous)
+
+    def commit(self, diff: ManifestDiff):
+        self.store.put(diff.manifest)
+
+
+def delete_vectors(vector_store, uid: str, ids: List[str]):
+    if not ids:
+        return
+    if hasattr(vector_store, 'shard'):
+        vector_store = vector_store.shard(uid)
+    if hasattr(vector_store, 'delete_nodes'):
+        vector_store.delete_nodes(ids)
+    else:
+        # legacy pinecone store only deletes by ref_doc_id, go through the index client
+        for i in range(0, len(ids), 1000):
+            vector_store.client.delete(ids=ids[i:i + 1000], namespace=vector_store.namespace)
+
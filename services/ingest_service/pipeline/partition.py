@@ -0,0 +1,202 @@
+import logging
+import mimetypes
+import threading
+import time
+from dataclasses import dataclass
+from typing import IO, Callable, Dict, List, Optional, Tuple, Iterable, Iterator
+
+from unstructured.documents.elements import Element, ElementMetadata, Text
+
+from providers import providers
+
+RemotePartitioner = Callable[[IO[bytes], str, str], Iterable[Element]]
+LocalPartitioner = Callable[[IO[bytes], str, str], Optional[Iterable[Element]]]
+
+UNSTRUCTURED_API_URL = 'https://api.unstructured.io/general/v0/general'
+
+MARKDOWN = 'text/markdown'
+DOCX = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+PDF = 'application/pdf'
+
+
+def resolve_mimetype(filename: str, content_type: Optional[str]) -> str:
+    if content_type and content_type not in ('application/octet-stream', 'binary/octet-stream'):
+        return content_type.split(';')[0].strip()
+    if filename.lower().endswith(('.md', '.markdown')):
+        return MARKDOWN
+    guessed, _ = mimetypes.guess_type(filename)
+    return guessed or 'application/octet-stream'
+
+
+def timed(items: Iterable, on_done: Callable[[float], None]) -> Iterator:
+    """
+    Yields from `items` and reports the time spent producing them, excluding the time
+    the consumer holds each item.
+    """
+    elapsed = 0.0
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            elapsed += time.perf_counter() - start
+            break
+        elapsed += time.perf_counter() - start
+        yield item
+    on_done(elapsed)
+
+
+def partition_text_file(file: IO[bytes], filename: str, mimetype: str) -> List[Element]:
+    from unstructured.partition.text import partition_text
+    return partition_text(file=file, metadata_filename=filename)
+
+
+def partition_markdown_file(file: IO[bytes], filename: str, mimetype: str) -> List[Element]:
+    from unstructured.partition.md import partition_md
+    return partition_md(file=file, metadata_filename=filename)
+
+
+def partition_html_file(file: IO[bytes], filename: str, mimetype: str) -> List[Element]:
+    from unstructured.partition.html import partition_html
+    return partition_html(file=file, metadata_filename=filename)
+
+
+def partition_docx_file(file: IO[bytes], filename: str, mimetype: str) -> List[Element]:
+    from unstructured.partition.docx import partition_docx
+    return partition_docx(file=file, metadata_filename=filename)
+
+
+class PdfTextLayer:
+    """
+    Reads the embedded text layer of digitally born PDFs page by page. Returns None when
+    the sampled pages look scanned (too little text) so the caller falls back to OCR.
+    """
+
+    def __init__(self, min_chars_per_page: int = 200, min_text_pages: float = 0.8, sample_pages: int = 5):
+        self.min_chars_per_page = min_chars_per_page
+        self.min_text_pages = min_text_pages
+        self.sample_pages = sample_pages
+
+    def __call__(self, file: IO[bytes], filename: str, mimetype: str) -> Optional[Iterable[Element]]:
+        from pypdf import PdfReader
+
+        reader = PdfReader(file)
+        if not reader.pages:
+            return None
+        sample = [reader.pages[i].extract_text() or '' for i in range(min(self.sample_pages, len(reader.pages)))]
+        text_pages = sum(1 for text in sample if len(text.strip()) >= self.min_chars_per_page)
+        if text_pages / len(sample) < self.min_text_pages:
+            return None
+        return self._pages(reader, filename, sample)
+
+    @staticmethod
+    def _pages(reader, filename: str, sample: List[str]) -> Iterator[Element]:
+        for index in range(len(reader.pages)):
+            text = sample[index] if index < len(sample) else reader.pages[index].extract_text() or ''
+            if text.strip():
+                yield Text(
+                    text=text.strip(),
+                    metadata=ElementMetadata(filename=filename, filetype=PDF, page_number=index + 1),
+                )
+
+
+DEFAULT_LOCAL_PARTITIONERS: Dict[str, LocalPartitioner] = {
+    'text/plain': partition_text_file,
+    MARKDOWN: partition_markdown_file,
+    'text/html': partition_html_file,
+    DOCX: partition_docx_file,
+    PDF: PdfTextLayer(),
+}
+
+
+@dataclass
+class PartitionStat:
+    count: int = 0
+    failures: int = 0
+    total_s: float = 0.0
+    max_s: float = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total_s += seconds
+        self.max_s = max(self.max_s, seconds)
+
+
+def partition_via_pooled_api(file: IO[bytes], metadata_filename: str, api_key: Optional[str],
+                             api_url: Optional[str], content_type: str, **params) -> List[Element]:
+    """
+    `unstructured.partition.api.partition_via_api` on the pooled connections and the gate
+    of the unstructured provider. The library opens a new session for every file.
+    """
+    from unstructured.staging.base import elements_from_json
+
+    response = providers.http('unstructured', timeout_s=600).post(
+        api_url or UNSTRUCTURED_API_URL,
+        headers={'accept': 'application/json', 'unstructured-api-key': api_key or ''},
+        files={'files': (metadata_filename, file.read(), content_type)},
+        data={name: str(value).lower() if isinstance(value, bool) else str(value) for name, value in params.items()},
+    )
+    if response.status_code != 200:
+        raise ValueError(f"unstructured api returned {response.status_code}: {response.text[:500]}")
+    return elements_from_json(text=response.text)
+
+
+class PartitionRouter:
+    """
+    Picks a partition strategy per file: local partitioners for formats we can read
+    ourselves, the remote hi_res API for everything else or whenever local declines.
+    """
+
+    def __init__(self, remote: RemotePartitioner,
+                 local: Optional[Dict[str, LocalPartitioner]] = None):
+        self.remote = remote
+        self.local = DEFAULT_LOCAL_PARTITIONERS if local is None else local
+        self._stats: Dict[Tuple[str, str], PartitionStat] = {}
+        self._lock = threading.Lock()
+
+    def _record(self, mimetype: str, strategy: str, seconds: float, failed: bool = False):
+        with self._lock:
+            stat = self._stats.setdefault((mimetype, strategy), PartitionStat())
+            if failed:
+                stat.failures += 1
+            else:
+                stat.record(seconds)
+
+    def partition(self, file: IO[bytes], filename: str, content_type: str) -> Tuple[Iterable[Element], str]:
+        """
+        Returns the elements lazily where the partitioner allows it. Latency stats are
+        recorded once the returned iterable is exhausted.
+        """
+        mimetype = resolve_mimetype(filename, content_type)
+
+        local = self.local.get(mimetype)
+        if local:
+            start = time.perf_counter()
+            try:
+                elements = local(file, filename, mimetype)
+                if elements is not None:
+                    setup_s = time.perf_counter() - start
+                    return timed(elements, lambda s: self._record(mimetype, 'local', setup_s + s)), 'local'
+                self._record(mimetype, 'local_declined', time.perf_counter() - start)
+            except Exception as err:
+                logging.warning(f"local partition of {filename} ({mimetype}) failed, using remote: {err!r}")
+                self._record(mimetype, 'local', 0, failed=True)
+            file.seek(0)
+
+        start = time.perf_counter()
+        elements = self.remote(file, filename, content_type or mimetype)
+        setup_s = time.perf_counter() - start
+        return timed(elements, lambda s: self._record(mimetype, 'remote', setup_s + s)), 'remote'
+
+    def get_stats(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        with self._lock:
+            stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+            for (mimetype, strategy), stat in self._stats.items():
+                stats.setdefault(mimetype, {})[strategy] = {
+                    'count': stat.count,
+                    'failures': stat.failures,
+                    'mean_s': stat.total_s / stat.count if stat.count else 0.0,
+                    'max_s': stat.max_s,
+                }
+            return stats
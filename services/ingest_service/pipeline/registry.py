@@ -0,0 +1,79 @@
+import os
+import threading
+from typing import Callable, Dict, Optional, Type, Tuple
+
+from app_ctx import ApplicationContext
+from pipeline import IngestPipeline, CostClass
+from pipeline.code import CodePipeline
+from pipeline.data import DataPipeline
+from pipeline.document import DocumentPipeline
+from pipeline.image import ImagePipeline
+from pipeline.partition import resolve_mimetype
+from pipeline.video import VideoPipeline
+
+PipelineFactory = Callable[[ApplicationContext], IngestPipeline]
+
+
+class PipelineRegistry:
+    """
+    Routes a file to a pipeline by extension, then by exact mimetype, then by `type/*`,
+    and falls back to the default pipeline. Pipelines are only built once a file needs
+    them, routing and scheduling only look at the classes.
+    """
+
+    def __init__(self, ctx: Optional[ApplicationContext], default: Type[IngestPipeline] = DocumentPipeline):
+        self.ctx = ctx
+        self.default = default
+        self._classes: Dict[str, Type[IngestPipeline]] = {default.name: default}
+        self._factories: Dict[str, PipelineFactory] = {default.name: default}
+        self._by_extension: Dict[str, str] = {}
+        self._by_mimetype: Dict[str, str] = {}
+        self._instances: Dict[str, IngestPipeline] = {}
+        self._lock = threading.Lock()
+
+    def register(self, pipeline: Type[IngestPipeline], factory: Optional[PipelineFactory] = None):
+        if not pipeline.name:
+            raise ValueError(f"{pipeline.__name__} has no name")
+        self._classes[pipeline.name] = pipeline
+        self._factories[pipeline.name] = factory or pipeline
+        for extension in pipeline.extensions:
+            self._by_extension[extension.lower()] = pipeline.name
+        for mimetype in pipeline.mimetypes:
+            self._by_mimetype[mimetype] = pipeline.name
+        return self
+
+    def resolve(self, filename: str, content_type: Optional[str]) -> Tuple[Type[IngestPipeline], str]:
+        """
+        Returns the pipeline class and the resolved mimetype.
+        """
+        mimetype = resolve_mimetype(filename, content_type)
+        name = self._by_extension.get(os.path.splitext(filename)[1].lower()) \
+            or self._by_mimetype.get(mimetype) \
+            or self._by_mimetype.get(mimetype.split('/')[0] + '/*')
+        return self._classes.get(name, self.default), mimetype
+
+    def classify(self, filename: str, content_type: Optional[str]) -> Tuple[str, CostClass]:
+        pipeline, mimetype = self.resolve(filename, content_type)
+        return pipeline.name, pipeline.cost_class_for(filename, mimetype)
+
+    def concurrency(self, name: str) -> int:
+        pipeline = self._classes.get(name, self.default)
+        return int(os.getenv(f'INGEST_{pipeline.name.upper()}_CONCURRENCY', pipeline.concurrency))
+
+    def get(self, name: str) -> IngestPipeline:
+        name = name if name in self._classes else self.default.name
+        with self._lock:
+            if name not in self._instances:
+                self._instances[name] = self._factories[name](self.ctx)
+            return self._instances[name]
+
+    def built(self, name: str) -> Optional[IngestPipeline]:
+        return self._instances.get(name)
+
+
+def build_registry(ctx: Optional[ApplicationContext]) -> PipelineRegistry:
+    return PipelineRegistry(ctx) \
+        .register(CodePipeline) \
+        .register(DataPipeline) \
+        .register(ImagePipeline) \
+        .register(VideoPipeline)
@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Sequence, Tuple, Type, Dict, Any, Optional, Iterable, Iterator, Callable
+
+import openai
+from llama_index.core.schema import BaseNode, MetadataMode
+
+from embedding_cache import estimate_tokens
+from pipeline import IngestStatus, ProgressCallback, no_progress
+
+# 429s are retried by the provider gate before they get here, retrying them again would
+# multiply its attempts
+TRANSIENT_ERRORS: Tuple[Type[BaseException], ...] = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+)
+
+
+@dataclass
+class BatchSettings:
+    embed_batch_size: int = 100
+    embed_concurrency: int = 4
+    upsert_batch_size: int = 100
+    upsert_concurrency: int = 4
+    max_retries: int = 5
+    backoff_s: float = 0.5
+    max_backoff_s: float = 20
+
+    @classmethod
+    def from_env(cls) -> 'BatchSettings':
+        return cls(
+            embed_batch_size=int(os.getenv('INGEST_EMBED_BATCH_SIZE', cls.embed_batch_size)),
+            embed_concurrency=int(os.getenv('INGEST_EMBED_CONCURRENCY', cls.embed_concurrency)),
+            upsert_batch_size=int(os.getenv('INGEST_UPSERT_BATCH_SIZE', cls.upsert_batch_size)),
+            upsert_concurrency=int(os.getenv('INGEST_UPSERT_CONCURRENCY', cls.upsert_concurrency)),
+        )
+
+
+@dataclass
+class IngestReport:
+    """
+    Stage times are busy time summed over batches, so concurrent stages can add up to
+    more than `wall_s`.
+    """
+
+    chunks: int = 0
+    tokens: int = 0
+    retries: int = 0
+    wall_s: float = 0.0
+    stage_s: Dict[str, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stage_s[stage] = self.stage_s.get(stage, 0.0) + seconds
+
+    def merge(self, other: 'IngestReport'):
+        self.chunks += other.chunks
+        self.tokens += other.tokens
+        self.retries += other.retries
+        self.wall_s += other.wall_s
+        for stage, seconds in other.stage_s.items():
+            self.add_time(stage, seconds)
+
+    @property
+    def total_s(self) -> float:
+        return self.wall_s or sum(self.stage_s.values())
+
+    def to_dict(self) -> Dict[str, Any]:
+        total = self.total_s
+        embed_s = self.stage_s.get('embed', 0.0)
+        return {
+            'chunks': self.chunks,
+            'tokens': self.tokens,
+            'retries': self.retries,
+            'stage_s': dict(self.stage_s),
+            'total_s': total,
+            'chunks_per_s': self.chunks / total if total else 0.0,
+            'embed_tokens_per_s': self.tokens / embed_s if embed_s else 0.0,
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def batched(items: Sequence, size: int) -> List[Sequence]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def take(iterator: Iterator, size: int) -> list:
+    return list(itertools.islice(iterator, size))
+
+
+_DONE = object()
+
+
+def merge_streams(streams: List[Iterable], concurrency: int, maxsize: int = 256,
+                  on_error: Optional[Callable[[int, Exception], None]] = None,
+                  poll_s: float = 0.1) -> Iterator:
+    """
+    Drains several iterables on worker threads into one iterator. The bounded queue
+    applies backpressure, so producers never run more than `maxsize` items ahead. An
+    error of a stream goes to `on_error`, without one (or when it raises) the merged
+    iterator ends with it. Closing or abandoning the merged iterator stops the producers
+    and closes their streams.
+    """
+    items: queue.Queue = queue.Queue(maxsize=maxsize)
+    next_stream = iter(enumerate(streams))
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors: List[BaseException] = []
+
+    def put(item) -> bool:
+        # gives up once the consumer is gone, a blocking put would hold the thread forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=poll_s)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while not stop.is_set():
+                with lock:
+                    index, stream = next(next_stream, (None, None))
+                if stream is None:
+                    break
+                iterator = iter(stream)
+                try:
+                    for item in iterator:
+                        if not put(item):
+                            break
+                except Exception as err:
+                    if on_error is None:
+                        raise
+                    on_error(index, err)
+                finally:
+                    # runs the stream's own cleanup, e.g. closes its reader, when it was cut short
+                    close = getattr(iterator, 'close', None)
+                    if close is not None:
+                        close()
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            put(_DONE)
+
+    workers = [threading.Thread(target=produce, daemon=True) for _ in range(max(1, min(concurrency, len(streams))))]
+    for worker in workers:
+        worker.start()
+    try:
+        finished = 0
+        while finished < len(workers):
+            if errors:
+                raise errors[0]
+            try:
+                item = items.get(timeout=poll_s)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                finished += 1
+            else:
+                yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+class BatchedIngestor:
+    """
+    Embeds nodes in batches and upserts them into the vector store, with a bounded number
+    of batches in flight. Embedding of one batch overlaps the upsert of the previous ones.
+    Timeouts and connection errors are retried with jittered backoff.
+    """
+
+    def __init__(self, embed_model, vector_store, settings: Optional[BatchSettings] = None,
+                 retry_on: Tuple[Type[BaseException], ...] = TRANSIENT_ERRORS):
+        self.embed_model = embed_model
+        self.vector_store = vector_store
+        self.settings = settings or BatchSettings()
+        self.retry_on = retry_on
+
+    async def _with_retry(self, report: IngestReport, fn, *args):
+        attempt = 0
+        while True:
+            try:
+                return await fn(*args)
+            except self.retry_on as err:
+                attempt += 1
+                if attempt > self.settings.max_retries:
+                    raise
+                report.retries += 1
+                delay = min(self.settings.max_backoff_s, self.settings.backoff_s * 2 ** (attempt - 1))
+                delay *= 0.5 + random.random()
+                logging.warning(f"retrying after {err!r} in {delay:.2f}s (attempt {attempt})")
+                await asyncio.sleep(delay)
+
+    async def _embed_batch(self, batch: Sequence[BaseNode], report: IngestReport):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+        start = time.perf_counter()
+        embeddings = await self._with_retry(report, self.embed_model.aget_text_embedding_batch, texts)
+        report.add_time('embed', time.perf_counter() - start)
+        for node, embedding in zip(batch, embeddings):
+            node.embedding = embedding
+        report.tokens += sum(estimate_tokens(text) for text in texts)
+
+    async def _upsert_batch(self, batch: Sequence[BaseNode], report: IngestReport):
+        start = time.perf_counter()
+        # vector store clients are synchronous, run the batches on threads
+        await self._with_retry(report, asyncio.to_thread, self.vector_store.add, list(batch))
+        report.add_time('upsert', time.perf_counter() - start)
+
+    async def arun(self, nodes: Iterable[BaseNode], report: Optional[IngestReport] = None,
+                   progress: Optional[ProgressCallback] = None) -> IngestReport:
+        """
+        Pulls nodes from `nodes` one embedding batch at a time, so at most
+        `embed_concurrency` batches are held in memory regardless of document size.
+        """
+        report = report or IngestReport()
+        progress = progress or no_progress
+        started = time.perf_counter()
+        embed_slots = asyncio.Semaphore(self.settings.embed_concurrency)
+        upsert_slots = asyncio.Semaphore(self.settings.upsert_concurrency)
+        stages_seen = set()
+
+        def enter(status: IngestStatus):
+            if status not in stages_seen:
+                stages_seen.add(status)
+                progress(status)
+
+        async def process(batch: List[BaseNode]):
+            try:
+                enter(IngestStatus.EMBEDDING)
+                await self._embed_batch(batch, report)
+                enter(IngestStatus.UPSERTING)
+                for upsert in batched(batch, self.settings.upsert_batch_size):
+                    async with upsert_slots:
+                        await self._upsert_batch(upsert, report)
+            finally:
+                embed_slots.release()
+
+        iterator = iter(nodes)
+        tasks = set()
+        try:
+            while True:
+                await embed_slots.acquire()
+                # producing nodes may partition and chunk, keep it off the event loop
+                batch = await asyncio.to_thread(take, iterator, self.settings.embed_batch_size)
+                if not batch:
+                    embed_slots.release()
+                    break
+                report.chunks += len(batch)
+                tasks.add(asyncio.create_task(process(batch)))
+                # surface failures early instead of after the whole stream is read
+                for done in [task for task in tasks if task.done()]:
+                    tasks.remove(done)
+                    done.result()
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            report.wall_s += time.perf_counter() - started
+        return report
+
+    def run(self, nodes: Iterable[BaseNode], report: Optional[IngestReport] = None,
+            progress: Optional[ProgressCallback] = None) -> IngestReport:
+        return asyncio.run(self.arun(nodes, report, progress))
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from llama_index.core.schema import BaseNode
+
+from app_ctx import ApplicationContext
+from pipeline import IngestPipeline, CostClass, make_node
+from pipeline.image import RemoteTextExtractor, TextExtractor
+from pipeline.stages import IngestReport
+
+# hooks work on a local copy of the video, so tests can swap them for fakes without ffmpeg
+VideoProbe = Callable[[str], Dict[str, Any]]
+KeyframeExtractor = Callable[[str, str, int], List[Tuple[float, str]]]
+
+PTS_TIME = re.compile(r'pts_time:\s*([\d.]+)')
+
+
+def ffprobe(path: str) -> Dict[str, Any]:
+    if not shutil.which('ffprobe'):
+        logging.warning("ffprobe is not installed, skipping video metadata")
+        return {}
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+        capture_output=True, check=True, timeout=60,
+    )
+    probe = json.loads(result.stdout)
+    video = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), {})
+    metadata = {
+        'duration_s': round(float(probe.get('format', {}).get('duration', 0) or 0), 2),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'codec': video.get('codec_name'),
+        'title': probe.get('format', {}).get('tags', {}).get('title'),
+    }
+    return {key: value for key, value in metadata.items() if value}
+
+
+def ffmpeg_keyframes(path: str, out_dir: str, max_frames: int) -> List[Tuple[float, str]]:
+    """
+    Decodes keyframes only, at most one every two seconds. Returns (timestamp, image path).
+    """
+    if not shutil.which('ffmpeg'):
+        logging.warning("ffmpeg is not installed, skipping keyframes")
+        return []
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'info', '-nostats', '-skip_frame', 'nokey', '-i', path,
+         '-vf', "select='isnan(prev_selected_t)+gte(t-prev_selected_t,2)',showinfo", '-vsync', 'vfr',
+         '-frames:v', str(max_frames), os.path.join(out_dir, '%d.jpg')],
+        capture_output=True, check=True, timeout=600, text=True,
+    )
+    # showinfo logs one line per written frame, in order
+    timestamps = [float(match) for match in PTS_TIME.findall(result.stderr)]
+    frames = sorted(os.listdir(out_dir), key=lambda name: int(name.split('.')[0]))
+    return [(round(timestamp, 2), os.path.join(out_dir, name)) for timestamp, name in zip(timestamps, frames)]
+
+
+class VideoPipeline(IngestPipeline):
+    """
+    Indexes a video by its metadata and by the text visible in its keyframes (slides,
+    captions, whiteboards). Only one of these runs at a time, they are the slowest jobs.
+    """
+
+    name = 'video'
+    mimetypes = ('video/*',)
+    extensions = ('.mp4', '.mov', '.mkv', '.webm', '.avi', '.m4v')
+    cost_class = CostClass.EXPENSIVE
+    concurrency = 1
+
+    def __init__(self, ctx: ApplicationContext, probe: Optional[VideoProbe] = None,
+                 extract_keyframes: Optional[KeyframeExtractor] = None,
+                 extract_text: Optional[TextExtractor] = None, max_frames: int = 20):
+        super().__init__(ctx)
+        self.probe = probe or ffprobe
+        self.extract_keyframes = extract_keyframes or ffmpeg_keyframes
+        self.extract_text = extract_text or RemoteTextExtractor(ctx)
+        self.max_frames = max_frames
+
+    def prepare(self, file: IO[bytes], filename: str, mimetype: str, uid: str,
+                report: IngestReport) -> Iterator[BaseNode]:
+        source_id = str(uuid.uuid4())
+        base_metadata = {'filename': filename, 'filetype': mimetype, 'user': uid}
+
+        with tempfile.TemporaryDirectory(prefix='ingest-video-') as workdir:
+            path = os.path.join(workdir, 'video' + os.path.splitext(filename)[1])
+            with open(path, 'wb') as local:
+                shutil.copyfileobj(file, local, length=1024 * 1024)
+
+            start = time.perf_counter()
+            try:
+                metadata = self.probe(path)
+            except Exception as err:
+                logging.warning(f"could not probe {filename}: {err!r}")
+                metadata = {}
+            frames_dir = os.path.join(workdir, 'frames')
+            os.mkdir(frames_dir)
+            try:
+                frames = self.extract_keyframes(path, frames_dir, self.max_frames)
+            except Exception as err:
+                logging.warning(f"could not extract keyframes of {filename}: {err!r}")
+                frames = []
+            report.add_time('partition', time.perf_counter() - start)
+
+            summary = ', '.join(f'{key}: {value}' for key, value in metadata.items())
+            yield make_node(
+                text=f"Video {filename}" + (f" ({summary})" if summary else ''),
+                metadata={**base_metadata, **metadata},
+                source_id=source_id,
+                excluded_llm_keys=('filetype', 'user'),
+                excluded_embed_keys=('filetype', 'width', 'height', 'codec', 'user'),
+            )
+
+            previous = ''
+            for index, (timestamp, frame_path) in enumerate(frames):
+                start = time.perf_counter()
+                with open(frame_path, 'rb') as frame:
+                    text = self.extract_text(frame, os.path.basename(frame_path), 'image/jpeg').strip()
+                report.add_time('partition', time.perf_counter() - start)
+                # consecutive frames of the same slide read the same
+                if not text or text == previous:
+                    continue
+                previous = text
+                yield make_node(
+                    text=text,
+                    metadata={**base_metadata, 'frame': index, 'timestamp': timestamp},
+                    source_id=source_id,
+                    excluded_llm_keys=('filetype', 'user'),
+                    excluded_embed_keys=('filetype', 'frame', 'timestamp', 'user'),
+                )
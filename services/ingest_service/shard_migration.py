@@ -0,0 +1,112 @@
+"""
+Moves existing vectors between Pinecone namespaces when VECTOR_SHARDING changes. Every
+vector goes to the namespace its `user` metadata maps to under the target strategy, in
+batches of listed ids. Runs are idempotent, so a run that fails part way can be repeated.
+Run from the service directory:
+
+    python -m shard_migration --from none --to user --dry-run
+    python -m shard_migration --from none --to user
+    python -m shard_migration --from none --to user --delete-source
+
+Cutover: copy without --delete-source, deploy both services with the new VECTOR_SHARDING,
+then run again with --delete-source. The second run also copies vectors that were written
+to the old namespaces before the deploy finished.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import List, Dict, Any
+
+from pinecone import Pinecone
+
+from vector_sharding import ShardingStrategy
+
+
+def source_namespaces(index, strategy: ShardingStrategy) -> List[str]:
+    if strategy.mode == 'none':
+        return [strategy.base]
+    namespaces = index.describe_index_stats().namespaces
+    return sorted(namespace for namespace in namespaces if namespace.startswith(f'{strategy.base}-'))
+
+
+def migrate_batch(index, namespace: str, ids: List[str], target: ShardingStrategy,
+                  counts: Counter, destinations: set, dry_run: bool, delete_source: bool, retries: int = 5):
+    vectors = index.fetch(ids=ids, namespace=namespace).vectors
+    by_namespace: Dict[str, List[Dict[str, Any]]] = {}
+    moved = []
+    for vector_id, vector in vectors.items():
+        uid = (vector.metadata or {}).get('user')
+        if uid is None:
+            counts['missing_user'] += 1
+            continue
+        destination = target.namespace(str(uid))
+        if destination == namespace:
+            counts['in_place'] += 1
+            continue
+        by_namespace.setdefault(destination, []).append(
+            {'id': vector_id, 'values': vector.values, 'metadata': vector.metadata}
+        )
+        moved.append(vector_id)
+
+    counts['selected'] += len(moved)
+    destinations.update(by_namespace)
+    if dry_run:
+        return
+    for destination, batch in by_namespace.items():
+        for attempt in range(retries):
+            try:
+                index.upsert(vectors=batch, namespace=destination)
+                break
+            except Exception as err:
+                if attempt == retries - 1:
+                    raise
+                logging.warning(f"upsert to {destination} failed, retrying: {err!r}")
+                time.sleep(0.5 * 2 ** attempt)
+        counts['copied'] += len(batch)
+
+    # sources are only removed after every copy of the batch succeeded
+    if delete_source and moved:
+        index.delete(ids=moved, namespace=namespace)
+        counts['deleted'] += len(moved)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--from', dest='source', choices=ShardingStrategy.MODES, default='none')
+    parser.add_argument('--to', dest='target', choices=ShardingStrategy.MODES, required=True)
+    parser.add_argument('--from-shards', type=int, default=16)
+    parser.add_argument('--to-shards', type=int, default=int(os.getenv('VECTOR_SHARDS', '16')))
+    parser.add_argument('--base', type=str, default='documents')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--delete-source', action='store_true')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    index = Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index("text-embedding-3-small-index")
+    source = ShardingStrategy(args.source, args.from_shards, args.base)
+    target = ShardingStrategy(args.target, args.to_shards, args.base)
+
+    counts, destinations = Counter(), set()
+    start = time.perf_counter()
+    for namespace in source_namespaces(index, source):
+        for ids in index.list(namespace=namespace, limit=args.batch_size):
+            migrate_batch(index, namespace, ids, target, counts, destinations, args.dry_run, args.delete_source)
+            counts['batches'] += 1
+            if counts['batches'] % 10 == 0:
+                logging.info(f"{namespace}: {counts['copied']} copied in {time.perf_counter() - start:.0f}s")
+
+    summary = {
+        'dry_run': args.dry_run,
+        **{key: counts[key] for key in ('selected', 'copied', 'deleted', 'in_place', 'missing_user', 'batches')},
+        'target_namespaces': len(destinations),
+        'elapsed_s': time.perf_counter() - start,
+    }
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
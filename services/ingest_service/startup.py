@@ -0,0 +1,219 @@
+"""
+Cold starts: clients built on first use, the api module imported while they are built
+concurrently, warm-up of the hot path after that, and a report of every step for /ready.
+Imported first by main so its clock starts close to the process.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, List, Optional, Sequence
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from metrics import metrics
+
+STARTED_AT = time.perf_counter()
+
+WarmUpTasks = Dict[str, Callable[[], Any]]
+
+
+class StartupReport:
+    """
+    Durations of the startup steps and the time of each milestone, in seconds since
+    the process imported this module.
+    """
+
+    def __init__(self, started_at: float = STARTED_AT):
+        self.started_at = started_at
+        self.steps: Dict[str, Dict[str, Any]] = {}
+        self.milestones: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    @contextmanager
+    def step(self, name: str):
+        start = self.elapsed()
+        error = None
+        try:
+            yield
+        except Exception as err:
+            error = repr(err)
+            raise
+        finally:
+            with self._lock:
+                self.steps[name] = {
+                    'started_s': start,
+                    'duration_s': self.elapsed() - start,
+                    'thread': threading.current_thread().name,
+                    'error': error,
+                }
+
+    def mark(self, milestone: str):
+        with self._lock:
+            self.milestones.setdefault(milestone, self.elapsed())
+
+    def fail(self, name: str, error: BaseException):
+        with self._lock:
+            self.errors[name] = repr(error)
+
+    @property
+    def ready(self) -> bool:
+        return 'ready' in self.milestones and not self.errors
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            steps = sorted(self.steps.items(), key=lambda item: item[1]['started_s'])
+            return {
+                'ready': self.ready,
+                'uptime_s': self.elapsed(),
+                'milestones': dict(self.milestones),
+                'steps': [{'name': name, **step} for name, step in steps],
+                'errors': dict(self.errors),
+            }
+
+
+report = StartupReport()
+
+metrics.gauge('startup_seconds', 'Seconds from process start to each startup milestone',
+              lambda: {(milestone,): s for milestone, s in report.milestones.items()}, labels=('milestone',))
+
+
+class lazy:
+    """
+    `functools.cached_property` for clients: built on first access, once even when
+    several threads ask at the same time, and recorded as a startup step. After that
+    the value is a plain instance attribute. `@lazy(warm=False)` leaves a client out of
+    the startup warm-up.
+    """
+
+    _locks_lock = threading.Lock()
+
+    def __init__(self, build: Optional[Callable[[Any], Any]] = None, warm: bool = True):
+        self.warm = warm
+        self.build = build
+        if build is not None:
+            self.name = build.__name__
+            self.__doc__ = build.__doc__
+
+    def __call__(self, build: Callable[[Any], Any]) -> 'lazy':
+        return lazy(build, warm=self.warm)
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def _lock(self, instance) -> threading.Lock:
+        with self._locks_lock:
+            locks = instance.__dict__.setdefault('_lazy_locks', {})
+            return locks.setdefault(self.name, threading.Lock())
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with self._lock(instance):
+            # another thread may have built it while this one waited
+            if self.name not in instance.__dict__:
+                with report.step(f'client.{self.name}'):
+                    instance.__dict__[self.name] = self.build(instance)
+            return instance.__dict__[self.name]
+
+
+def lazy_names(obj: Any) -> List[str]:
+    """
+    The clients of `obj` the startup warm-up builds.
+    """
+    return [name for cls in type(obj).__mro__ for name, value in vars(cls).items()
+            if isinstance(value, lazy) and value.warm]
+
+
+def warm_up(tasks: WarmUpTasks, timed: bool = True, max_workers: int = 8) -> Dict[str, BaseException]:
+    """
+    Runs the tasks concurrently and returns the errors by task name. Most of the work is
+    network handshakes and imports, so threads overlap nearly all of it.
+    """
+    errors: Dict[str, BaseException] = {}
+
+    def run(name: str, task: Callable[[], Any]):
+        try:
+            if timed:
+                with report.step(name):
+                    task()
+            else:
+                task()
+        except Exception as err:
+            logging.exception(f"warm up of {name} failed")
+            errors[name] = err
+
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks)), thread_name_prefix='warm-up') as pool:
+            list(pool.map(lambda item: run(*item), tasks.items()))
+    return errors
+
+
+def lifespan(api: str, routers: Sequence[str]):
+    """
+    Lifespan of an app whose routes live in the module `api`. The shared application
+    context builds its clients concurrently while `api` imports, which only waits on the
+    clients it touches. The routers are included once it is imported, then the tasks of
+    its `warm_up_tasks()` run. STARTUP_WARMUP=blocking serves only after those,
+    `background` (the default) serves right away and /ready answers 503 until they finish.
+    """
+
+    @asynccontextmanager
+    async def run(app):
+        import app_ctx
+
+        blocking = os.getenv('STARTUP_WARMUP', 'background') == 'blocking'
+        ctx = await asyncio.to_thread(app_ctx.get_context)
+        clients = asyncio.create_task(asyncio.to_thread(
+            warm_up, {name: lambda name=name: getattr(ctx, name) for name in lazy_names(ctx)}, False
+        ))
+        try:
+            with report.step(f'import.{api}'):
+                module = await asyncio.to_thread(importlib.import_module, api)
+        except Exception:
+            clients.cancel()
+            raise
+        for router in routers:
+            app.include_router(getattr(module, router))
+        report.mark('routes')
+
+        async def warm():
+            for name, err in (await clients).items():
+                report.fail(f'client.{name}', err)
+            tasks = module.warm_up_tasks() if hasattr(module, 'warm_up_tasks') else {}
+            # the hot path works without these, a failure only costs the first requests
+            await asyncio.to_thread(warm_up, tasks)
+            report.mark('ready')
+            logging.info(f"ready after {report.milestones['ready']:.2f}s")
+
+        warming = asyncio.create_task(warm())
+        if blocking:
+            await warming
+        report.mark('serving')
+        yield
+        if not warming.done():
+            warming.cancel()
+
+    return run
+
+
+startup_router = APIRouter()
+
+
+@startup_router.get('/ready')
+async def get_ready():
+    """
+    200 once the clients are built and the hot path is warm, 503 before that or when a
+    client failed to build. The body is the startup report either way.
+    """
+    body = report.to_dict()
+    return JSONResponse(body, status_code=200 if body['ready'] else 503)
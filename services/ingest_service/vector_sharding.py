@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import defaultdict
+from typing import List, Optional, Dict, Any, Callable
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+
+
+class ShardingStrategy:
+    """
+    Maps a user to the Pinecone namespace holding their vectors. `none` keeps everyone in
+    the base namespace, `user` gives every user a namespace of their own and `hash`
+    spreads users over a fixed number of namespaces.
+    """
+
+    MODES = ('none', 'user', 'hash')
+
+    def __init__(self, mode: str = 'none', shards: int = 16, base: str = 'documents'):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown sharding mode {mode}, expected one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.shards = shards
+        self.base = base
+
+    @classmethod
+    def from_env(cls) -> 'ShardingStrategy':
+        return cls(
+            mode=os.getenv('VECTOR_SHARDING', 'none'),
+            shards=int(os.getenv('VECTOR_SHARDS', '16')),
+        )
+
+    def namespace(self, uid: str) -> str:
+        if self.mode == 'none':
+            return self.base
+        if self.mode == 'user':
+            return f'{self.base}-{uid}'
+        shard = int(hashlib.sha256(uid.encode('utf-8')).hexdigest(), 16) % self.shards
+        return f'{self.base}-{shard:03d}'
+
+    def namespaces(self) -> Optional[List[str]]:
+        """
+        Every namespace a user can map to, None when there is one per user.
+        """
+        if self.mode == 'none':
+            return [self.base]
+        if self.mode == 'hash':
+            return [f'{self.base}-{shard:03d}' for shard in range(self.shards)]
+        return None
+
+
+class ShardedVectorStore(BasePydanticVectorStore):
+    """
+    Routes every call to the store of the user's namespace: writes by the user metadata of
+    each node, queries by their exact match filter on it. The filter is still passed on,
+    hashed namespaces are shared between users.
+    """
+
+    stores_text: bool = True
+    partition_key: str = Field(default='user')
+
+    _strategy: ShardingStrategy = PrivateAttr()
+    _factory: Callable[[str], BasePydanticVectorStore] = PrivateAttr()
+    _stores: Dict[str, BasePydanticVectorStore] = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, strategy: ShardingStrategy, factory: Callable[[str], BasePydanticVectorStore],
+                 partition_key: str = 'user', **kwargs: Any):
+        super().__init__(partition_key=partition_key, **kwargs)
+        self._strategy = strategy
+        self._factory = factory
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'ShardedVectorStore'
+
+    @property
+    def client(self) -> Any:
+        return self.shard('').client
+
+    def shard(self, uid: str) -> BasePydanticVectorStore:
+        return self._store(self._strategy.namespace(uid))
+
+    def _store(self, namespace: str) -> BasePydanticVectorStore:
+        with self._lock:
+            store = self._stores.get(namespace)
+            if store is None:
+                store = self._stores[namespace] = self._factory(namespace)
+            return store
+
+    def _uid(self, query: VectorStoreQuery) -> Optional[str]:
+        for metadata_filter in (query.filters.filters if query.filters else []):
+            if metadata_filter.key == self.partition_key:
+                return str(metadata_filter.value)
+        return None
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        by_uid: Dict[str, List[BaseNode]] = defaultdict(list)
+        for node in nodes:
+            uid = node.metadata.get(self.partition_key)
+            if uid is None:
+                raise ValueError(f"node {node.node_id} has no {self.partition_key} to shard by")
+            by_uid[str(uid)].append(node)
+        for uid, group in by_uid.items():
+            self.shard(uid).add(group, **add_kwargs)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, uid: Optional[str] = None, **delete_kwargs: Any) -> None:
+        """
+        Deletes the document from the namespace of `uid`, or from every namespace when the
+        owner is not given, which per user namespaces cannot list.
+        """
+        if uid is not None:
+            self.shard(uid).delete(ref_doc_id, **delete_kwargs)
+            return
+        namespaces = self._strategy.namespaces()
+        if namespaces is None:
+            raise ValueError(f"deletes from per user namespaces need the {self.partition_key} of the document")
+        for namespace in namespaces:
+            self._store(namespace).delete(ref_doc_id, **delete_kwargs)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        uid = self._uid(query)
+        if uid is None:
+            raise ValueError(f"sharded queries need an exact {self.partition_key} filter")
+        return self.shard(uid).query(query, **kwargs)
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        # pinecone has no async query, and a gated call may wait for a slot or back off
+        return await asyncio.to_thread(self.query, query, **kwargs)
@@ -239,6 +239,7 @@ export interface ChatAgentTask {
     event_id: string;
     parent_id: string;
     duration_s: number;
+    metrics?: { [key: string]: any } | null;
 }
 
 interface ChatAgentSources {
@@ -253,18 +254,20 @@ type AgentResponseType =
     | 'agent_error'
     | 'agent_event_start'
     | 'agent_event_stop'
+    | 'response_cache_hit'
     | 'response_start'
     | 'response_stream'
     | 'response_complete'
     | 'response_error';
 
+// compact lines leave out null and empty fields
 interface ChatResponseChunk {
     id: string;
     event_type: AgentResponseType;
-    task: ChatAgentTask | null;
-    error: string | null;
-    response_chunk: string;
-    sources: ChatAgentSources[];
+    task?: ChatAgentTask | null;
+    error?: string | null;
+    response_chunk?: string;
+    sources?: ChatAgentSources[];
 }
 
 export async function* generateResponse(message: string, chat: Chat) {
@@ -278,18 +281,27 @@ export async function* generateResponse(message: string, chat: Chat) {
     }
 
     const messages = chat.messages.history.slice(0, -1); // removes the last user message
-    const requestBody = JSON.stringify({
+    const buildRequestBody = (withHistory: boolean) => JSON.stringify({
         'model': chat.settings.model,
         'settings': {
             'temperature': chat.settings.temperature,
             'max_token': chat.settings.maxLength,
             'top_p': 0.5,
         },
-        'history': messages.map(msg => ({
+        // the service keeps the conversation, history is only sent when it asks for it
+        'conversation_id': chat.chatId,
+        'history_length': messages.length,
+        'history': withHistory ? messages.map(msg => ({
             'role': msg.role,
             'message': msg.content
-        })),
+        })) : [],
         message: message,
+        stream: {
+            verbosity: 'full',
+            coalesce_ms: 50,
+            coalesce_chars: 256,
+            compact: true,
+        },
     });
 
     const idToken = await firebaseAuth.currentUser?.getIdToken();
@@ -298,14 +310,19 @@ export async function* generateResponse(message: string, chat: Chat) {
         toast.error('Error occurred when getting an response');
     }
 
-    const response = await fetch(chatApiUrl, {
+    const postChat = (withHistory: boolean) => fetch(chatApiUrl, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
             'Authorization': `Bearer ${idToken}`,
         },
-        body: requestBody,
+        body: buildRequestBody(withHistory),
     });
+    let response = await postChat(false);
+    if (response.status === 409) {
+        // the service lost or never saw this conversation
+        response = await postChat(true);
+    }
     if (response.body) {
         const reader = response.body.getReader();
         let decoder = new TextDecoder();
@@ -387,14 +404,17 @@ export async function sendUserMessage(chatId: string, content: string) {
                     }
                     break;
                 }
+                case "response_cache_hit": {
+                    break;
+                }
                 case "response_start": {
                     chatState.appendChatMessageResponse(
                         chatId,
                         responseMessageId,
-                        chunk.response_chunk,
+                        chunk.response_chunk ?? '',
                         false
                     );
-                    const sources: ContextSource[] = chunk.sources.map(source => {
+                    const sources: ContextSource[] = (chunk.sources ?? []).map(source => {
                         const context: ContextSource = {
                             type: 'document_text' as const,
                             score: source.score === null ? 0 : source.score,
@@ -410,7 +430,7 @@ export async function sendUserMessage(chatId: string, content: string) {
                     chatState.appendChatMessageResponse(
                         chatId,
                         responseMessageId,
-                        chunk.response_chunk,
+                        chunk.response_chunk ?? '',
                         false
                     );
                     break;
@@ -419,7 +439,7 @@ export async function sendUserMessage(chatId: string, content: string) {
                     chatState.appendChatMessageResponse(
                         chatId,
                         responseMessageId,
-                        chunk.response_chunk,
+                        chunk.response_chunk ?? '',
                         true
                     );
                     break;